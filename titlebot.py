@@ -1,18 +1,59 @@
 from errbot import BotPlugin, botcmd, arg_botcmd, webhook
 from errbot.backends.base import RoomDoesNotExistError, UserDoesNotExistError
+from flask import Response
 
 from queue import Queue
-from threading import Thread
+from threading import Condition, Event, Lock, RLock, Thread, local
 
+import collections
+import copy
+import csv
+import functools
+import heapq
+import importlib
+import io
+import inspect
+import itertools
+import json
 import logging
 import math
-import requests;
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import tempfile
 import time
+import unicodedata
+import zlib
 
-try:
-    import emoji
-except ImportError:
-    pass # optional, not required
+# modules only some features need (requests: HSLive forwarding, emoji: optional), imported on first use to keep loading the plugin fast
+LAZY_MODULES = { }
+LAZY_LOCK = Lock()
+
+
+# name: string -> module (None: not installed)
+def lazyImport(name):
+    if name not in LAZY_MODULES:
+        with LAZY_LOCK:
+            if name not in LAZY_MODULES:
+                try:
+                    LAZY_MODULES[name] = importlib.import_module(name)
+                except ImportError:
+                    LAZY_MODULES[name] = None
+    
+    return LAZY_MODULES[name]
+
+
+# text: string -> string (raises AttributeError: emoji not installed)
+def emojize(text):
+    emoji = lazyImport('emoji')
+    
+    try:
+        return emoji.emojize(text, language='alias')
+    except (TypeError, KeyError):
+        return emoji.emojize(text, use_aliases=True) # emoji before 2.0
 
 
 class VotingOption:
@@ -20,32 +61,104 @@ class VotingOption:
     # text          string
     # votes         int
     # deleted       boolean
+    # deletedTS     float (-1: not deleted or unknown)
     
     def __init__(self, id, text):
         self.id = id
         self.text = text
         self.votes = 0
         self.deleted = False
+        self.deletedTS = -1
 
 
 
 class PersistedVote:
     # user          String
-    # option        Index for ChanInfo.options (or ChanConfig.options)
+    # option        VotingOption.id, the first option of the ballot
+    # ballot        tuple of VotingOption.id (None: just option. missing in votes persisted by older releases)
     
-    def __init__(self, userVote):
-        self.user = str(userVote.user.person)
-        self.option = userVote.option
+    def __init__(self, user, option, ballot):
+        self.user = user
+        self.option = option
+        self.ballot = ballot
 
 
 
 class UserVote:
     # user          Person
-    # option        Index for ChanInfo.options
+    # option        VotingOption.id, the first option of the ballot
+    # uid           int, Identities id of user
+    # name          string, str(user.person) as interned by Identities
+    # ballot        tuple of VotingOption.id, the approved or ranked options (single mode: just option)
+    #
+    # never modified, a changed ballot is a new UserVote
     
-    def __init__(self, user, option):
+    def __init__(self, user, uid, name, ballot):
         self.user = user
-        self.option = option
+        self.option = ballot[0]
+        self.uid = uid
+        self.name = name
+        self.ballot = ballot
+
+
+
+class Identities:
+    """
+    Interns the persons of the chat backend: each user gets a compact integer id and its string form is computed once
+    
+    Ids are never reused or dropped, there are only as many as users ever seen by the bot.
+    """
+    
+    # ids           dict of Person -> int, each Person object the backend handed out for a user maps to its id
+    # byName        dict of string -> int
+    # names         list of string, str(person.person) by id
+    # lock          Lock, guards additions (lookups of known persons do not lock)
+    
+    def __init__(self):
+        self.ids = { }
+        self.byName = { }
+        self.names = [ ]
+        self.lock = Lock()
+    
+    
+    # person: Person -> int
+    def intern(self, person):
+        try:
+            uid = self.ids.get(person)
+        except TypeError: # unhashable person of some backend
+            return self.internName(str(person.person))
+        
+        if uid is None:
+            uid = self.internName(str(person.person))
+            self.ids[person] = uid
+        
+        return uid
+    
+    
+    # name: string, str(person.person) -> int
+    def internName(self, name):
+        uid = self.byName.get(name)
+        
+        if uid is None:
+            with self.lock:
+                uid = self.byName.get(name)
+                
+                if uid is None:
+                    uid = len(self.names)
+                    self.names.append(name)
+                    self.byName[name] = uid
+        
+        return uid
+    
+    
+    # uid: int -> string
+    def name(self, uid):
+        return self.names[uid]
+    
+    
+    # person: Person -> string, str(person.person)
+    def nameOf(self, person):
+        return self.names[self.intern(person)]
 
 
 
@@ -53,764 +166,4669 @@ class ChanConfig:
     # channel       string
     # admins        list of string
     # apiKey        string
+    # digestInterval integer
+    # digestTop     integer
+    # polls         list of PollConfig
+    # defaultPoll   string
+    # duplicates    boolean
+    # similarity    float
+    # quickVotes    boolean
+    # floodUser     integer, commands per minute per user (-1: plugin default, 0: unlimited)
+    # floodChannel  integer, commands per second in the channel (-1: plugin default, 0: unlimited)
+    #
+    # configs persisted by older releases have no polls, but the attributes of a single poll instead:
     # options       list of VotingOption
     # userVotes     list of PersistetVote
     # enabled       boolean
+    # countdownTS   float
 
-    def __init__(self, room, admins, key, options, votes, enabled):
+    def __init__(self, room, admins, key, digestInterval, digestTop, polls, defaultPoll, duplicates, similarity, quickVotes, floodUser, floodChannel):
         self.channel = str(room)
         self.admins = admins[:]
         self.apiKey = key
-        self.options = options[:]
-        self.userVotes = [ PersistedVote(vote) for vote in votes ]
-        self.enabled = enabled
+        self.digestInterval = digestInterval
+        self.digestTop = digestTop
+        self.polls = polls[:]
+        self.defaultPoll = defaultPoll
+        self.duplicates = duplicates
+        self.similarity = similarity
+        self.quickVotes = quickVotes
+        self.floodUser = floodUser
+        self.floodChannel = floodChannel
+    
+    
+    # converts a config persisted by an older release into the current layout
+    # -> ChanConfig
+    def upgrade(self):
+        if not hasattr(self, 'polls'):
+            poll = PollConfig(self.channel, ChanInfo.DEFAULT_POLL, getattr(self, 'options', [ ]), [ ], getattr(self, 'enabled', False), getattr(self, 'countdownTS', -1), len(getattr(self, 'options', [ ])), 'single')
+            poll.userVotes = getattr(self, 'userVotes', [ ])
+            
+            self.polls = [ poll ]
+            self.defaultPoll = ChanInfo.DEFAULT_POLL
+        
+        return self
 
 
 
-class ChanInfo:
-    # channel       Room
-    # admins        list of string
-    # apiKey        string
+class PollConfig:
+    # channel       string
+    # name          string
     # options       list of VotingOption
-    # userVotes     list of UserVote
+    # userVotes     list of PersistetVote
     # enabled       boolean
     # countdownTS   float
-    # countdownVal  integer
-    # streamQueue   Queue
-    # streamWorker  WebsiteForwardWorker
+    # nextOption    integer, id of the next option added
+    # mode          string, Tally.MODES (missing in configs persisted by older releases: 'single')
 
-    def __init__(self, chan, adminList, key):
-        self.channel = chan
-        self.admins = adminList
-        self.apiKey = key
+    def __init__(self, room, name, options, votes, enabled, countdownTS, nextOption, mode):
+        self.channel = str(room)
+        self.name = name
+        self.options = options[:]
+        self.userVotes = [ PersistedVote(vote.name, vote.option, vote.ballot if len(vote.ballot) > 1 else None) for vote in votes ]
+        self.enabled = enabled
+        self.countdownTS = countdownTS
+        self.nextOption = nextOption
+        self.mode = mode
+
+
+
+class ArchiveEntry:
+    # id            integer, number of the archived poll within its channel
+    # poll          string, name of the poll
+    # finished      float
+    # reason        string, 'countdown', 'reset' or 'removed'
+    # options       integer, number of options
+    # voters        integer
+    # winner        string (None: no votes)
+    #
+    # the archived poll itself is stored separately as zlib compressed JSON
+
+    def __init__(self, poll, finished, reason, options, voters, winner):
+        self.id = -1
+        self.poll = poll
+        self.finished = finished
+        self.reason = reason
+        self.options = options
+        self.voters = voters
+        self.winner = winner
+
+
+
+class Export:
+    # name          string, file name without extension
+    # columns       tuple of string
+    # rows          iterator of tuple, generated lazily while rendering
+    #
+    # the rows are rendered in chunks, the whole document is never held in memory
+    
+    KINDS = ('options', 'results', 'votes')
+    FORMATS = { 'csv': 'text/csv', 'json': 'application/json' }
+    CHUNK_ROWS = 256
+    
+    COLUMNS = {
+        'options': ('id', 'text', 'votes'),
+        'results': ('place', 'id', 'text', 'votes'),
+        'votes': ('user', 'option', 'text', 'rank'),
+    }
+    
+    
+    def __init__(self, name, kind, rows):
+        self.name = name + '-' + kind
+        self.columns = Export.COLUMNS[kind]
+        self.rows = rows
+    
+    
+    # format: string -> iterator of str
+    def render(self, format):
+        if format == 'json':
+            return self.renderJson()
+        else:
+            return self.renderCsv()
+    
+    
+    # -> iterator of str
+    def renderCsv(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
         
-        self.options = [ ]
-        self.userVotes = [ ]
+        writer.writerow(self.columns)
         
-        self.streamQueue = None
-        self.streamWorker = None
+        for count, row in enumerate(self.rows, 1):
+            writer.writerow(row)
+            
+            if count % Export.CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                
+                buffer.seek(0)
+                buffer.truncate()
         
-        self.reset()
-
-
-    def reset(self):
-        self.options.clear()
-        self.userVotes.clear()
+        yield buffer.getvalue()
+    
+    
+    # -> iterator of str
+    def renderJson(self):
+        chunk = [ ]
+        separator = '[\n'
+        
+        for row in self.rows:
+            chunk.append(separator + json.dumps(dict(zip(self.columns, row))))
+            separator = ',\n'
+            
+            if len(chunk) >= Export.CHUNK_ROWS:
+                yield ''.join(chunk)
+                
+                chunk = [ ]
         
-        self.enabled = False
+        chunk.append('\n]\n' if separator != '[\n' else '[]\n')
+        
+        yield ''.join(chunk)
+    
+    
+    # rows of an archived poll (see Poll.exportArchive)
+    # id: int, record: dict, kind: string -> Export
+    @staticmethod
+    def fromArchive(id, record, kind):
+        options = [ option for option in record['options'] if not option['deleted'] ]
+        
+        if kind == 'options':
+            rows = ( (option['id'], option['text'], option['votes']) for option in options )
+        elif kind == 'results' and 'results' in record:
+            texts = { option['id']: option['text'] for option in record['options'] }
+            rows = ( (result['place'], result['id'], texts.get(result['id']), result['votes']) for result in record['results'] )
+        elif kind == 'results':
+            # archived by older releases, single votes only
+            results = sorted([ option for option in options if option['votes'] > 0 ], key=lambda option: option['votes'], reverse=True)
+            rows = ( (place, option['id'], option['text'], option['votes']) for place, option in enumerate(results, 1) )
+        else:
+            texts = { option['id']: option['text'] for option in record['options'] }
+            rows = ( (vote['user'], option, texts.get(option), rank) for vote in record['votes'] for rank, option in enumerate(vote.get('ballot', [ vote['option'] ]), 1) )
         
-        self.resetCountdown()
+        return Export(record['channel'].lstrip('#') + '-' + record['poll'] + '-archive-' + str(id), kind, rows)
 
 
-    def resetCountdown(self):
-        self.countdownTS = -1
-        self.countdownVal = -1;
 
+class EventLog:
+    """
+    Bounded log of the recent state changes of a channel, read by the event stream webhooks
+    
+    Readers only keep a cursor (the sequence number of the last event they have received), thus each listener is bounded by the log size.
+    A listener lagging behind the oldest event gets a reset and has to reload the state.
+    """
+    
+    # events        deque of (int, string), sequence number and JSON encoded event
+    # seq           int, sequence number of the latest event
+    # cond          Condition, notifies waiting readers
+    # closed        bool
+    
+    def __init__(self, size):
+        self.events = collections.deque(maxlen=size)
+        self.seq = 0
+        self.cond = Condition()
+        self.closed = False
+    
+    
+    # kind: string, data: dict
+    def publish(self, kind, data):
+        with self.cond:
+            self.seq += 1
+            
+            event = dict(data)
+            event['seq'] = self.seq
+            event['type'] = kind
+            
+            self.events.append((self.seq, json.dumps(event)))
+            self.cond.notify_all()
+    
+    
+    # cursor: int, timeout: float -> (int, list of string, bool): new cursor, JSON encoded events, reset required
+    def read(self, cursor, timeout):
+        deadline = time.time() + timeout
+        
+        with self.cond:
+            while cursor == self.seq and not self.closed:
+                remaining = deadline - time.time()
+                
+                if remaining <= 0:
+                    break
+                
+                self.cond.wait(remaining)
+            
+            missed = self.seq - cursor
+            
+            if missed < 0 or missed > len(self.events):
+                return (self.seq, [ ], True)
+            
+            events = [ event for seq, event in itertools.islice(self.events, len(self.events) - missed, None) ]
+            
+            return (self.seq, events, False)
+    
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
 
-    # user: Person
-    def isAdmin(self, user):
-        return str(user.person) in self.admins
 
 
-    # user: Person
-    def findVote(self, user):
-        for vote in self.userVotes:
-            if vote.user == user:
-                return vote
-        
-        return None
+class ChatBacklog:
+    """
+    Bounded buffer of the recent lines forwarded to HSLive, read by the website to catch up after a reload or restart
+    
+    Capped by the number of lines and their encoded size, the oldest lines are dropped first.
+    Readers keep a cursor (the sequence number of the last line they have received) like the readers of the EventLog.
+    """
+    
+    # lines         deque of (int, string), sequence number and JSON encoded envelope
+    # seq           int, sequence number of the latest line
+    # size          int, encoded size of all lines (bytes, the JSON encoding is ASCII)
+    # maxLines      int
+    # maxBytes      int
+    # lock          Lock
+    
+    def __init__(self, maxLines, maxBytes):
+        self.lines = collections.deque()
+        self.seq = 0
+        self.size = 0
+        self.maxLines = maxLines
+        self.maxBytes = maxBytes
+        self.lock = Lock()
+    
+    
+    # envelope: dict (time, nick, post, ts)
+    def append(self, envelope):
+        with self.lock:
+            self.seq += 1
+            
+            line = dict(envelope)
+            line['seq'] = self.seq
+            line = json.dumps(line)
+            
+            self.lines.append((self.seq, line))
+            self.size += len(line)
+            
+            while len(self.lines) > self.maxLines or (self.size > self.maxBytes and len(self.lines) > 0):
+                self.size -= len(self.lines.popleft()[1])
+    
+    
+    # cursor: int (None: unknown to this backlog) -> (int, list of string, bool): new cursor, JSON encoded lines, lines missed by the reader were dropped
+    def read(self, cursor):
+        with self.lock:
+            first = self.seq - len(self.lines) + 1
+            
+            if cursor is None or cursor > self.seq or cursor < first - 1:
+                return (self.seq, [ line for seq, line in self.lines ], cursor is None or cursor < first - 1 or cursor > self.seq)
+            
+            return (self.seq, [ line for seq, line in itertools.islice(self.lines, cursor - first + 1, None) ], False)
 
 
-    # user: Person, option: int -> int ( >= 0: ACK, -1: No such option, <-1: -oldVote - 2)
-    def vote(self, user, option):
-        if len(self.options) <= option or self.options[option].deleted:
-            return -1
+
+class OptionIndex:
+    """
+    Index of the option texts of a poll, used to detect duplicate options
+    
+    Texts are normalized (case, whitespace, punctuation and emoji), an exact duplicate is found by a single dict lookup.
+    The optional fuzzy index maps the character trigrams of the normalized texts to the options containing them,
+    near-duplicates are ranked by the Jaccard similarity of the trigram sets of all options sharing a trigram.
+    """
+    
+    # texts         dict of string -> list of int, normalized text -> option ids (several if duplicates are allowed)
+    # grams         dict of string -> set of int, trigram -> option ids (None: fuzzy index disabled)
+    # optionGrams   dict of int -> frozenset of string, option id -> trigrams
+    
+    GRAM_SIZE = 3
+    
+    def __init__(self, fuzzy):
+        self.texts = { }
+        self.grams = { } if fuzzy else None
+        self.optionGrams = { }
+    
+    
+    def clear(self):
+        self.texts.clear()
+        self.optionGrams.clear()
         
-        oldVote = self.findVote(user)
+        if self.grams is not None:
+            self.grams.clear()
+    
+    
+    # text: string -> string
+    def normalize(self, text):
+        try:
+            # Slack sends emoji aliases (:smile:), other clients unicode emoji: both become their canonical name
+            text = lazyImport('emoji').demojize(emojize(text))
+        except AttributeError:
+            pass # no emoji support, aliases are still normalized by dropping the punctuation
         
-        if oldVote is not None:
-            return -oldVote.option - 2
+        text = unicodedata.normalize('NFKC', text).casefold()
         
-        self.options[option].votes += 1
-        self.userVotes.append(UserVote(user, option))
+        return ' '.join(''.join(c if c.isalnum() else ' ' for c in text).split())
+    
+    
+    # norm: string (normalized) -> frozenset of string
+    def trigrams(self, norm):
+        padded = ' ' + norm + ' '
         
-        return option
-
-
-    # user: Person -> int
-    def revoke(self, user):
-        oldVote = self.findVote(user)
+        return frozenset(padded[i:i + OptionIndex.GRAM_SIZE] for i in range(max(len(padded) - OptionIndex.GRAM_SIZE + 1, 1)))
+    
+    
+    # option: VotingOption
+    def add(self, option):
+        norm = self.normalize(option.text)
         
-        if oldVote is None:
-            return -1
+        if not norm:
+            return # nothing left to compare, e.g. an option consisting of punctuation only
         
-        self.options[oldVote.option].votes -= 1
-        self.userVotes[:] = [ vote for vote in self.userVotes if vote.user != user ]
+        self.texts.setdefault(norm, [ ]).append(option.id)
         
-        return oldVote.option
+        if self.grams is not None:
+            grams = self.trigrams(norm)
+            self.optionGrams[option.id] = grams
+            
+            for gram in grams:
+                self.grams.setdefault(gram, set()).add(option.id)
     
     
-    # option: str -> int
-    def addOption(self, option):
-        result = len(self.options)
-        newOption = VotingOption(result, option)
+    # option: VotingOption
+    def remove(self, option):
+        norm = self.normalize(option.text)
+        ids = self.texts.get(norm, [ ])
         
-        self.options.append(newOption)
+        if option.id in ids:
+            ids.remove(option.id)
+            
+            if len(ids) == 0:
+                del self.texts[norm]
         
-        return result
+        grams = self.optionGrams.pop(option.id, frozenset())
+        
+        for gram in grams:
+            ids = self.grams.get(gram)
+            
+            if ids is not None:
+                ids.discard(option.id)
+                
+                if len(ids) == 0:
+                    del self.grams[gram]
     
     
-    # option: int -> list of Person
-    def delOption(self, option):
-        if option >= len(self.options) or self.options[option].deleted:
-            return None
+    # text: string -> int (None: no duplicate)
+    def find(self, text):
+        ids = self.texts.get(self.normalize(text))
         
-        voteOpt = self.options[option]
-        result = [ ]
+        return ids[0] if ids else None
+    
+    
+    # text: string, threshold: float, limit: int -> list of int (most similar first)
+    def similar(self, text, threshold, limit):
+        if self.grams is None:
+            return [ ]
         
-        for vote in self.userVotes:
-            if option == vote.option:
-                result.append(vote.user)
-                voteOpt.votes -= 1
+        grams = self.trigrams(self.normalize(text))
+        shared = collections.Counter()
         
-        self.userVotes[:] = [ vote for vote in self.userVotes if vote.option != option ]
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
         
-        voteOpt.deleted = True
+        scores = [ ]
         
-        return result
+        for id, count in shared.items():
+            score = count / (len(grams) + len(self.optionGrams[id]) - count)
+            
+            if score >= threshold:
+                scores.append((score, id))
+        
+        scores.sort(key=lambda entry: (-entry[0], entry[1]))
+        
+        return [ id for score, id in scores[:limit] ]
+
+
+
+class TallyHistory:
+    """
+    Time series of the vote counts of a poll
     
+    Changes of the counts are accumulated and recorded as delta snapshot every INTERVAL seconds or MUTATIONS changes.
+    If more than SIZE snapshots have been recorded, the older half is downsampled by merging adjacent snapshots,
+    thus the resolution decreases with the age of the data while the memory stays bounded.
+    """
     
-    # admin: string
-    def addAdmin(self, admin):
-        if admin not in self.admins:
-            self.admins.append(admin)
+    # start         float, time of the base counts
+    # base          dict of int -> int, option id -> vote count at start
+    # snapshots     list of (float, dict of int -> int), time and changes of the counts since the previous snapshot
+    #               (only appended to, replaced when downsampled: views share it)
+    # pending       dict of int -> int, changes not recorded yet
+    # pendingTS     float, time of the first pending change (-1: none)
+    # lastTS        float, time of the last pending change
+    # mutations     integer, number of pending changes
+    
+    INTERVAL = 10
+    MUTATIONS = 50
+    SIZE = 1000
+    
+    def __init__(self, counts):
+        self.clear(counts)
+    
+    
+    # counts: dict of int -> int
+    def clear(self, counts):
+        self.start = time.time()
+        self.base = { id: count for id, count in counts.items() if count != 0 }
+        self.snapshots = [ ]
+        self.pending = { }
+        self.pendingTS = -1
+        self.lastTS = -1
+        self.mutations = 0
+    
+    
+    # changes: dict of int -> int
+    def record(self, changes):
+        now = time.time()
         
+        # the pending changes are recorded at the time of the last one, do not move them to a later change
+        if self.pendingTS >= 0 and now - self.pendingTS >= TallyHistory.INTERVAL:
+            self.flush()
         
-    # admin: string
-    def delAdmin(self, admin):
-        self.admins[:] = [ name for name in self.admins if name != admin ]
+        for id, change in changes.items():
+            self.pending[id] = self.pending.get(id, 0) + change
+        
+        if self.pendingTS < 0:
+            self.pendingTS = now
+        
+        self.lastTS = now
+        self.mutations += 1
+        
+        if self.mutations >= TallyHistory.MUTATIONS:
+            self.flush()
     
     
-    # -> ChanConfig
-    def exportConfig(self):
-        return ChanConfig(self.channel, self.admins, self.apiKey, self.options, self.userVotes, self.enabled)
+    def flush(self):
+        changes = { id: change for id, change in self.pending.items() if change != 0 }
+        
+        if len(changes) > 0:
+            self.snapshots.append((self.lastTS, changes))
+        
+        self.pending = { }
+        self.pendingTS = -1
+        self.mutations = 0
+        
+        if len(self.snapshots) > TallyHistory.SIZE:
+            self.downsample()
     
     
-    # log: Logger
-    def setupSlackStreaming(self, log):
-        if self.apiKey is None:
-            return # do not start logger
+    # merges pairs of adjacent snapshots of the older half
+    def downsample(self):
+        half = len(self.snapshots) // 2
+        merged = [ ]
+        
+        for index in range(0, half - 1, 2):
+            (_, first), (secondTS, second) = self.snapshots[index], self.snapshots[index + 1]
+            changes = dict(first)
             
-        if self.streamQueue is None:
-            self.streamQueue = Queue()
-            self.streamWorker = WebsiteForwardWorker(self.streamQueue, log, self.apiKey)
+            for id, change in second.items():
+                changes[id] = changes.get(id, 0) + change
             
-            self.streamWorker.daemon = True
-            self.streamWorker.start()
-        else:
-            log.warning("HSLive Slack Streaming for Channel " + str(self.channel) + " was already set up")
+            merged.append((secondTS, { id: change for id, change in changes.items() if change != 0 }))
+        
+        self.snapshots = merged + self.snapshots[half - half % 2:]
     
     
-    def stopSlackStreaming(self):
-        if not self.streamQueue is None:
-            self.streamQueue.put(None) # signals the worker to terminate
-            
-            self.streamQueue = None
-            self.streamWorker = None
+    # the recorded data as of now, to be read without the lock of the poll. only the pending changes are copied
+    # -> HistoryView
+    def view(self):
+        pending = [ (self.lastTS, dict(self.pending)) ] if self.pendingTS >= 0 else [ ]
+        
+        return HistoryView(self.start, self.base, self.snapshots, len(self.snapshots), pending)
+
+
+
+class HistoryView:
+    """
+    The data of a TallyHistory at one point in time, taken under the lock of the poll and read without it
+    """
     
+    # start         float, see TallyHistory
+    # base          dict of int -> int, see TallyHistory
+    # snapshots     list of (float, dict of int -> int), TallyHistory.snapshots, its first count entries belong to the view
+    # count         integer
+    # pending       list of (float, dict of int -> int), the pending changes as one more snapshot (empty: none)
     
-    # log: Logger, key: String
-    def changeStreamingAPIKey(self, log, key):
-        self.apiKey = key
-        
-        # change worker key
-        if self.streamWorker is not None:
-            if key is not None:
-                self.streamWorker.key = key
+    def __init__(self, start, base, snapshots, count, pending):
+        self.start = start
+        self.base = base
+        self.snapshots = snapshots
+        self.count = count
+        self.pending = pending
+    
+    
+    # begin: float, end: float -> (dict of int -> int, list of (float, dict of int -> int))
+    # the counts at begin and the changes recorded until end (pending changes included)
+    def series(self, begin, end):
+        counts = dict(self.base)
+        changes = [ ]
+        snapshots = self.snapshots[:self.count] + self.pending
+        
+        for ts, delta in snapshots:
+            if ts > end:
+                break
+            
+            if ts <= begin:
+                for id, change in delta.items():
+                    counts[id] = counts.get(id, 0) + change
             else:
-                self.stopSlackStreaming()
-        else:
-            if key is not None:
-                self.setupSlackStreaming(log)
+                changes.append((ts, { id: change for id, change in delta.items() if change != 0 }))
+        
+        return ({ id: count for id, count in counts.items() if count != 0 }, changes)
     
-    # msg: Message
-    def streamMsg(self, msg):
-        if self.apiKey is not None:
-            self.streamQueue.put(msg)
-        # else: discard silently
+    
+    # begin: float, end: float, points: int -> list of (float, dict of int -> int)
+    # the counts at evenly spaced times between begin and end
+    def sample(self, begin, end, points):
+        counts, changes = self.series(begin, end)
+        step = (end - begin) / max(points - 1, 1)
+        result = [ ]
+        index = 0
+        
+        for point in range(points):
+            ts = begin + point * step
+            
+            while index < len(changes) and changes[index][0] <= ts:
+                for id, change in changes[index][1].items():
+                    counts[id] = counts.get(id, 0) + change
+                
+                index += 1
+            
+            result.append((ts, dict(counts)))
+        
+        return result
 
 
 
-class Titlebot(BotPlugin):
+class Profiles:
     """
-    I help you to do open polls
+    Persistent map of rankings to their number of ballots, see Tally
     
-    Hint: The argument <channel> in commands is only rqequired if you send the command as query/direct message.
+    A change returns a new map sharing everything but the one shard holding the ranking, thus a published map is never
+    modified and a change copies about 1 / SHARDS of it.
     """
     
-    # chans         list of ChanInfo
-    # cbChan        list of ChanInfo
-    # polling       bool
+    # shards        tuple of dict of tuple of int -> int, by hash of the ranking
+    # size          integer, number of rankings
     
+    SHARDS = 64
     
-    def __init__(self, bot, name):
-        super().__init__(bot, name)
-        
-        self.chans = [ ]
-        self.cbChan = [ ]
-        
-        self.resetState()
+    def __init__(self, shards = None, size = 0):
+        self.shards = shards if shards is not None else tuple({ } for shard in range(Profiles.SHARDS))
+        self.size = size
     
     
-    def resetState(self):
-        for chan in self.chans:
-            self.tryDisableRoom(chan.channel)
+    # ranking: tuple of int, sign: int -> Profiles
+    def changed(self, ranking, sign):
+        index = hash(ranking) % Profiles.SHARDS
+        shard = dict(self.shards[index])
+        size = self.size - (ranking in shard)
+        count = shard.get(ranking, 0) + sign
+        
+        if count > 0:
+            shard[ranking] = count
+            size += 1
+        else:
+            shard.pop(ranking, None)
         
-        self.chans = [ ]
-        self.cbChan = [ ]
-        self.polling = False
+        return Profiles(self.shards[:index] + (shard, ) + self.shards[index + 1:], size)
     
     
-    # msg: Message, errStr: String
-    def badArgs(self, msg, errStr = ""):
+    # -> iterator of (tuple of int, int)
+    def items(self):
+        return itertools.chain.from_iterable(shard.items() for shard in self.shards)
+    
+    
+    # -> iterator of int
+    def values(self):
+        return itertools.chain.from_iterable(shard.values() for shard in self.shards)
+    
+    
+    def __len__(self):
+        return self.size
+
+
+
+class Tally:
+    """
+    Ballot counting of a poll by voting mode, updated incrementally with every ballot cast or revoked
+    
+    single: one option per ballot. approval: a ballot approves any number of options, each approval counts.
+    ranked: a ballot lists options in order of preference, instant-runoff decides. The vote counts of the options hold
+    the first preferences, identical rankings are counted as one profile, thus the runoff works on the distinct rankings
+    instead of every single ballot.
+    
+    Not thread-safe, guarded by the lock of the poll.
+    """
+    
+    # mode          string, one of MODES
+    # profiles      Profiles, ballots per ranking (ranked mode only, replaced on change, shared with the published snapshots)
+    
+    MODES = ('single', 'approval', 'ranked')
+    UNITS = { 'single': 'votes', 'approval': 'approvals', 'ranked': 'first choices' }
+    
+    def __init__(self, mode):
+        self.mode = mode
+        self.profiles = Profiles()
+    
+    
+    def clear(self):
+        self.profiles = Profiles()
+    
+    
+    # ballot: tuple of int -> tuple of int, the options whose vote count includes the ballot
+    def counted(self, ballot):
+        return ballot if self.mode == 'approval' else ballot[:1]
+    
+    
+    # ballot: tuple of int, sign: int (1: cast, -1: revoked)
+    def add(self, ballot, sign):
+        if self.mode != 'ranked':
+            return
+        
+        self.profiles = self.profiles.changed(ballot, sign)
+    
+    
+    # ballot: tuple of int -> string
+    def describe(self, ballot):
+        if len(ballot) == 1:
+            return "option " + str(ballot[0] + 1)
+        
+        return "options " + (" > " if self.mode == 'ranked' else ", ").join(str(option + 1) for option in ballot)
+    
+    
+    # instant-runoff on the ranking profiles: the option with the fewest votes is eliminated and its ballots are transferred
+    # to their next continuing preference, until an option holds the majority of the ballots not exhausted
+    # ties are eliminated by the fewest first preferences, then the higher (later added) id
+    # each profile only moves forward along its ranking and the eliminations are taken from a heap,
+    # thus a runoff costs O((distinct rankings * their length + options) * log(options))
+    # profiles: Profiles (or dict of tuple of int -> int), candidates: iterable of int ->
+    #     (list of (int, int), int, int), (option, votes) by placement (votes: final or at elimination), rounds, exhausted ballots
+    @staticmethod
+    def runoff(profiles, candidates):
+        remaining = set(candidates)
+        rankings = [ ]
+        positions = [ ]
+        weights = [ ]
+        piles = collections.defaultdict(list)
+        counts = collections.Counter()
+        active = 0
+        
+        for ranking, weight in profiles.items():
+            ranking = [ option for option in ranking if option in remaining ]
+            
+            if len(ranking) == 0:
+                continue
+            
+            piles[ranking[0]].append(len(rankings))
+            counts[ranking[0]] += weight
+            active += weight
+            rankings.append(ranking)
+            positions.append(0)
+            weights.append(weight)
+        
+        first = { option: counts[option] for option in remaining }
+        heap = [ (counts[option], first[option], -option) for option in remaining ]
+        heapq.heapify(heap)
+        leader = max(counts.values(), default=0)
+        eliminated = [ ]
+        total = active
+        
+        while len(remaining) > 1 and leader * 2 <= active:
+            votes, firstVotes, key = heapq.heappop(heap)
+            option = -key
+            
+            if option not in remaining or votes != counts[option]:
+                continue # outdated entry
+            
+            remaining.discard(option)
+            eliminated.append((option, votes))
+            
+            for index in piles.pop(option, [ ]):
+                ranking = rankings[index]
+                position = positions[index] + 1
+                
+                while position < len(ranking) and ranking[position] not in remaining:
+                    position += 1
+                
+                positions[index] = position
+                
+                if position < len(ranking):
+                    successor = ranking[position]
+                    piles[successor].append(index)
+                    counts[successor] += weights[index]
+                    leader = max(leader, counts[successor])
+                    heapq.heappush(heap, (counts[successor], first[successor], -successor))
+                else:
+                    active -= weights[index]
+        
+        finalists = sorted(remaining, key=lambda option: (-counts[option], -first[option], option))
+        placements = [ (option, counts[option]) for option in finalists ] + eliminated[::-1]
+        rounds = 1 + len([ votes for option, votes in eliminated if votes > 0 ]) # options without votes go at once
+        
+        return ([ (option, votes) for option, votes in placements if votes > 0 ], rounds, total - active)
+
+
+
+class PollSnapshot:
+    """
+    Immutable state of a poll at one version of its channel, the read paths (listings, webhooks, exports, persistence) work off it
+    
+    Published by Poll.publish() under the channel lock after every change of the poll, readers just take the current one. Taking
+    it copies the references to the options, nothing else: options are replaced on change instead of modified (see
+    Poll.changeOption), the vote ledger is only appended to (the snapshot keeps its length) and the ranked profiles are
+    persistent. The lookup by id and the results are built by the readers on first use.
+    """
+    
+    # name          string
+    # version       integer, ChanInfo.version when the snapshot was taken
+    # revision      integer, Poll.revision when the snapshot was taken
+    # enabled       boolean
+    # countdownTS   float
+    # nextId        integer
+    # mode          string, Tally.MODES
+    # options       tuple of VotingOption (never modified), ordered by id, tombstones included
+    # lookup        dict of int -> VotingOption, see byId (None: not built yet)
+    # voters        integer
+    # ledger        list of UserVote, Poll.userVotes when the snapshot was taken, its first voters entries are the votes
+    # profiles      Profiles, Tally.profiles when the snapshot was taken (None: not ranked)
+    # placements    tuple of VotingOption, see results (None: not computed yet)
+    # rounds        integer, runoff rounds (ranked mode, 1 otherwise)
+    # exhausted     integer, ballots without continuing preference in the final round (ranked mode)
+    
+    def __init__(self, name, version, revision, enabled, countdownTS, nextId, mode, options, ledger, voters, profiles):
+        self.name = name
+        self.version = version
+        self.revision = revision
+        self.enabled = enabled
+        self.countdownTS = countdownTS
+        self.nextId = nextId
+        self.mode = mode
+        self.options = options
+        self.lookup = None
+        self.voters = voters
+        self.ledger = ledger
+        self.profiles = profiles
+        self.placements = None
+        self.rounds = 1
+        self.exhausted = 0
+    
+    
+    # the options with votes by placement, copies holding the votes of their placement (ranked: final round or elimination)
+    # computed on first use, concurrent readers might compute it twice which is harmless
+    # -> tuple of VotingOption
+    @property
+    def results(self):
+        if self.placements is not None:
+            return self.placements
+        
+        if self.mode != 'ranked':
+            # sort is stable: options with the same votes stay ordered by id
+            placements = tuple(sorted((option for option in self.options if not option.deleted and option.votes > 0), key=lambda option: option.votes, reverse=True))
+        else:
+            tallied, self.rounds, self.exhausted = Tally.runoff(self.profiles, [ option.id for option in self.live() ])
+            placements = [ ]
+            
+            for id, votes in tallied:
+                option = copy.copy(self.byId[id])
+                option.votes = votes
+                placements.append(option)
+            
+            placements = tuple(placements)
+        
+        self.placements = placements
+        
+        return placements
+    
+    
+    # built on first use, concurrent readers might build it twice which is harmless
+    # -> dict of int -> VotingOption
+    @property
+    def byId(self):
+        if self.lookup is None:
+            self.lookup = { option.id: option for option in self.options }
+        
+        return self.lookup
+    
+    
+    # -> list of UserVote
+    @property
+    def votes(self):
+        return self.ledger[:self.voters]
+    
+    
+    # -> list of VotingOption
+    def live(self):
+        return [ option for option in self.options if not option.deleted ]
+    
+    
+    # top: int -> tuple of int
+    def ranking(self, top):
+        return tuple(option.id for option in self.results[:top])
+    
+    
+    # id: int -> str (None: compacted)
+    def optionText(self, id):
+        option = self.byId.get(id)
+        
+        return option.text if option is not None else None
+    
+    
+    # -> list of dict
+    def exportOptions(self):
+        return [ { 'id': option.id + 1, 'text': option.text, 'votes': option.votes } for option in self.live() ]
+    
+    
+    # -> dict
+    def exportResults(self):
+        results = [ { 'place': index + 1, 'id': option.id + 1, 'text': option.text, 'votes': option.votes } for index, option in enumerate(self.results) ]
+        
+        result = { 'poll': self.name, 'mode': self.mode, 'enabled': self.enabled, 'countdown': self.countdownTS if self.countdownTS >= 0 else None, 'results': results }
+        
+        if self.mode == 'ranked':
+            result['rounds'] = self.rounds
+            result['exhausted'] = self.exhausted
+        
+        return result
+    
+    
+    # -> dict
+    def exportCounts(self):
+        return { 'poll': self.name, 'voters': self.voters, 'votes': { str(option.id + 1): option.votes for option in self.live() } }
+
+
+
+class Poll:
+    # chan          ChanInfo
+    # name          string
+    # options       list of VotingOption, ordered by id. Deleted options are kept as tombstones until they are compacted
+    # slots         dict of int -> int, option id -> index in options. Option ids are public (id + 1) and never reused
+    # nextId        integer, id of the next option added
+    # userVotes     list of UserVote, only appended to, replaced when votes are removed (published snapshots share it)
+    # ballots       dict of int -> UserVote, the votes by Identities id of the voter
+    # enabled       boolean
+    # countdownTS   float
+    # countdownVal  integer
+    # digestLast    tuple of int
+    # index         OptionIndex of the options not deleted
+    # history       TallyHistory
+    # tally         Tally, the voting mode and its incremental counts
+    # revision      integer, incremented on every change of the options, votes or state
+    # published     PollSnapshot of the current state, replaced after every change
+    # archived      ArchiveEntry of the current options and votes (None: not archived since their last change)
+    # lock          RLock of the channel
+
+    def __init__(self, chan, name):
+        self.chan = chan
+        self.name = name
+        self.lock = chan.lock
+        
+        self.options = [ ]
+        self.slots = { }
+        self.nextId = 0
+        self.userVotes = [ ]
+        self.ballots = { }
+        self.index = OptionIndex(chan.similarity > 0)
+        self.history = TallyHistory({ })
+        self.tally = Tally('single')
+        self.revision = 0
+        self.archived = None
+        
+        self.enabled = False
+        self.digestLast = ()
+        self.countdownTS = -1
+        self.countdownVal = -1
+        
+        self.publish()
+
+
+    def reset(self):
+        with self.lock:
+            self.options = [ ]
+            self.slots = { }
+            self.nextId = 0
+            self.userVotes = [ ]
+            self.ballots = { }
+            self.index.clear()
+            self.history.clear({ })
+            self.tally.clear()
+            
+            self.enabled = False
+            self.digestLast = ()
+            
+            self.touch('reset', { })
+            
+            self.resetCountdown()
+
+
+    def resetCountdown(self):
+        with self.lock:
+            self.countdownTS = -1
+            self.countdownVal = -1;
+            
+            self.touch('countdown', { 'end': None })
+    
+    
+    # marks a change of the poll state and publishes it to the event log of the channel
+    # kind: string, data: dict
+    def touch(self, kind, data):
+        event = dict(data)
+        event['poll'] = self.name
+        
+        # enabling and the countdown leave the options and votes, thus an archive of them, as they are
+        if kind not in ('enabled', 'countdown'):
+            self.archived = None
+        
+        # in place before the event: readers notified of the change find it published, with the version the event gives the channel
+        self.publish(self.chan.version + 1)
+        self.chan.touch(kind, event)
+    
+    
+    # replaces the published snapshot with the current state, called under the lock after every change
+    # version: int, ChanInfo.version of the state (None: the current one)
+    def publish(self, version = None):
+        self.revision += 1
+        self.published = PollSnapshot(self.name, version if version is not None else self.chan.version, self.revision, self.enabled, self.countdownTS, self.nextId, self.tally.mode, tuple(self.options), self.userVotes, len(self.userVotes), self.tally.profiles if self.tally.mode == 'ranked' else None)
+    
+    
+    # the published state of the poll, readers never lock
+    # -> PollSnapshot
+    def snapshot(self):
+        return self.published
+    
+    
+    # published options are never modified, a change applies to a copy which replaces the option
+    # id: int -> VotingOption, the copy to modify
+    def changeOption(self, id):
+        slot = self.slots[id]
+        option = copy.copy(self.options[slot])
+        self.options[slot] = option
+        
+        return option
+    
+    
+    # enabled: bool
+    def setEnabled(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            
+            self.touch('enabled', { 'enabled': enabled })
+    
+    
+    # the mode can only be changed while there are no votes
+    # mode: string (Tally.MODES) -> bool
+    def setMode(self, mode):
+        with self.lock:
+            if len(self.userVotes) > 0:
+                return False
+            
+            self.tally = Tally(mode)
+            
+            self.touch('mode', { 'mode': mode })
+            
+            return True
+
+
+    # id: int -> VotingOption (None: no such option or compacted)
+    def findOption(self, id):
+        slot = self.slots.get(id)
+        
+        return self.options[slot] if slot is not None else None
+    
+    
+    # user: Person -> UserVote (None: has not voted)
+    def findVote(self, user):
+        return self.ballots.get(self.chan.identities.intern(user))
+    
+    
+    # adds a vote restored from the storage, the options deleted or compacted in between are dropped from its ballot
+    # not published per vote, see restartHistory
+    # user: Person, ballot: tuple of int -> bool (False: none of its options is left)
+    def restoreVote(self, user, ballot):
+        with self.lock:
+            ballot = tuple(option for option in ballot if self.findOption(option) is not None and not self.findOption(option).deleted)
+            
+            if len(ballot) == 0:
+                return False
+            
+            uid = self.chan.identities.intern(user)
+            vote = UserVote(user, uid, self.chan.identities.name(uid), ballot)
+            
+            # not recorded in the history, it is restarted with the restored counts
+            for option in self.tally.counted(ballot):
+                self.changeOption(option).votes += 1
+            
+            self.tally.add(ballot, 1)
+            self.userVotes.append(vote)
+            self.ballots[uid] = vote
+            
+            return True
+    
+    
+    # adds (sign 1) or removes (sign -1) a ballot to the vote counts, the tally and the history
+    # vote: UserVote, sign: int -> dict of str -> int, the new vote counts of the changed options by public id
+    def count(self, vote, sign):
+        counted = self.tally.counted(vote.ballot)
+        
+        for option in counted:
+            self.changeOption(option).votes += sign
+        
+        self.tally.add(vote.ballot, sign)
+        self.history.record({ option: sign for option in counted })
+        
+        return { str(option + 1): self.findOption(option).votes for option in counted }
+
+
+    # user: Person, option: int -> (bool, UserVote), see cast
+    def vote(self, user, option):
+        return self.cast(user, (option, ))
+    
+    
+    # user: Person, ballot: tuple of int, distinct options (approval: approved, ranked: by preference, single: one) ->
+    #     (bool, UserVote), (True, the new vote): accepted, (False, the existing vote): already voted, (False, None): no such option
+    def cast(self, user, ballot):
+        with self.lock:
+            for option in ballot:
+                voteOpt = self.findOption(option)
+                
+                if voteOpt is None or voteOpt.deleted:
+                    return (False, None)
+            
+            uid = self.chan.identities.intern(user)
+            oldVote = self.ballots.get(uid)
+            
+            if oldVote is not None:
+                return (False, oldVote)
+            
+            vote = UserVote(user, uid, self.chan.identities.name(uid), ballot)
+            
+            counts = self.count(vote, 1)
+            self.userVotes.append(vote)
+            self.ballots[uid] = vote
+            
+            event = { 'option': vote.option + 1, 'votes': self.findOption(vote.option).votes }
+            
+            if len(ballot) > 1:
+                event['ballot'] = [ option + 1 for option in ballot ]
+                event['counts'] = counts
+            
+            self.touch('vote', event)
+            
+            return (True, vote)
+
+
+    # user: Person -> UserVote, the revoked vote (None: no vote)
+    def revoke(self, user):
+        with self.lock:
+            oldVote = self.findVote(user)
+            
+            if oldVote is None:
+                return None
+            
+            counts = self.count(oldVote, -1)
+            del self.ballots[oldVote.uid]
+            self.userVotes = [ vote for vote in self.userVotes if vote is not oldVote ]
+            
+            event = { 'option': oldVote.option + 1, 'votes': self.findOption(oldVote.option).votes }
+            
+            if len(oldVote.ballot) > 1:
+                event['ballot'] = [ option + 1 for option in oldVote.ballot ]
+                event['counts'] = counts
+            
+            self.touch('revoke', event)
+            
+            return oldVote
+    
+    
+    # option: str -> int
+    def addOption(self, option):
+        with self.lock:
+            newOption = self.insertOption(option)
+            
+            self.touch('option', { 'option': newOption.id + 1, 'text': option })
+            
+            return newOption.id
+    
+    
+    # adds the options as one change with a single event
+    # texts: list of str, rejectDuplicates: bool -> (list of VotingOption, list of (str, VotingOption))
+    def addOptions(self, texts, rejectDuplicates):
+        with self.lock:
+            added = [ ]
+            rejected = [ ]
+            
+            for text in texts:
+                duplicate = self.findDuplicate(text) if rejectDuplicates else None
+                
+                if duplicate is not None:
+                    rejected.append((text, duplicate))
+                else:
+                    added.append(self.insertOption(text))
+            
+            if len(added) > 0:
+                self.touch('options', { 'options': [ { 'option': option.id + 1, 'text': option.text } for option in added ] })
+            
+            return (added, rejected)
+    
+    
+    # not published, see addOption and addOptions
+    # text: str -> VotingOption
+    def insertOption(self, text):
+        option = VotingOption(self.nextId, text)
+        
+        self.nextId += 1
+        self.slots[option.id] = len(self.options)
+        self.options.append(option)
+        self.index.add(option)
+        
+        return option
+    
+    
+    # deletes the options as one change with a single event, ballots holding them lose them in one pass over the votes,
+    # a ballot left without options is revoked
+    # options: list of int -> (dict of int -> list of Person, list of UserVote)
+    # the deleted options with the voters whose ballot held nothing else (by the last of its options in the list), and the
+    # ballots that were shortened
+    def delOptions(self, options):
+        with self.lock:
+            order = { }
+            
+            for option in options:
+                voteOpt = self.findOption(option)
+                
+                if voteOpt is not None and not voteOpt.deleted and option not in order:
+                    order[option] = len(order)
+            
+            if len(order) == 0:
+                return ({ }, [ ])
+            
+            result = { option: [ ] for option in order }
+            shortened = [ ]
+            changes = { }
+            ledger = [ ]
+            
+            for vote in self.userVotes:
+                removed = [ option for option in vote.ballot if option in order ]
+                
+                if len(removed) == 0:
+                    ledger.append(vote)
+                    continue
+                
+                for counted in self.tally.counted(vote.ballot):
+                    changes[counted] = changes.get(counted, 0) - 1
+                
+                self.tally.add(vote.ballot, -1)
+                ballot = tuple(other for other in vote.ballot if other not in order)
+                
+                if len(ballot) == 0:
+                    result[max(removed, key=order.get)].append(vote.user)
+                    del self.ballots[vote.uid]
+                    continue
+                
+                vote = UserVote(vote.user, vote.uid, vote.name, ballot)
+                
+                for counted in self.tally.counted(ballot):
+                    changes[counted] = changes.get(counted, 0) + 1
+                
+                self.tally.add(ballot, 1)
+                shortened.append(vote)
+                self.ballots[vote.uid] = vote
+                ledger.append(vote)
+            
+            self.userVotes = ledger
+            
+            for counted, change in changes.items():
+                self.changeOption(counted).votes += change
+            
+            now = time.time()
+            
+            for option in order:
+                voteOpt = self.changeOption(option)
+                voteOpt.deleted = True
+                voteOpt.deletedTS = now
+                self.index.remove(voteOpt)
+            
+            changes = { counted: change for counted, change in changes.items() if change != 0 }
+            
+            if len(changes) > 0:
+                self.history.record(changes)
+            
+            self.touch('delete', { 'options': [ option + 1 for option in order ] })
+            
+            return (result, shortened)
+    
+    
+    # drops the tombstones of options deleted before the given time, their ids stay reserved
+    # before: float -> list of int (ids of the dropped options)
+    def compact(self, before):
+        with self.lock:
+            purged = [ option.id for option in self.options if option.deleted and option.deletedTS <= before ]
+            
+            if len(purged) > 0:
+                # replaced, not modified in place: readers iterate the options without locking
+                self.options = [ option for option in self.options if not option.deleted or option.deletedTS > before ]
+                self.slots = { option.id: slot for slot, option in enumerate(self.options) }
+                self.publish()
+            
+            return purged
+    
+    
+    # options: list of VotingOption (ordered by id, copied), nextId: int
+    def setOptions(self, options, nextId):
+        with self.lock:
+            # e.g. the options of a published snapshot (see exportConfig)
+            options = [ copy.copy(option) for option in options ]
+            
+            for option in options:
+                # options persisted by older releases lack the deletion time, their retention starts now
+                if getattr(option, 'deletedTS', -1) < 0:
+                    option.deletedTS = time.time() if option.deleted else -1
+                
+                # recounted by restoreVote
+                option.votes = 0
+            
+            self.tally.clear()
+            self.options = options
+            self.slots = { option.id: slot for slot, option in enumerate(options) }
+            self.nextId = max([ nextId ] + [ option.id + 1 for option in options ])
+            
+            self.reindex()
+            self.publish()
+    
+    
+    # starts the history with the current counts and publishes them, e.g. after restoring the options and votes
+    def restartHistory(self):
+        with self.lock:
+            self.history.clear({ option.id: option.votes for option in self.options })
+            
+            self.publish()
+    
+    
+    # -> HistoryView
+    def historyView(self):
+        with self.lock:
+            return self.history.view()
+    
+    
+    # the series is computed without holding the lock
+    # begin: float, end: float -> dict
+    def exportHistory(self, begin, end):
+        with self.lock:
+            view = self.history.view()
+            snapshot = self.snapshot()
+        
+        return self.renderHistory(view, snapshot, begin, end)
+    
+    
+    # view: HistoryView, snapshot: PollSnapshot (the option texts), begin: float, end: float -> dict
+    def renderHistory(self, view, snapshot, begin, end):
+        counts, changes = view.series(begin, end)
+        
+        return {
+            'poll': self.name,
+            'from': begin,
+            'to': end,
+            'options': { str(option.id + 1): option.text for option in snapshot.options },
+            'start': { str(id + 1): count for id, count in counts.items() },
+            'changes': [ { 'time': ts, 'votes': { str(id + 1): change for id, change in delta.items() } } for ts, delta in changes ],
+        }
+    
+    
+    # reason: string -> dict (None: nothing to archive)
+    def exportArchive(self, reason):
+        with self.lock:
+            snapshot = self.snapshot()
+            now = time.time()
+            view = self.history.view()
+        
+        if len(snapshot.options) == 0:
+            return None
+        
+        return {
+            'channel': str(self.chan.channel),
+            'poll': self.name,
+            'reason': reason,
+            'finished': now,
+            'options': [ { 'id': option.id + 1, 'text': option.text, 'votes': option.votes, 'deleted': option.deleted, 'deletedTS': option.deletedTS if option.deleted else None } for option in snapshot.options ],
+            'mode': snapshot.mode,
+            'votes': [ { 'user': vote.name, 'option': vote.option + 1, 'ballot': [ option + 1 for option in vote.ballot ] } for vote in snapshot.votes ],
+            'results': [ { 'place': place, 'id': option.id + 1, 'votes': option.votes } for place, option in enumerate(snapshot.results, 1) ],
+            'history': self.renderHistory(view, snapshot, view.start, now),
+        }
+    
+    
+    # rebuilds the option index, e.g. after restoring the options
+    def reindex(self):
+        with self.lock:
+            self.index = OptionIndex(self.chan.similarity > 0)
+            
+            for option in self.options:
+                if not option.deleted:
+                    self.index.add(option)
+    
+    
+    # text: string -> VotingOption (None: no duplicate)
+    def findDuplicate(self, text):
+        with self.lock:
+            id = self.index.find(text)
+            
+            return self.findOption(id) if id is not None else None
+    
+    
+    # text: string, threshold: float, limit: int -> list of VotingOption
+    def findSimilar(self, text, threshold, limit):
+        with self.lock:
+            return [ self.findOption(id) for id in self.index.similar(text, threshold, limit) ]
+    
+    
+    # rows are generated from the snapshot while the export is rendered
+    # kind: string -> Export
+    def export(self, kind):
+        snapshot = self.snapshot()
+        
+        if kind == 'options':
+            rows = ( (option.id + 1, option.text, option.votes) for option in snapshot.live() )
+        elif kind == 'results':
+            rows = ( (place, option.id + 1, option.text, option.votes) for place, option in enumerate(snapshot.results, 1) )
+        else:
+            # one row per option of a ballot, rank is its position (approval: all approved options)
+            rows = ( (vote.name, option + 1, snapshot.optionText(option), rank) for vote in snapshot.votes for rank, option in enumerate(vote.ballot, 1) )
+        
+        return Export(str(self.chan.channel).lstrip('#') + '-' + self.name, kind, rows)
+    
+    
+    # -> list of str (empty if consistent)
+    def verify(self):
+        with self.lock:
+            problems = [ ]
+            counts = collections.Counter()
+            voters = set()
+            
+            profiles = collections.Counter()
+            
+            for vote in self.userVotes:
+                for id in vote.ballot:
+                    option = self.findOption(id)
+                    
+                    if option is None or option.deleted:
+                        problems.append("vote of " + vote.name + " for missing option " + str(id))
+                
+                if len(set(vote.ballot)) != len(vote.ballot) or vote.option != vote.ballot[0]:
+                    problems.append("ballot of " + vote.name + " is malformed")
+                
+                if self.tally.mode == 'single' and len(vote.ballot) != 1:
+                    problems.append("ballot of " + vote.name + " holds several options in single mode")
+                
+                counts.update(self.tally.counted(vote.ballot))
+                profiles[vote.ballot] += 1
+                
+                if vote.uid in voters:
+                    problems.append("multiple votes of " + vote.name)
+                voters.add(vote.uid)
+                
+                if self.ballots.get(vote.uid) is not vote:
+                    problems.append("vote of " + vote.name + " is missing in the ballots")
+            
+            if len(self.ballots) != len(self.userVotes):
+                problems.append("ballots hold " + str(len(self.ballots)) + " votes, ledger has " + str(len(self.userVotes)))
+            
+            for option in self.options:
+                if option.votes != counts[option.id]:
+                    problems.append("option " + str(option.id) + " counts " + str(option.votes) + " votes, ledger has " + str(counts[option.id]))
+            
+            if self.tally.mode == 'ranked' and dict(self.tally.profiles.items()) != profiles:
+                problems.append("tally holds " + str(sum(self.tally.profiles.values())) + " ranked ballots in " + str(len(self.tally.profiles)) + " rankings, ledger has " + str(len(self.userVotes)) + " in " + str(len(profiles)))
+            
+            for slot, option in enumerate(self.options):
+                if self.slots.get(option.id) != slot or option.id >= self.nextId:
+                    problems.append("option " + str(option.id) + " is not found at slot " + str(slot))
+            
+            if len(self.slots) != len(self.options):
+                problems.append("slots refer to " + str(len(self.slots)) + " options, there are " + str(len(self.options)))
+            
+            for ids in self.index.texts.values():
+                for id in ids:
+                    if self.findOption(id) is None or self.findOption(id).deleted:
+                        problems.append("duplicate index refers to missing option " + str(id))
+            
+            return problems
+    
+    
+    # -> PollConfig
+    def exportConfig(self):
+        snapshot = self.snapshot()
+        
+        return PollConfig(self.chan.channel, self.name, list(snapshot.options), snapshot.votes, snapshot.enabled, snapshot.countdownTS, snapshot.nextId, snapshot.mode)
+
+
+
+class ChanInfo:
+    # channel       Room
+    # identities    Identities of the bot
+    # admins        list of string
+    # adminIds      set of int, Identities ids of admins (replaced on change)
+    # apiKey        string
+    # polls         dict of string -> Poll
+    # defaultPoll   string, name of the poll addressed by commands without --poll
+    # duplicates    boolean, reject options duplicating the normalized text of an existing option
+    # similarity    float, minimum similarity of existing options suggested as near-duplicates (0: disabled)
+    # quickVotes    boolean, plain channel messages like "+3" (or "3" while voting is enabled) vote in the default poll
+    # floodUser     integer, commands per minute per user (-1: plugin default FLOOD_USER, 0: unlimited)
+    # floodChannel  integer, commands per second in the channel (-1: plugin default FLOOD_CHANNEL, 0: unlimited)
+    # quickAcks     list of (Poll, string, int, (bool, UserVote)), quick votes not yet confirmed (poll, user, option number, result of Poll.vote, None: voting disabled)
+    # digestInterval integer (seconds, -1: disabled)
+    # digestTop     integer
+    # digestTS      float
+    # streamQueue   Queue
+    # streamWorker  WebsiteForwardWorker
+    # backlog       ChatBacklog of the lines forwarded to HSLive
+    # lock          RLock, serializes all state changes of this channel and its polls
+    # epoch         string, distinguishes the versions of different ChanInfo instances of a channel
+    # version       integer, incremented on every state change
+    # events        EventLog
+    # changes       collections.Counter, state changes by kind since the start (metrics)
+    # archive       list of ArchiveEntry, index of the archived polls (replaced on change, never modified in place)
+
+    EVENT_LOG_SIZE = 1000
+    BACKLOG_LINES = 500
+    BACKLOG_BYTES = 256 * 1024
+    DEFAULT_POLL = 'main'
+
+    def __init__(self, chan, adminList, key, identities):
+        self.lock = RLock()
+        self.epoch = '{:x}'.format(int(time.time() * 1000))
+        self.version = 0
+        self.events = EventLog(ChanInfo.EVENT_LOG_SIZE)
+        self.changes = collections.Counter()
+        
+        self.channel = chan
+        self.identities = identities
+        self.admins = adminList
+        self.adminIds = { identities.internName(admin) for admin in adminList }
+        self.apiKey = key
+        
+        self.duplicates = True
+        self.similarity = 0
+        self.quickVotes = False
+        self.quickAcks = [ ]
+        self.floodUser = -1
+        self.floodChannel = -1
+        
+        self.polls = { ChanInfo.DEFAULT_POLL: Poll(self, ChanInfo.DEFAULT_POLL) }
+        self.defaultPoll = ChanInfo.DEFAULT_POLL
+        
+        self.streamQueue = None
+        self.streamWorker = None
+        self.backlog = ChatBacklog(ChanInfo.BACKLOG_LINES, ChanInfo.BACKLOG_BYTES)
+        
+        self.digestInterval = -1
+        self.digestTop = 5
+        self.digestTS = -1
+        
+        self.archive = [ ]
+    
+    
+    # marks a change of the channel state and publishes it to the event log
+    # kind: string, data: dict
+    def touch(self, kind, data):
+        self.version += 1
+        self.changes[kind] += 1
+        self.events.publish(kind, data)
+
+
+    # user: Person
+    def isAdmin(self, user):
+        return self.identities.intern(user) in self.adminIds
+    
+    
+    # name: string (None: default poll) -> Poll
+    def findPoll(self, name):
+        if name is None:
+            name = self.defaultPoll
+        
+        return self.polls.get(name, None)
+    
+    
+    # name: string -> Poll (None: already exists)
+    def addPoll(self, name):
+        with self.lock:
+            if name in self.polls:
+                return None
+            
+            poll = Poll(self, name)
+            self.polls[name] = poll
+            
+            self.touch('poll', { 'poll': name, 'exists': True })
+            
+            return poll
+    
+    
+    # name: string -> Poll (None: no such poll or default poll)
+    def delPoll(self, name):
+        with self.lock:
+            if name not in self.polls or name == self.defaultPoll:
+                return None
+            
+            poll = self.polls.pop(name)
+            
+            self.touch('poll', { 'poll': name, 'exists': False })
+            
+            return poll
+    
+    
+    # name: string -> bool
+    def setDefaultPoll(self, name):
+        with self.lock:
+            if name not in self.polls:
+                return False
+            
+            self.defaultPoll = name
+            
+            self.touch('poll', { 'poll': name, 'exists': True, 'default': True })
+            
+            return True
+    
+    
+    # duplicates: bool, similarity: float
+    def setDuplicateCheck(self, duplicates, similarity):
+        with self.lock:
+            fuzzy = self.similarity > 0
+            
+            self.duplicates = duplicates
+            self.similarity = similarity
+            
+            if fuzzy != (similarity > 0):
+                for poll in self.polls.values():
+                    poll.reindex()
+    
+    
+    # -> list of str (empty if consistent)
+    def verify(self):
+        with self.lock:
+            return [ "poll " + name + ": " + problem for name, poll in self.polls.items() for problem in poll.verify() ]
+    
+    
+    # admin: string
+    def addAdmin(self, admin):
+        with self.lock:
+            if admin not in self.admins:
+                self.admins.append(admin)
+                self.adminIds = self.adminIds | { self.identities.internName(admin) }
+        
+        
+    # admin: string
+    def delAdmin(self, admin):
+        with self.lock:
+            self.admins[:] = [ name for name in self.admins if name != admin ]
+            self.adminIds = self.adminIds - { self.identities.internName(admin) }
+    
+    
+    # -> ChanConfig
+    def exportConfig(self):
+        with self.lock:
+            return ChanConfig(self.channel, self.admins, self.apiKey, self.digestInterval, self.digestTop, [ poll.exportConfig() for poll in self.polls.values() ], self.defaultPoll, self.duplicates, self.similarity, self.quickVotes, self.floodUser, self.floodChannel)
+    
+    
+    # log: Logger, target: (string, float) URL and request timeout
+    def setupSlackStreaming(self, log, target):
+        if self.apiKey is None:
+            return # do not start logger
+            
+        if self.streamQueue is None:
+            self.streamQueue = Queue()
+            self.streamWorker = WebsiteForwardWorker(self.streamQueue, log, self.apiKey, target, self.backlog)
+            
+            self.streamWorker.daemon = True
+            self.streamWorker.start()
+        else:
+            log.warning("HSLive Slack Streaming for Channel " + str(self.channel) + " was already set up")
+    
+    
+    def stopSlackStreaming(self):
+        if not self.streamQueue is None:
+            self.streamQueue.put(None) # signals the worker to terminate
+            
+            self.streamQueue = None
+            self.streamWorker = None
+    
+    
+    # log: Logger, key: String, target: (string, float) URL and request timeout
+    def changeStreamingAPIKey(self, log, key, target):
+        with self.lock:
+            self.apiKey = key
+            
+            # change worker key
+            if self.streamWorker is not None:
+                if key is not None:
+                    self.streamWorker.key = key
+                else:
+                    self.stopSlackStreaming()
+            else:
+                if key is not None:
+                    self.setupSlackStreaming(log, target)
+    
+    # msg: Message
+    def streamMsg(self, msg):
+        queue = self.streamQueue
+        
+        if queue is not None:
+            queue.put(msg)
+        # else: discard silently
+
+
+
+class StoreMetrics:
+    """
+    Write counters of a storage, exported by the metrics webhook
+    """
+    
+    # writes        int, write transactions
+    # rows          int, rows changed (SQLite only)
+    # bytes         int, bytes handed to the store (the key/value store rewrites the whole state, its size is estimated)
+    # lock          Lock
+    
+    def __init__(self):
+        self.writes = 0
+        self.rows = 0
+        self.bytes = 0
+        self.lock = Lock()
+    
+    
+    # rows: int, size: int
+    def record(self, rows, size):
+        with self.lock:
+            self.writes += 1
+            self.rows += rows
+            self.bytes += size
+
+
+
+class KVStorage:
+    """
+    Persists all channels as list of ChanConfig in the errbot key/value store (key 'ccfg')
+    
+    Every change rewrites the whole list, the fine-grained operations exist for interface compatibility with SqliteStorage.
+    """
+    
+    # plugin        BotPlugin
+    # lock          RLock, guards the read-modify-write cycles of 'ccfg'
+    # metrics       StoreMetrics
+    # stateSize     int, pickled size of 'ccfg' when last measured
+    
+    SIZE_SAMPLING = 16 # measure the pickled size of the state on every 16th write only
+    
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.lock = RLock()
+        self.metrics = StoreMetrics()
+        self.stateSize = 0
+    
+    
+    # key: string, value: object (pickled by errbot), size: int (None: pickled size of value, sampled)
+    def write(self, key, value, size = None):
+        if size is None:
+            if self.metrics.writes % KVStorage.SIZE_SAMPLING == 0:
+                self.stateSize = len(pickle.dumps(value))
+            
+            size = self.stateSize
+        
+        self.plugin[key] = value
+        self.metrics.record(0, size)
+    
+    
+    # -> list of ChanConfig
+    def loadAll(self):
+        try:
+            return [ cfg.upgrade() for cfg in self.plugin['ccfg'] ]
+        except:
+            return [ ]
+    
+    
+    # channel: string -> ChanConfig
+    def loadChannel(self, channel):
+        candidate = [ cfg for cfg in self.loadAll() if cfg.channel == channel ]
+        
+        if len(candidate) > 0:
+            return candidate[0]
+        else:
+            return None
+    
+    
+    # config: ChanConfig -> bool
+    def addChannel(self, config):
+        with self.lock:
+            ccfg = self.loadAll()
+            
+            if len([ cfg for cfg in ccfg if cfg.channel == config.channel ]) > 0:
+                return False
+            
+            ccfg.append(config)
+            self.write('ccfg', ccfg)
+            
+            return True
+    
+    
+    # config: ChanConfig
+    def storeConfig(self, config):
+        with self.lock:
+            ccfg = self.loadAll()
+            ccfg[:] = [ cfg for cfg in ccfg if cfg.channel != config.channel ]
+            ccfg.append(config)
+            self.write('ccfg', ccfg)
+    
+    
+    # channel: string -> ChanConfig
+    def removeChannel(self, channel):
+        with self.lock:
+            ccfg = self.loadAll()
+            candidate = [ cfg for cfg in ccfg if cfg.channel == channel ]
+            ccfg[:] = [ cfg for cfg in ccfg if cfg.channel != channel ]
+            self.write('ccfg', ccfg)
+        
+        if len(candidate) > 0:
+            return candidate[0]
+        else:
+            return None
+    
+    
+    # chan: ChanInfo
+    def storeChannel(self, chan):
+        self.storeConfig(chan.exportConfig())
+    
+    
+    # chan: ChanInfo
+    def storeSettings(self, chan):
+        self.storeChannel(chan)
+    
+    
+    # poll: Poll
+    def storePoll(self, poll):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll
+    def storePollSettings(self, poll):
+        self.storeChannel(poll.chan)
+    
+    
+    # chan: ChanInfo, name: string
+    def removePoll(self, chan, name):
+        self.storeChannel(chan)
+    
+    
+    # poll: Poll, user: string, ballot: tuple of int
+    def storeVote(self, poll, user, ballot):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, votes: list of (string, tuple of int), user and ballot
+    def storeBallots(self, poll, votes):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, user: string
+    def dropVote(self, poll, user):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, users: list of string
+    def dropVotes(self, poll, users):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, option: VotingOption
+    def storeOption(self, poll, option):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, option: int
+    def dropOption(self, poll, option):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, options: list of VotingOption
+    def storeOptions(self, poll, options):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, options: list of int
+    def dropOptions(self, poll, options):
+        self.storeChannel(poll.chan)
+    
+    
+    # poll: Poll, options: list of int
+    def purgeOptions(self, poll, options):
+        self.storeChannel(poll.chan)
+    
+    
+    # channel: string -> list of ArchiveEntry
+    def loadArchiveIndex(self, channel):
+        try:
+            return self.plugin['archive:' + channel]
+        except KeyError:
+            return [ ]
+    
+    
+    # channel: string, id: int -> bytes (None: unknown)
+    def loadArchive(self, channel, id):
+        try:
+            return self.plugin['archive:' + channel + ':' + str(id)]
+        except KeyError:
+            return None
+    
+    
+    # archived polls are stored under their own key, thus the index stays small
+    # channel: string, entry: ArchiveEntry, data: bytes -> int (id of the archived poll)
+    def archivePoll(self, channel, entry, data):
+        with self.lock:
+            index = self.loadArchiveIndex(channel)
+            entry.id = max([ 0 ] + [ other.id for other in index ]) + 1
+            
+            self.write('archive:' + channel + ':' + str(entry.id), data, len(data))
+            self.plugin['archive:' + channel] = index + [ entry ]
+            
+            return entry.id
+    
+    
+    def close(self):
+        pass
+
+
+
+class SqliteStorage:
+    """
+    Persists all channels in a SQLite database (WAL mode)
+    
+    Votes and options are stored as individual rows, thus voting, revoking and adding or deleting options are single-row writes.
+    The vote count of an option is not stored, it is recounted from the ballots on restore.
+    sqlite3 caches the prepared statements of each connection, therefore all statements are constant strings with parameters.
+    
+    Several bot processes on one host may share the database. Each channel is served by the process holding its lease,
+    writes of a process identified by "writer" increment the channel version to notify the other processes.
+    """
+    
+    # path          string
+    # writer        string, instance id of this process if change notifications are enabled, else None
+    # local         threading.local, holds one connection per thread and its number of changed rows when last counted
+    # metrics       StoreMetrics
+    # connections   list of sqlite3.Connection
+    # lock          RLock, guards connections
+    
+    SCHEMA_VERSION = 1
+    
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS channels (channel TEXT PRIMARY KEY, apiKey TEXT, digestInterval INTEGER NOT NULL, digestTop INTEGER NOT NULL, defaultPoll TEXT NOT NULL, duplicates INTEGER NOT NULL DEFAULT 1, similarity REAL NOT NULL DEFAULT 0, quickVotes INTEGER NOT NULL DEFAULT 0, floodUser INTEGER NOT NULL DEFAULT -1, floodChannel INTEGER NOT NULL DEFAULT -1)",
+        "CREATE TABLE IF NOT EXISTS admins (channel TEXT NOT NULL, admin TEXT NOT NULL, PRIMARY KEY (channel, admin))",
+        "CREATE TABLE IF NOT EXISTS polls (channel TEXT NOT NULL, name TEXT NOT NULL, enabled INTEGER NOT NULL, countdownTS REAL NOT NULL, nextOption INTEGER NOT NULL DEFAULT 0, mode TEXT NOT NULL DEFAULT 'single', PRIMARY KEY (channel, name))",
+        "CREATE TABLE IF NOT EXISTS options (channel TEXT NOT NULL, poll TEXT NOT NULL, id INTEGER NOT NULL, text TEXT NOT NULL, deleted INTEGER NOT NULL, deletedTS REAL NOT NULL DEFAULT -1, PRIMARY KEY (channel, poll, id))",
+        "CREATE TABLE IF NOT EXISTS votes (channel TEXT NOT NULL, poll TEXT NOT NULL, user TEXT NOT NULL, option INTEGER NOT NULL, ballot TEXT, PRIMARY KEY (channel, poll, user))",
+        "CREATE INDEX IF NOT EXISTS votes_by_option ON votes (channel, poll, option)",
+        "CREATE TABLE IF NOT EXISTS archive (channel TEXT NOT NULL, id INTEGER NOT NULL, poll TEXT NOT NULL, finished REAL NOT NULL, reason TEXT NOT NULL, options INTEGER NOT NULL, voters INTEGER NOT NULL, winner TEXT, data BLOB NOT NULL, PRIMARY KEY (channel, id))",
+        "CREATE TABLE IF NOT EXISTS leases (channel TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS versions (channel TEXT PRIMARY KEY, version INTEGER NOT NULL, writer TEXT NOT NULL)",
+    ]
+    
+    SELECT_CHANNELS = "SELECT channel FROM channels"
+    SELECT_CHANNEL = "SELECT apiKey, digestInterval, digestTop, defaultPoll, duplicates, similarity, quickVotes, floodUser, floodChannel FROM channels WHERE channel = ?"
+    SELECT_ADMINS = "SELECT admin FROM admins WHERE channel = ?"
+    SELECT_POLLS = "SELECT name, enabled, countdownTS, nextOption, mode FROM polls WHERE channel = ?"
+    SELECT_OPTIONS = "SELECT poll, id, text, deleted, deletedTS FROM options WHERE channel = ? ORDER BY poll, id"
+    SELECT_VOTES = "SELECT poll, user, option, ballot FROM votes WHERE channel = ?"
+    INSERT_CHANNEL = "INSERT INTO channels (channel, apiKey, digestInterval, digestTop, defaultPoll, duplicates, similarity, quickVotes, floodUser, floodChannel) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    UPSERT_CHANNEL = "INSERT OR REPLACE INTO channels (channel, apiKey, digestInterval, digestTop, defaultPoll, duplicates, similarity, quickVotes, floodUser, floodChannel) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    INSERT_ADMIN = "INSERT OR IGNORE INTO admins (channel, admin) VALUES (?, ?)"
+    UPSERT_POLL = "INSERT OR REPLACE INTO polls (channel, name, enabled, countdownTS, nextOption, mode) VALUES (?, ?, ?, ?, ?, ?)"
+    UPDATE_NEXT_OPTION = "UPDATE polls SET nextOption = MAX(nextOption, ?) WHERE channel = ? AND name = ?"
+    UPSERT_OPTION = "INSERT OR REPLACE INTO options (channel, poll, id, text, deleted, deletedTS) VALUES (?, ?, ?, ?, ?, ?)"
+    DELETE_OPTION = "UPDATE options SET deleted = 1, deletedTS = ? WHERE channel = ? AND poll = ? AND id = ?"
+    PURGE_OPTION = "DELETE FROM options WHERE channel = ? AND poll = ? AND id = ?"
+    UPSERT_VOTE = "INSERT OR REPLACE INTO votes (channel, poll, user, option, ballot) VALUES (?, ?, ?, ?, ?)"
+    DELETE_VOTE = "DELETE FROM votes WHERE channel = ? AND poll = ? AND user = ?"
+    DELETE_OPTION_VOTES = "DELETE FROM votes WHERE channel = ? AND poll = ? AND option = ?"
+    DELETE_POLL = "DELETE FROM polls WHERE channel = ? AND name = ?"
+    DELETE_POLL_OPTIONS = "DELETE FROM options WHERE channel = ? AND poll = ?"
+    DELETE_POLL_VOTES = "DELETE FROM votes WHERE channel = ? AND poll = ?"
+    CLEAR_CHANNEL = "DELETE FROM channels WHERE channel = ?"
+    CLEAR_ADMINS = "DELETE FROM admins WHERE channel = ?"
+    CLEAR_POLLS = "DELETE FROM polls WHERE channel = ?"
+    CLEAR_OPTIONS = "DELETE FROM options WHERE channel = ?"
+    CLEAR_VOTES = "DELETE FROM votes WHERE channel = ?"
+    SELECT_ARCHIVE_INDEX = "SELECT id, poll, finished, reason, options, voters, winner FROM archive WHERE channel = ? ORDER BY id"
+    SELECT_ARCHIVE = "SELECT data FROM archive WHERE channel = ? AND id = ?"
+    SELECT_ARCHIVE_ID = "SELECT COALESCE(MAX(id), 0) + 1 FROM archive WHERE channel = ?"
+    INSERT_ARCHIVE = "INSERT INTO archive (channel, id, poll, finished, reason, options, voters, winner, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    ACQUIRE_LEASE = "INSERT INTO leases (channel, owner, expires) VALUES (?, ?, ?) ON CONFLICT (channel) DO UPDATE SET owner = excluded.owner, expires = excluded.expires WHERE leases.owner = excluded.owner OR leases.expires < ?"
+    RELEASE_LEASE = "DELETE FROM leases WHERE channel = ? AND owner = ?"
+    SELECT_LEASES = "SELECT channel, owner, expires FROM leases"
+    SELECT_VERSIONS = "SELECT channel, version, writer FROM versions"
+    TOUCH_VERSION = "INSERT INTO versions (channel, version, writer) VALUES (?, 1, ?) ON CONFLICT (channel) DO UPDATE SET version = version + 1, writer = excluded.writer"
+    
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.local = local()
+        self.connections = [ ]
+        self.lock = RLock()
+        self.metrics = StoreMetrics()
+        
+        db = self.connection()
+        
+        if db.execute("PRAGMA user_version").fetchone()[0] < SqliteStorage.SCHEMA_VERSION:
+            # the schema changes are done in one transaction, a concurrently starting bot process waits for it
+            db.execute("BEGIN IMMEDIATE")
+            
+            with db:
+                for statement in SqliteStorage.SCHEMA:
+                    db.execute(statement)
+                
+                db.execute("PRAGMA user_version = " + str(SqliteStorage.SCHEMA_VERSION))
+    
+    
+    # -> sqlite3.Connection
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            
+            self.local.db = db
+            
+            with self.lock:
+                self.connections.append(db)
+        
+        return db
+    
+    
+    # -> bool
+    def isEmpty(self):
+        return self.connection().execute(SqliteStorage.SELECT_CHANNELS).fetchone() is None
+    
+    
+    # -> list of ChanConfig
+    def loadAll(self):
+        channels = [ row[0] for row in self.connection().execute(SqliteStorage.SELECT_CHANNELS) ]
+        
+        return [ cfg for cfg in [ self.loadChannel(channel) for channel in channels ] if cfg is not None ]
+    
+    
+    # channel: string -> ChanConfig
+    def loadChannel(self, channel):
+        db = self.connection()
+        
+        row = db.execute(SqliteStorage.SELECT_CHANNEL, (channel, )).fetchone()
+        
+        if row is None:
+            return None
+        
+        apiKey, digestInterval, digestTop, defaultPoll, duplicates, similarity, quickVotes, floodUser, floodChannel = row
+        
+        admins = [ admin for (admin, ) in db.execute(SqliteStorage.SELECT_ADMINS, (channel, )) ]
+        polls = { name: PollConfig(channel, name, [ ], [ ], bool(enabled), countdownTS, nextOption, mode) for name, enabled, countdownTS, nextOption, mode in db.execute(SqliteStorage.SELECT_POLLS, (channel, )) }
+        options = { name: { } for name in polls }
+        
+        # ids are not dense, the tombstones of compacted options are gone
+        for name, id, text, deleted, deletedTS in db.execute(SqliteStorage.SELECT_OPTIONS, (channel, )):
+            if name not in polls:
+                continue
+            
+            option = VotingOption(id, text)
+            option.deleted = bool(deleted)
+            option.deletedTS = deletedTS
+            polls[name].options.append(option)
+            options[name][id] = option
+        
+        # the vote counts are recounted from the ballots on restore
+        for name, user, option, ballot in db.execute(SqliteStorage.SELECT_VOTES, (channel, )):
+            if name in polls:
+                polls[name].userVotes.append(PersistedVote(user, option, SqliteStorage.decodeBallot(ballot)))
+        
+        return ChanConfig(channel, admins, apiKey, digestInterval, digestTop, list(polls.values()), defaultPoll, bool(duplicates), similarity, bool(quickVotes), floodUser, floodChannel)
+    
+    
+    # config: ChanConfig -> bool
+    def addChannel(self, config):
+        try:
+            with self.connection() as db:
+                db.execute(SqliteStorage.INSERT_CHANNEL, (config.channel, config.apiKey, config.digestInterval, config.digestTop, config.defaultPoll, config.duplicates, config.similarity, config.quickVotes, config.floodUser, config.floodChannel))
+                self.writeContents(db, config)
+                self.touch(db, config.channel)
+        except sqlite3.IntegrityError:
+            return False
+        
+        return True
+    
+    
+    # config: ChanConfig
+    def storeConfig(self, config):
+        # configs restored from the errbot store might predate some attributes
+        digestInterval = getattr(config, 'digestInterval', -1)
+        digestTop = getattr(config, 'digestTop', 5)
+        duplicates = getattr(config, 'duplicates', True)
+        similarity = getattr(config, 'similarity', 0)
+        quickVotes = getattr(config, 'quickVotes', False)
+        floodUser = getattr(config, 'floodUser', -1)
+        floodChannel = getattr(config, 'floodChannel', -1)
+        
+        with self.connection() as db:
+            db.execute(SqliteStorage.UPSERT_CHANNEL, (config.channel, getattr(config, 'apiKey', None), digestInterval, digestTop, config.defaultPoll, duplicates, similarity, quickVotes, floodUser, floodChannel))
+            
+            for statement in (SqliteStorage.CLEAR_ADMINS, SqliteStorage.CLEAR_POLLS, SqliteStorage.CLEAR_OPTIONS, SqliteStorage.CLEAR_VOTES):
+                db.execute(statement, (config.channel, ))
+            
+            self.writeContents(db, config)
+            self.touch(db, config.channel)
+    
+    
+    # db: sqlite3.Connection, config: ChanConfig
+    def writeContents(self, db, config):
+        db.executemany(SqliteStorage.INSERT_ADMIN, [ (config.channel, admin) for admin in getattr(config, 'admins', [ ]) ])
+        
+        for poll in config.polls:
+            self.writePoll(db, poll)
+    
+    
+    # db: sqlite3.Connection, poll: PollConfig
+    def writePoll(self, db, poll):
+        channel = poll.channel
+        
+        db.execute(SqliteStorage.UPSERT_POLL, (channel, poll.name, poll.enabled, poll.countdownTS, getattr(poll, 'nextOption', len(poll.options)), getattr(poll, 'mode', 'single')))
+        db.executemany(SqliteStorage.UPSERT_OPTION, [ (channel, poll.name, option.id, option.text, option.deleted, getattr(option, 'deletedTS', -1)) for option in poll.options ])
+        db.executemany(SqliteStorage.UPSERT_VOTE, [ (channel, poll.name, vote.user, vote.option, SqliteStorage.encodeBallot(getattr(vote, 'ballot', None))) for vote in poll.userVotes ])
+    
+    
+    # ballots of a single option are stored as NULL
+    # ballot: tuple of int (None: single option) -> string
+    @staticmethod
+    def encodeBallot(ballot):
+        return " ".join(str(option) for option in ballot) if ballot is not None and len(ballot) > 1 else None
+    
+    
+    # text: string -> tuple of int (None: single option)
+    @staticmethod
+    def decodeBallot(text):
+        return tuple(int(option) for option in text.split()) if text else None
+    
+    
+    # channel: string -> ChanConfig
+    def removeChannel(self, channel):
+        config = self.loadChannel(channel)
+        
+        with self.connection() as db:
+            for statement in (SqliteStorage.CLEAR_CHANNEL, SqliteStorage.CLEAR_ADMINS, SqliteStorage.CLEAR_POLLS, SqliteStorage.CLEAR_OPTIONS, SqliteStorage.CLEAR_VOTES):
+                db.execute(statement, (channel, ))
+            
+            self.touch(db, channel)
+        
+        return config
+    
+    
+    # chan: ChanInfo
+    def storeChannel(self, chan):
+        self.storeConfig(chan.exportConfig())
+    
+    
+    # chan: ChanInfo
+    def storeSettings(self, chan):
+        with chan.lock:
+            row = (str(chan.channel), chan.apiKey, chan.digestInterval, chan.digestTop, chan.defaultPoll, chan.duplicates, chan.similarity, chan.quickVotes, chan.floodUser, chan.floodChannel)
+            admins = [ (str(chan.channel), admin) for admin in chan.admins ]
+        
+        with self.connection() as db:
+            db.execute(SqliteStorage.UPSERT_CHANNEL, row)
+            db.execute(SqliteStorage.CLEAR_ADMINS, (str(chan.channel), ))
+            db.executemany(SqliteStorage.INSERT_ADMIN, admins)
+            self.touch(db, str(chan.channel))
+    
+    
+    # poll: Poll
+    def storePoll(self, poll):
+        config = poll.exportConfig()
+        
+        with self.connection() as db:
+            for statement in (SqliteStorage.DELETE_POLL_OPTIONS, SqliteStorage.DELETE_POLL_VOTES):
+                db.execute(statement, (config.channel, config.name))
+            
+            self.writePoll(db, config)
+            self.touch(db, config.channel)
+    
+    
+    # poll: Poll
+    def storePollSettings(self, poll):
+        with poll.lock:
+            row = (str(poll.chan.channel), poll.name, poll.enabled, poll.countdownTS, poll.nextId, poll.tally.mode)
+        
+        with self.connection() as db:
+            db.execute(SqliteStorage.UPSERT_POLL, row)
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # chan: ChanInfo, name: string
+    def removePoll(self, chan, name):
+        with self.connection() as db:
+            for statement in (SqliteStorage.DELETE_POLL, SqliteStorage.DELETE_POLL_OPTIONS, SqliteStorage.DELETE_POLL_VOTES):
+                db.execute(statement, (str(chan.channel), name))
+            
+            self.touch(db, str(chan.channel))
+    
+    
+    # poll: Poll, user: string, ballot: tuple of int
+    def storeVote(self, poll, user, ballot):
+        with self.connection() as db:
+            db.execute(SqliteStorage.UPSERT_VOTE, (str(poll.chan.channel), poll.name, user, ballot[0], SqliteStorage.encodeBallot(ballot)))
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, votes: list of (string, tuple of int), user and ballot
+    def storeBallots(self, poll, votes):
+        with self.connection() as db:
+            db.executemany(SqliteStorage.UPSERT_VOTE, [ (str(poll.chan.channel), poll.name, user, ballot[0], SqliteStorage.encodeBallot(ballot)) for user, ballot in votes ])
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, user: string
+    def dropVote(self, poll, user):
+        with self.connection() as db:
+            db.execute(SqliteStorage.DELETE_VOTE, (str(poll.chan.channel), poll.name, user))
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, users: list of string
+    def dropVotes(self, poll, users):
+        with self.connection() as db:
+            db.executemany(SqliteStorage.DELETE_VOTE, [ (str(poll.chan.channel), poll.name, user) for user in users ])
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, option: VotingOption
+    def storeOption(self, poll, option):
+        with self.connection() as db:
+            db.execute(SqliteStorage.UPSERT_OPTION, (str(poll.chan.channel), poll.name, option.id, option.text, option.deleted, option.deletedTS))
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, option: int
+    def dropOption(self, poll, option):
+        self.dropOptions(poll, [ option ])
+    
+    
+    # poll: Poll, options: list of VotingOption
+    def storeOptions(self, poll, options):
+        with self.connection() as db:
+            db.executemany(SqliteStorage.UPSERT_OPTION, [ (str(poll.chan.channel), poll.name, option.id, option.text, option.deleted, option.deletedTS) for option in options ])
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, options: list of int
+    def dropOptions(self, poll, options):
+        now = time.time()
+        rows = [ (str(poll.chan.channel), poll.name, option) for option in options ]
+        
+        with self.connection() as db:
+            db.executemany(SqliteStorage.DELETE_OPTION, [ (now, ) + row for row in rows ])
+            db.executemany(SqliteStorage.DELETE_OPTION_VOTES, rows)
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # poll: Poll, options: list of int
+    def purgeOptions(self, poll, options):
+        with self.connection() as db:
+            # keep the ids of the purged options reserved
+            db.execute(SqliteStorage.UPDATE_NEXT_OPTION, (poll.nextId, str(poll.chan.channel), poll.name))
+            db.executemany(SqliteStorage.PURGE_OPTION, [ (str(poll.chan.channel), poll.name, option) for option in options ])
+            self.touch(db, str(poll.chan.channel))
+    
+    
+    # channel: string -> list of ArchiveEntry
+    def loadArchiveIndex(self, channel):
+        index = [ ]
+        
+        for id, poll, finished, reason, options, voters, winner in self.connection().execute(SqliteStorage.SELECT_ARCHIVE_INDEX, (channel, )):
+            entry = ArchiveEntry(poll, finished, reason, options, voters, winner)
+            entry.id = id
+            index.append(entry)
+        
+        return index
+    
+    
+    # channel: string, id: int -> bytes (None: unknown)
+    def loadArchive(self, channel, id):
+        row = self.connection().execute(SqliteStorage.SELECT_ARCHIVE, (channel, id)).fetchone()
+        
+        return bytes(row[0]) if row is not None else None
+    
+    
+    # channel: string, entry: ArchiveEntry, data: bytes -> int (id of the archived poll)
+    def archivePoll(self, channel, entry, data):
+        # archives are no channel state, other bot processes are not notified
+        with self.connection() as db:
+            entry.id = db.execute(SqliteStorage.SELECT_ARCHIVE_ID, (channel, )).fetchone()[0]
+            db.execute(SqliteStorage.INSERT_ARCHIVE, (channel, entry.id, entry.poll, entry.finished, entry.reason, entry.options, entry.voters, entry.winner, data))
+            self.count(db, len(data))
+        
+        return entry.id
+    
+    
+    # db: sqlite3.Connection, channel: string
+    def touch(self, db, channel):
+        self.count(db, 0)
+        
+        if self.writer is not None:
+            db.execute(SqliteStorage.TOUCH_VERSION, (channel, self.writer))
+    
+    
+    # counts a write transaction of this thread's connection
+    # db: sqlite3.Connection, size: int (bytes of blobs written)
+    def count(self, db, size):
+        changes = db.total_changes
+        
+        self.metrics.record(changes - getattr(self.local, 'changes', 0), size)
+        self.local.changes = changes
+    
+    
+    # writer: string
+    def enableNotifications(self, writer):
+        self.writer = writer
+    
+    
+    # -> dict of string -> (int, string)
+    def versions(self):
+        return { channel: (version, writer) for channel, version, writer in self.connection().execute(SqliteStorage.SELECT_VERSIONS) }
+    
+    
+    # channel: string, owner: string, duration: float -> bool
+    def acquireLease(self, channel, owner, duration):
+        now = time.time()
+        
+        with self.connection() as db:
+            return db.execute(SqliteStorage.ACQUIRE_LEASE, (channel, owner, now + duration, now)).rowcount > 0
+    
+    
+    # -> dict of string -> (string, float)
+    def leases(self):
+        return { channel: (owner, expires) for channel, owner, expires in self.connection().execute(SqliteStorage.SELECT_LEASES) }
+    
+    
+    # channel: string, owner: string
+    def releaseLease(self, channel, owner):
+        with self.connection() as db:
+            db.execute(SqliteStorage.RELEASE_LEASE, (channel, owner))
+    
+    
+    # configs: list of ChanConfig
+    def importConfigs(self, configs):
+        for config in configs:
+            self.storeConfig(config)
+    
+    
+    def close(self):
+        with self.lock:
+            for db in self.connections:
+                db.close()
+            
+            self.connections = [ ]
+            self.local = local()
+
+
+
+class Histogram:
+    """
+    Latency histogram with fixed, exponentially growing buckets (10us to 15s), constant memory
+    """
+    
+    # counts        list of int, samples per bucket, the last bucket collects everything above BOUNDS[-1]
+    # count         int
+    # total         float (seconds)
+    # max           float (seconds)
+    
+    BOUNDS = [ 0.00001 * 1.5 ** index for index in range(36) ]
+    
+    def __init__(self):
+        self.counts = [ 0 ] * (len(Histogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    
+    # seconds: float
+    def add(self, seconds):
+        index = 0
+        
+        while index < len(Histogram.BOUNDS) and seconds > Histogram.BOUNDS[index]:
+            index += 1
+        
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    
+    
+    # upper bound of the bucket holding the percentile
+    # fraction: float -> float (seconds)
+    def percentile(self, fraction):
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        
+        for index, count in enumerate(self.counts):
+            seen += count
+            
+            if seen >= rank:
+                return min(Histogram.BOUNDS[index], self.max) if index < len(Histogram.BOUNDS) else self.max
+        
+        return self.max
+
+
+
+class CommandTimer:
+    """
+    Splits the time of one command invocation into phases, lives on the thread running the command
+    """
+    
+    # command       string
+    # begin         float (perf_counter)
+    # last          float (perf_counter), end of the previous segment
+    # stack         list of string, phases entered, the innermost last
+    # phases        dict of string -> float (seconds)
+    
+    def __init__(self, command):
+        self.command = command
+        self.begin = time.perf_counter()
+        self.last = self.begin
+        self.stack = [ 'args' ] # errbot parses the arguments until the command resolves its channel
+        self.phases = collections.defaultdict(float)
+    
+    
+    # attributes the time since the previous segment to the current phase
+    def split(self):
+        now = time.perf_counter()
+        self.phases[self.stack[-1]] += now - self.last
+        self.last = now
+    
+    
+    # phase: string
+    def enter(self, phase):
+        self.split()
+        self.stack.append(phase)
+    
+    
+    def leave(self):
+        self.split()
+        self.stack.pop()
+        
+        if self.stack[-1] == 'args':
+            self.stack[-1] = 'state' # the command itself runs from now on
+
+
+
+class CommandStats:
+    """
+    In-memory latency histograms per command and phase, see !tb stats
+    
+    Phases: args (errbot argument parsing), resolve (channel and poll lookup), state (checks and state changes),
+    persist (storage writes), render (formatting of listings), send (handing replies to the chat backend)
+    """
+    
+    # enabled       bool, checked before anything is timed
+    # since         float, start of the recording
+    # commands      dict of string -> Histogram
+    # phases        dict of (string, string) -> Histogram, by command and phase
+    # lock          Lock
+    # local         threading.local, timer of the command running on this thread
+    
+    PHASES = ('args', 'resolve', 'state', 'persist', 'render', 'send')
+    
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.local = local()
+        
+        self.reset()
+    
+    
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.commands = collections.defaultdict(Histogram)
+            self.phases = collections.defaultdict(Histogram)
+    
+    
+    # -> CommandTimer (None: no timed command running on this thread)
+    def current(self):
+        return getattr(self.local, 'timer', None)
+    
+    
+    # command: string -> CommandTimer
+    def begin(self, command):
+        timer = CommandTimer(command)
+        self.local.timer = timer
+        
+        return timer
+    
+    
+    # timer: CommandTimer
+    def end(self, timer):
+        timer.split()
+        self.local.timer = None
+        
+        with self.lock:
+            self.commands[timer.command].add(timer.last - timer.begin)
+            
+            for phase, seconds in timer.phases.items():
+                self.phases[(timer.command, phase)].add(seconds)
+    
+    
+    # -> list of (string, Histogram, dict of string -> Histogram)
+    def snapshot(self):
+        with self.lock:
+            return [ (command, copy.deepcopy(histogram), { phase: copy.deepcopy(self.phases[(command, phase)]) for phase in CommandStats.PHASES if (command, phase) in self.phases }) for command, histogram in sorted(self.commands.items()) ]
+
+
+
+class TimedStorage:
+    """
+    Wraps KVStorage or SqliteStorage while the command statistics are recorded, times the storage calls of commands as phase 'persist'
+    """
+    
+    # storage       KVStorage or SqliteStorage
+    # stats         CommandStats
+    
+    def __init__(self, storage, stats):
+        self.storage = storage
+        self.stats = stats
+    
+    
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        
+        if not callable(method):
+            return method
+        
+        def timed(*args, **kwargs):
+            timer = self.stats.current()
+            
+            if timer is None:
+                return method(*args, **kwargs)
+            
+            timer.enter('persist')
+            
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timer.leave()
+        
+        return timed
+
+
+
+class TokenBucket:
+    # capacity      float, burst size
+    # rate          float, tokens added per second
+    # tokens        float
+    # stamp         float, time.monotonic() of the last refill
+    
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = now
+    
+    
+    # now: float
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+
+
+class FloodControl:
+    """
+    Token buckets per user and channel, checked before a command is parsed
+    
+    Each user may issue a number of commands per minute in a channel, the channel as a whole a number of commands per second.
+    Under load the channel bucket keeps a reserve for the more important commands: listings and non-admin calls of admin commands
+    are shed first, then additions, votes last. Admins and bot owners are never limited.
+    """
+    
+    # userLimit     integer, default commands per minute per user (0: unlimited)
+    # chanLimit     integer, default commands per second per channel (0: unlimited)
+    # users         dict of (string, int) -> TokenBucket, by channel and Identities id
+    # chans         dict of string -> TokenBucket
+    # warned        set of (string, int), users told to slow down since they were last admitted
+    # shed          collections.Counter of (string, string, string) -> int, rejected commands by channel, command and reason ('user', 'channel')
+    # lock          Lock
+    
+    # share of the channel bucket a command leaves for more important commands
+    RESERVE = { 'vote': 0, 'add': 0.25, 'list': 0.5, 'admin': 0.5 }
+    MAX_USERS = 10000 # buckets of idle users are dropped beyond
+    
+    def __init__(self, userLimit, chanLimit):
+        self.userLimit = userLimit
+        self.chanLimit = chanLimit
+        self.users = { }
+        self.chans = { }
+        self.warned = set()
+        self.shed = collections.Counter()
+        self.lock = Lock()
+    
+    
+    # buckets: dict, key: object, capacity: float, rate: float, now: float -> TokenBucket (refilled)
+    def bucket(self, buckets, key, capacity, rate, now):
+        bucket = buckets.get(key)
+        
+        if bucket is None or bucket.capacity != capacity:
+            bucket = buckets[key] = TokenBucket(capacity, rate, now)
+        
+        bucket.refill(now)
+        
+        return bucket
+    
+    
+    # channel: string, uid: int, command: string, kind: string (key of RESERVE), userLimit: int, chanLimit: int
+    # -> (string, bool) (None: admitted, else reason 'user' or 'channel' and whether the user has to be told)
+    def admit(self, channel, uid, command, kind, userLimit, chanLimit):
+        now = time.monotonic()
+        
+        with self.lock:
+            user = self.bucket(self.users, (channel, uid), userLimit, userLimit / 60, now) if userLimit > 0 else None
+            chan = self.bucket(self.chans, channel, chanLimit, chanLimit, now) if chanLimit > 0 else None
+            
+            if user is not None and user.tokens < 1:
+                reason = 'user'
+            elif chan is not None and chan.tokens < 1 + FloodControl.RESERVE[kind] * chanLimit:
+                reason = 'channel'
+            else:
+                for bucket in (user, chan):
+                    if bucket is not None:
+                        bucket.tokens -= 1
+                
+                self.warned.discard((channel, uid))
+                
+                if len(self.users) > FloodControl.MAX_USERS:
+                    self.users = { key: bucket for key, bucket in self.users.items() if bucket.tokens + (now - bucket.stamp) * bucket.rate < bucket.capacity }
+                
+                return None
+            
+            self.shed[(channel, command, reason)] += 1
+            warn = (channel, uid) not in self.warned
+            self.warned.add((channel, uid))
+            
+            return (reason, warn)
+    
+    
+    # channel: string (None: all channels) -> collections.Counter of (string, string) -> int, by command and reason
+    def shedCounts(self, channel = None):
+        with self.lock:
+            result = collections.Counter()
+            
+            for (chan, command, reason), count in self.shed.items():
+                if channel is None or chan == channel:
+                    result[(command, reason)] += count
+            
+            return result
+
+
+
+# times a bot command as a whole (outermost decorator, includes errbot's argument parsing), see CommandStats
+def timedCommand(func):
+    @functools.wraps(func)
+    def wrapper(self, msg, args):
+        if not self.stats.enabled:
+            result = func(self, msg, args)
+        else:
+            timer = self.stats.begin(func.__name__)
+            
+            try:
+                result = func(self, msg, args)
+                
+                # errbot's argument parser wraps the command in a generator, it runs while the replies are consumed
+                if inspect.isgenerator(result):
+                    result = list(result)
+            finally:
+                self.stats.end(timer)
+        
+        if inspect.isgenerator(result) or isinstance(result, list):
+            yield from result
+        elif result is not None:
+            yield result
+    
+    return wrapper
+
+
+# sheds a bot command of a user or channel over its limit before the arguments are parsed, see FloodControl
+# kind: string (key of FloodControl.RESERVE)
+def limitedCommand(kind):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, msg, args):
+            if not self.admitCommand(msg, func.__name__, kind):
+                return None
+            
+            return func(self, msg, args)
+        
+        return wrapper
+    
+    return decorator
+
+
+# times a helper method as phase of the running command, see CommandStats
+# phase: string
+def timedPhase(phase):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            timer = self.stats.current()
+            
+            if timer is None:
+                return func(self, *args, **kwargs)
+            
+            timer.enter(phase)
+            
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                timer.leave()
+        
+        return wrapper
+    
+    return decorator
+
+
+
+class Titlebot(BotPlugin):
+    """
+    I help you to do open polls
+    
+    Hint: The argument <channel> in commands is only rqequired if you send the command as query/direct message.
+    """
+    
+    # chans         list of ChanInfo
+    # cbChan        list of Poll, polls with a running countdown
+    # dgChan        list of ChanInfo
+    # qvChan        list of ChanInfo, channels with quick votes to confirm
+    # polling       bool
+    # chansLock     RLock, guards changes of chans (readers iterate the current list without locking)
+    # pollLock      RLock, guards cbChan, dgChan, qvChan, polling and profiler
+    # storage       KVStorage or SqliteStorage
+    # instance      string, id of this bot process if the state is shared with other processes, else None
+    # leaseTime     integer (seconds)
+    # foreignChans  set of string, configured channels served by another bot process
+    # pendingRooms  dict of string -> Room, rooms waiting for the background restore (guarded by chansLock)
+    # restorer      Thread restoring the pending rooms, None if there are none
+    # restored      Event, set while no room is waiting for its restore
+    # restoreTime   float, seconds the last background restore took (-1: running)
+    # knownVersions dict of string -> int, last seen storage version of the served channels
+    # webCache      dict of (string, string, string) -> (PollSnapshot, string, string), rendered webhook responses (snapshot, etag, body)
+    # streamClients integer, number of connected server-sent events listeners
+    # streamLock    RLock, guards streamClients
+    # stats         CommandStats
+    # profiler      SamplingProfiler while profiling, else None
+    # floodControl  FloodControl
+    # identities    Identities of all users seen
+    # ownerIds      frozenset of int, Identities ids of the bot owners (BOT_ADMINS)
+    #
+    # locks are always acquired in this order: chansLock, ChanInfo.lock, pollLock, storage locks
+    
+    CONFIG_TEMPLATE = {
+        'STORAGE': 'kv', # 'kv': errbot key/value store, 'sqlite': SQLite database
+        'SQLITE_PATH': '', # default: titlebot.sqlite in the errbot data directory
+        'SHARED': False, # share the SQLite database with other bot processes on this host
+        'INSTANCE': '', # unique id of this bot process, default: <hostname>:<pid>
+        'LEASE_TIME': 30, # seconds until a channel of a crashed bot process is taken over
+        'STREAM_CLIENTS': 500, # maximum number of concurrent server-sent events listeners
+        'TOMBSTONE_RETENTION': 86400, # seconds deleted options are kept for auditing (!dump), -1: forever
+        'HSLIVE_URL': 'https://happyshooting.de/live/add_line.php', # HSLive Slack Streaming endpoint the channel messages are forwarded to
+        'HSLIVE_TIMEOUT': 0.5, # seconds, request timeout of the HSLive Slack Streaming forwarder
+        'COMMAND_STATS': False, # record command latencies from the start, can be toggled at runtime by !tb stats
+        'FLOOD_USER': 30, # commands per minute a user may send in a channel, 0: unlimited. per channel: !flood
+        'FLOOD_CHANNEL': 0, # commands per second a channel may send, listings are shed first, 0: unlimited. per channel: !flood
+    }
+    
+    LONG_POLL_MAX_WAIT = 30
+    SIMILAR_OPTIONS = 3
+    QUICK_VOTE_NAMES = 10
+    HISTORY_MAX_POINTS = 60
+    STREAM_KEEPALIVE = 15
+    PROFILE_MAX_DURATION = 600
+    MODE_USAGE = {
+        'single': "Vote for one option",
+        'approval': "Vote for all options you approve, e.g. vote 2 5 7. The option with the most approvals wins",
+        'ranked': "Vote for options in order of preference, e.g. vote 5 2 7. The least preferred options are eliminated until one has the majority",
+    }
+    
+    
+    def __init__(self, bot, name):
+        super().__init__(bot, name)
+        
+        self.chansLock = RLock()
+        self.pollLock = RLock()
+        
+        self.storage = KVStorage(self)
+        self.instance = None
+        self.leaseTime = Titlebot.CONFIG_TEMPLATE['LEASE_TIME']
+        self.foreignChans = set()
+        self.pendingRooms = { }
+        self.restorer = None
+        self.restored = Event()
+        self.restored.set()
+        self.restoreTime = -1
+        self.knownVersions = { }
+        self.webCache = { }
+        self.streamClients = 0
+        self.streamLock = RLock()
+        self.stats = CommandStats(False)
+        self.floodControl = FloodControl(Titlebot.CONFIG_TEMPLATE['FLOOD_USER'], Titlebot.CONFIG_TEMPLATE['FLOOD_CHANNEL'])
+        self.profiler = None
+        self.identities = Identities()
+        self.ownerIds = frozenset(self.identities.internName(owner) for owner in self.bot_config.BOT_ADMINS)
+        
+        self.chans = [ ]
+        self.cbChan = [ ]
+        self.dgChan = [ ]
+        self.qvChan = [ ]
+        
+        self.resetState()
+    
+    
+    def resetState(self):
+        with self.chansLock:
+            self.pendingRooms = { }
+            
+            for chan in self.chans:
+                self.tryDisableRoom(chan.channel)
+            
+            with self.pollLock:
+                self.chans = [ ]
+                self.cbChan = [ ]
+                self.dgChan = [ ]
+                self.qvChan = [ ]
+                self.polling = False
+    
+    
+    # identifier: Identifier, text: string
+    @timedPhase('send')
+    def send(self, identifier, text, *args, **kwargs):
+        return super(Titlebot, self).send(identifier, text, *args, **kwargs)
+    
+    
+    # msg: Message, errStr: String
+    def badArgs(self, msg, errStr = ""):
         self.send(msg.frm, "error: bad or missing argument. " + errStr)
     
     
-    # msg: Message, channel: string -> Room
-    def lookupChannel(self, msg, channel):
+    # msg: Message, channel: string -> Room
+    def lookupChannel(self, msg, channel):
+        try:
+            room = self.query_room(channel)
+        except (RoomDoesNotExistError, ValueError) as e:
+            self.badArgs(msg, "unknown or invalid channel name. details:\n" + str(e))
+            
+            return None
+        
+        if room.joined:
+            return room        
+        else:
+            self.badArgs(msg, "i am not a member of this channel")
+            
+            return None
+    
+    
+    # msg: Message, channel: Room -> ChanInfo
+    def lookupChanInfo(self, msg, channel):
+        self.awaitRoom(channel)
+        
+        candidate = [ chan for chan in self.chans if chan.channel == channel ]
+        
+        if len(candidate) > 0:
+            return candidate[0]
+        elif str(channel) in self.foreignChans:
+            return None # another bot process serves this channel and replies
+        else:
+            self.badArgs(msg, "i do not listen to commands for this channel")
+            
+            return None
+
+
+    # msg: Message, channel: String -> bool
+    def testChannel(self, msg, channel):
+        if channel is None:
+            if msg.is_direct and len(self.pendingRooms) > 0:
+                self.restored.wait() # the channel is inferred from all configured channels
+            
+            if len(self.chans) != 1 and msg.is_direct:
+                self.send(msg.frm, "Which channel did you mean? Please specify the channel using the argument \"--channel\" <channel_name>")
+                
+                return False
+        else: # test if user occupies the requested channel
+            for room in self.rooms():
+                if channel == str(room) and len([ occupant for occupant in room.occupants if str(msg.frm) == occupant.person ]) > 0:
+                    return True
+            
+            self.badArgs(msg, "i do only accept commands from users in my channels")
+            
+            return False
+            
+        return True
+    
+    
+    # msg: Message, channel: String -> Room
+    def inferChannel(self, msg, channel):
+        if channel is not None:
+            return self.lookupChannel(msg, channel)
+        elif not msg.is_direct:
+            return msg.to
+        else: # direct message and only one configured channel
+            if len(self.chans) == 1:
+                return self.chans[0].channel
+            else:
+                self.send(msg.frm, "error: could not infer the channel. this is a bug and not your fault. sorry!")
+                
+                return None
+
+
+    # person: Person, chan: ChanInfo -> bool
+    def testAdmin(self, person, chan):
+        if not chan.isAdmin(person) and not self.isOwner(person):
+            self.send(person, "Access denied. Administrative privileges are required to run this command.")
+            
+            return False
+        
+        return True
+    
+    
+    # person: Person -> bool
+    def isOwner(self, person):
+        return self.identities.intern(person) in self.ownerIds
+    
+    
+    # msg: Message
+    def testOwner(self, msg):
+        if not self.isOwner(msg.frm):
+            self.send(msg.frm, "Access denied. Only bot owners are allowed to run this command.")
+            
+            return False
+        
+        return True
+    
+    
+    # flood control of a command before its arguments are parsed, direct messages count for the only channel or no channel
+    # msg: Message, command: string, kind: string (key of FloodControl.RESERVE), chan: ChanInfo (None: from the message), quiet: bool -> bool
+    def admitCommand(self, msg, command, kind, chan = None, quiet = False):
+        if chan is None:
+            chans = self.chans
+            
+            if msg.is_direct:
+                chan = chans[0] if len(chans) == 1 else None
+            else:
+                chan = next((candidate for candidate in chans if candidate.channel == msg.to), None)
+        
+        if self.isOwner(msg.frm) or (chan is not None and chan.isAdmin(msg.frm)):
+            return True
+        
+        userLimit = chan.floodUser if chan is not None and chan.floodUser >= 0 else self.floodControl.userLimit
+        chanLimit = chan.floodChannel if chan is not None and chan.floodChannel >= 0 else self.floodControl.chanLimit
+        
+        if userLimit <= 0 and chanLimit <= 0:
+            return True
+        
+        result = self.floodControl.admit(str(chan.channel) if chan is not None else '', self.identities.intern(msg.frm), command, kind, userLimit, chanLimit)
+        
+        if result is None:
+            return True
+        
+        reason, warn = result
+        
+        if warn and not quiet:
+            if reason == 'user':
+                self.send(msg.frm, "Slow down, you sent too many commands. Please wait a few seconds")
+            else:
+                self.send(msg.frm, "The bot is busy, " + ("please try again in a moment" if kind == 'vote' else "votes are handled first. Please try again in a few seconds"))
+        
+        return False
+
+
+    # msg: Message, channel: String -> (room, ChanInfo)
+    @timedPhase('resolve')
+    def parseParams(self, msg, channel):
+        if channel is not None:
+            chanStr = '#' + channel
+        else:
+            chanStr = None
+        
+        if not self.testChannel(msg, chanStr):
+            raise ValueError()
+        
+        room = self.inferChannel(msg, chanStr)
+        if room is None:
+            raise ValueError()
+                 
+        chan = self.lookupChanInfo(msg, room)
+        if chan is None:
+            raise ValueError()
+        
+        return (room, chan)
+
+
+    # msg: Message, chan: ChanInfo, name: String (None: default poll) -> Poll
+    @timedPhase('resolve')
+    def lookupPoll(self, msg, chan, name):
+        poll = chan.findPoll(name)
+        
+        if poll is None:
+            self.badArgs(msg, "there is no poll named " + str(name) + " in this channel. see: !poll list")
+            
+            raise ValueError()
+        
+        return poll
+    
+    
+    # poll: Poll -> string, prefix for channel messages if the channel runs several polls
+    def pollTag(self, poll):
+        if len(poll.chan.polls) > 1:
+            return "[" + poll.name + "] "
+        else:
+            return ""
+
+
+    @timedCommand
+    @limitedCommand('vote')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll to vote in, default: the default poll of the channel')
+    @arg_botcmd('--quiet', '-q', '--silent', '-s', action='store_true', help='do not reply to confirm a successful vote')
+    @arg_botcmd('lOptions', metavar='option_id', nargs='+', type=int, help='the option number you want to vote for. approval polls: all options you approve, ranked polls: the options in order of preference')
+    def vote(self, msg, channel, pollName, quiet, lOptions):
+        """vote for option <option_id>, in approval or ranked polls for several options"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if min(lOptions) < 1:
+            self.badArgs(msg, "option numbers start at 1. see: !list")
+            
+            return
+        
+        if len(set(lOptions)) != len(lOptions):
+            self.badArgs(msg, "each option may be listed only once")
+            
+            return
+        
+        ballot = tuple(option - 1 for option in lOptions)
+        
+        with chan.lock:
+            if not poll.enabled:
+                self.send(msg.frm, self.pollTag(poll) + "Voting has been disabled")
+                
+                return
+            
+            if poll.tally.mode == 'single' and len(ballot) > 1:
+                self.badArgs(msg, "this poll takes a single option per vote. see: !mode")
+                
+                return
+            
+            accepted, vote = poll.cast(msg.frm, ballot)
+            
+            if accepted:
+                self.storage.storeVote(poll, vote.name, vote.ballot)
+            
+            described = poll.tally.describe(vote.ballot) if vote is not None else None
+        
+        if accepted:
+            if not quiet:
+                self.send(msg.frm, self.pollTag(poll) + "Vote for " + described + " accepted")
+        elif vote is None:
+            self.send(msg.frm, "Failed: There is no such option. Maybe it has been deleted?")
+        else:
+            self.send(msg.frm, "Vote rejected, you have already voted for " + described)
+
+
+    @timedCommand
+    @limitedCommand('vote')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('user', nargs='?', type=str, help='the user whose vote is to be revoked (admin-only)')
+    def revoke(self, msg, channel, pollName, user):
+        """revoke (your) vote"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        person = msg.frm
+        isAdmin = False
+        
+        if user is not None and str(person.person) != user:
+            isAdmin = self.testAdmin(person, chan)
+            
+            if isAdmin:
+                try:
+                    person = self.build_identifier(user)
+                except (UserDoesNotExistError, ValueError) as e:
+                    self.badArgs(msg, "unknown user or invalid syntax, can not revoke vote. details:\n" + str(e))
+                    
+                    return
+            else:
+                return
+        
+        msgTo = msg.frm if not isAdmin else room
+        
+        with chan.lock:
+            if not poll.enabled and not isAdmin:
+                self.send(msg.frm, self.pollTag(poll) + "Voting has been disabled")
+                
+                return
+            
+            oldVote = poll.revoke(person)
+            
+            if oldVote is not None:
+                self.storage.dropVote(poll, oldVote.name)
+                described = poll.tally.describe(oldVote.ballot)
+        
+        if oldVote is not None:
+            self.send(msgTo, "----- " + self.pollTag(poll) + "Vote by user " + str(person.person) + " for " + described + " has been revoked")
+        else:
+            self.send(msg.frm, "Failed: No vote to revoke for user " + str(person.person))
+
+
+    @timedCommand
+    @limitedCommand('add')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('lText', metavar='option_text', nargs='+', type=str, help='the text of your proposed option')
+    def add(self, msg, channel, pollName, lText):
+        """add an option with text <option_text> to the vote"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        option = ' '.join(lText)
+        similar = [ ]
+        
+        with chan.lock:
+            if not poll.enabled:
+                self.send(msg.frm, self.pollTag(poll) + "Voting has been disabled")
+                return
+            
+            duplicate = poll.findDuplicate(option) if chan.duplicates else None
+            
+            if duplicate is None:
+                if chan.similarity > 0:
+                    similar = poll.findSimilar(option, chan.similarity, Titlebot.SIMILAR_OPTIONS)
+                
+                result = poll.addOption(option)
+                
+                if result >= 0:
+                    self.storage.storeOption(poll, poll.findOption(result))
+        
+        if duplicate is not None:
+            self.send(msg.frm, "Option rejected, it duplicates option " + str(duplicate.id + 1) + ": " + duplicate.text)
+        elif result >= 0:
+            hint = ""
+            
+            if len(similar) > 0:
+                hint = " (similar to option " + ", ".join(str(other.id + 1) for other in similar) + ")"
+            
+            self.send(room, "----- " + self.pollTag(poll) + "Option " + str(result + 1) + " added: " + option + hint)
+        else:
+            self.send(msg.frm, "----- Failed to add option")
+        
+        
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('lOptions', metavar='option_id', nargs='+', type=int, help='the option number(s) you want to delete')
+    def rm(self, msg, channel, pollName, lOptions):
+        """delete the voting option(s) <option_id> (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        with chan.lock:
+            deleted, shortened = poll.delOptions([ option - 1 for option in lOptions if option > 0 ])
+            
+            if len(deleted) > 0:
+                self.storage.dropOptions(poll, list(deleted.keys()))
+                
+                # ballots keeping other options lose just the deleted ones
+                if len(shortened) > 0:
+                    self.storage.storeBallots(poll, [ (vote.name, vote.ballot) for vote in shortened ])
+                
+                self.compactPoll(poll)
+        
+        out = [ ]
+        
+        for option, revoked in deleted.items():
+            for user in revoked:
+                out.append("----- " + self.pollTag(poll) + "Vote by user " + str(user.person) + " for option " + str(option + 1) + " has been revoked -----")
+                
+            out.append("----- " + self.pollTag(poll) + "Option " + str(option + 1) + " has been deleted by admin " + str(msg.frm.person) + " -----")
+        
+        if len(out) > 0:
+            self.send(room, '\n'.join(out))
+        
+        failed = sorted(set(option for option in lOptions if option - 1 not in deleted))
+        
+        if len(failed) > 0:
+            self.send(msg.frm, "Failed to delete option " + ", ".join(str(option) for option in failed) + ". Does it exist or has it already been deleted by someone else?")
+
+
+    @timedCommand
+    @limitedCommand('admin')
+    @botcmd(name='import')
+    def importOptions(self, msg, args):
+        """add many options at once, one option per line: !import [--channel <channel>] [--poll <poll>] followed by the option texts on the next lines. Works while voting is disabled (admin only command)"""
+        
+        lines = args.split('\n')
+        header = lines[0].split()
+        channel = None
+        pollName = None
+        
+        while len(header) > 0 and header[0] in ('-c', '--channel', '-P', '--poll'):
+            if len(header) < 2:
+                self.badArgs(msg, "missing value of " + header[0])
+                return
+            
+            flag = header.pop(0)
+            
+            if flag in ('-c', '--channel'):
+                channel = header.pop(0)
+            else:
+                pollName = header.pop(0)
+        
+        texts = [ ' '.join(line.split()) for line in [ ' '.join(header) ] + lines[1:] ]
+        texts = [ text for text in texts if text ]
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        if len(texts) == 0:
+            self.badArgs(msg, "no options given, put one option per line below the command")
+            return
+        
+        with chan.lock:
+            added, rejected = poll.addOptions(texts, chan.duplicates)
+            
+            if len(added) > 0:
+                self.storage.storeOptions(poll, added)
+        
+        if len(added) > 0:
+            out = [ "----- " + self.pollTag(poll) + str(len(added)) + " options have been added by admin " + str(msg.frm.person) + " -----" ]
+            
+            for option in added:
+                out.append("  " + str(option.id + 1) + ") " + option.text)
+            
+            self.send(room, '\n'.join(out))
+        
+        if len(rejected) > 0:
+            out = [ str(len(rejected)) + " options rejected as duplicates:" ]
+            
+            for text, duplicate in rejected:
+                out.append("  " + text + " (duplicates option " + str(duplicate.id + 1) + ")")
+            
+            self.send(msg.frm, '\n'.join(out))
+
+
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    def enable(self, msg, channel, pollName):
+        """enable/resume voting (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+            
+        with chan.lock:
+            wasEnabled = poll.enabled
+            
+            if not wasEnabled:
+                poll.setEnabled(True)
+                
+                self.storage.storePollSettings(poll)
+        
+        if not wasEnabled:
+            self.send(room, "----- " + self.pollTag(poll) + "Voting has been ENABLED! -----")
+        else:
+            self.send(msg.frm, "Voting was already enabled")
+
+
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    def disable(self, msg, channel, pollName):
+        """disable/pause voting. It might be continued later. Also resets the countdown timer, if running (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        with chan.lock:
+            wasEnabled = poll.enabled
+            
+            if wasEnabled:
+                poll.setEnabled(False)
+                self.resetCountdown(poll)
+                
+                self.storage.storePollSettings(poll)
+        
+        if wasEnabled:
+            self.send(room, "----- " + self.pollTag(poll) + "Voting has been DISABLED! -----")
+        else:
+            self.send(msg.frm, "Voting was already disabled")
+
+
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('--disable', '-d', action='store_true', help='disables a running countdown')
+    @arg_botcmd('--list', '-l', dest='doList', action='store_true', help='lists all vote options before the countdown starts')
+    @arg_botcmd('delay', nargs='?', type=int, default='120', help='countdown delay (in seconds). Negative values have the same effect as --disable. A value of zero ends the voting immediately. default=60sec')
+    def countdown(self, msg, channel, pollName, disable, doList, delay):
+        """start/stop a countdown to end the voting. Might be called again to change the counter value (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        # only used in the regular case, delay > 0
+        delayMins = math.floor(delay / 60)
+        delaySecs = delay % 60
+        delayStr = ""
+        
+        if delayMins > 0:
+            delayStr = " " + str(delayMins) + "min"
+        if delaySecs > 0:
+            delayStr = delayStr + " " + str(delaySecs) + "sec"
+        
+        with chan.lock:
+            if not poll.enabled:
+                self.send(msg.frm, "Failed: Voting is disabled")
+                return
+            
+            if disable or delay < 0:
+                wasRunning = self.resetCountdown(poll)
+            elif delay == 0:
+                self.setCountdown(poll, delay)
+            else:
+                started = self.setCountdown(poll, delay)
+            
+            self.storage.storePollSettings(poll)
+        
+        if disable or delay < 0:
+            if wasRunning:
+                self.send(room, "----- " + self.pollTag(poll) + "Countdown timer has been disabled")
+            else:
+                self.send(msg.frm, "Countdown timer was not running")
+            return
+        
+        if delay == 0:
+            return # the poller announces the end of the voting
+        
+        if doList:
+            self.printOptions(room, poll)
+        
+        if started:
+            self.send(room, "----- " + self.pollTag(poll) + "Countdown timer has been enabled. Voting will end in" + delayStr)
+        else:
+            self.send(room, "----- " + self.pollTag(poll) + "Countdown timer has been changed. Voting will end in" + delayStr)
+    
+    
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('--disable', '-d', action='store_true', help='disables the periodic standings digest')
+    @arg_botcmd('--top', '-t', type=int, default=5, help='number of placements included in each digest. default=5')
+    @arg_botcmd('interval', nargs='?', type=int, default=60, help='minimum delay between two digests (in seconds). Values <= 0 have the same effect as --disable. default=60sec')
+    def digest(self, msg, channel, disable, top, interval):
+        """post the current top standings periodically to the channel, but only if the ranking has changed since the last digest (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        if disable or interval <= 0:
+            with chan.lock:
+                wasEnabled = self.resetDigest(chan)
+                
+                if wasEnabled:
+                    self.storage.storeSettings(chan)
+            
+            if wasEnabled:
+                self.send(room, "----- Standings digest has been disabled")
+            else:
+                self.send(msg.frm, "Standings digest was not enabled")
+            return
+        
+        if top <= 0:
+            self.badArgs(msg, "the number of placements must be positive")
+            return
+        
+        with chan.lock:
+            self.setDigest(chan, interval, top)
+            self.storage.storeSettings(chan)
+        
+        self.send(room, "----- Standings digest has been enabled. The top " + str(top) + " will be posted at most every " + str(interval) + "sec while voting is enabled")
+    
+    
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('--similar', '-s', type=float, help='point out existing options at least this similar (0..1, e.g. 0.6) to a new option. 0 disables. default: unchanged')
+    @arg_botcmd('mode', nargs='?', type=str, choices=['reject', 'allow'], help='reject or allow options equal to an existing option (ignoring case, whitespace, punctuation and emoji). default: unchanged')
+    def duplicates(self, msg, channel, similar, mode):
+        """configures the duplicate detection of !add, prints the current configuration if called without arguments (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        if similar is not None and not 0 <= similar <= 1:
+            self.badArgs(msg, "the similarity must be between 0 and 1")
+            return
+        
+        with chan.lock:
+            if mode is not None or similar is not None:
+                duplicates = chan.duplicates if mode is None else mode == 'reject'
+                similarity = chan.similarity if similar is None else similar
+                
+                chan.setDuplicateCheck(duplicates, similarity)
+                self.storage.storeSettings(chan)
+            
+            duplicates = chan.duplicates
+            similarity = chan.similarity
+        
+        out = "Duplicate options are " + ("rejected" if duplicates else "allowed")
+        
+        if similarity > 0:
+            out += ", similar options (similarity >= " + str(similarity) + ") are pointed out"
+        else:
+            out += ", similar options are not pointed out"
+        
+        self.send(msg.frm, out)
+    
+    
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('mode', nargs='?', type=str, choices=['on', 'off'], help='on: plain messages "+<option_id>" (or "<option_id>" while voting is enabled) vote in the default poll. default: unchanged')
+    def quickvotes(self, msg, channel, mode):
+        """configures quick votes, prints the current configuration if called without arguments (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        with chan.lock:
+            if mode is not None:
+                chan.quickVotes = mode == 'on'
+                self.storage.storeSettings(chan)
+            
+            quickVotes = chan.quickVotes
+        
+        if mode is not None:
+            self.send(room, "----- Quick votes have been " + ("enabled: vote by sending \"+<option_id>\" (or just the number while voting is enabled), votes are confirmed collectively" if quickVotes else "disabled"))
+        else:
+            self.send(msg.frm, "Quick votes are " + ("enabled" if quickVotes else "disabled"))
+    
+    
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('votingMode', metavar='mode', nargs='?', type=str, choices=list(Tally.MODES), help='single: one option per vote, approval: vote for any number of options, ranked: rank options by preference, instant-runoff decides. default: unchanged')
+    def mode(self, msg, channel, pollName, votingMode):
+        """sets the voting mode of a poll while it has no votes, prints the current mode if called without arguments (admin only command)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        changed = False
+        
+        with chan.lock:
+            current = poll.tally.mode
+            
+            if votingMode is not None and votingMode != current:
+                changed = poll.setMode(votingMode)
+                
+                if changed:
+                    self.storage.storePollSettings(poll)
+        
+        if changed:
+            self.send(room, "----- " + self.pollTag(poll) + "Voting mode is now " + votingMode + ". " + Titlebot.MODE_USAGE[votingMode] + " -----")
+        elif votingMode is not None and votingMode != current:
+            self.send(msg.frm, "Failed: The voting mode can not be changed while the poll has votes, reset it or revoke them first")
+        else:
+            self.send(msg.frm, "Voting mode is " + current + ". " + Titlebot.MODE_USAGE[current])
+    
+    
+    @timedCommand
+    @limitedCommand('admin')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('--user', '-u', dest='userLimit', type=int, help='commands per minute a user may send, 0: unlimited, -1: plugin default. default: unchanged')
+    @arg_botcmd('--total', '-t', dest='chanLimit', type=int, help='commands per second the channel may send, 0: unlimited, -1: plugin default. default: unchanged')
+    def flood(self, msg, channel, userLimit, chanLimit):
+        """configures the flood control of the channel and shows the commands shed so far (admin only command)"""
+        
         try:
-            room = self.query_room(channel)
-        except (RoomDoesNotExistError, ValueError) as e:
-            self.badArgs(msg, "unknown or invalid channel name. details:\n" + str(e))
+            room, chan = self.parseParams(msg, channel)
+        except ValueError as e:
+            return
+        
+        if not self.testAdmin(msg.frm, chan):
+            return
+        
+        if (userLimit is not None and userLimit < -1) or (chanLimit is not None and chanLimit < -1):
+            self.badArgs(msg, "the limits must be -1 (plugin default), 0 (unlimited) or positive")
+            return
+        
+        with chan.lock:
+            if userLimit is not None or chanLimit is not None:
+                chan.floodUser = chan.floodUser if userLimit is None else userLimit
+                chan.floodChannel = chan.floodChannel if chanLimit is None else chanLimit
+                
+                self.storage.storeSettings(chan)
             
-            return None
+            floodUser = chan.floodUser
+            floodChannel = chan.floodChannel
         
-        if room.joined:
-            return room        
-        else:
-            self.badArgs(msg, "i am not a member of this channel")
+        describe = lambda limit, default, unit: ("unlimited" if limit == 0 else str(limit) + unit) + (" (plugin default)" if default else "")
+        
+        out = [ ]
+        out.append("----- Flood control -----")
+        out.append("  per user: " + describe(self.floodControl.userLimit if floodUser < 0 else floodUser, floodUser < 0, " commands per minute"))
+        out.append("  channel: " + describe(self.floodControl.chanLimit if floodChannel < 0 else floodChannel, floodChannel < 0, " commands per second, listings are shed first"))
+        
+        shed = self.floodControl.shedCounts(str(chan.channel))
+        
+        if len(shed) > 0:
+            out.append("  shed: " + ", ".join(command + " " + str(count) + " (" + reason + ")" for (command, reason), count in shed.most_common()))
+        
+        out.append("----- Flood control end -----")
+        
+        self.send(msg.frm, '\n'.join(out))
+    
+    
+    def startPoller(self):
+        with self.pollLock:
+            if not self.polling:
+                self.start_poller(1, self.pollCallback)
             
-            return None
+            self.polling = True
     
     
-    # msg: Message, channel: Room -> ChanInfo
-    def lookupChanInfo(self, msg, channel):
-        candidate = [ chan for chan in self.chans if chan.channel == channel ]
-        
-        if len(candidate) > 0:
-            return candidate[0]
-        else:
-            self.badArgs(msg, "i do not listen to commands for this channel")
+    def stopPoller(self):
+        with self.pollLock:
+            if self.polling:
+                self.stop_poller(self.pollCallback)
             
-            return None
-
-
-    # msg: Message, channel: String -> bool
-    def testChannel(self, msg, channel):
-        if channel is None:
-            if len(self.chans) != 1 and msg.is_direct:
-                self.send(msg.frm, "Which channel did you mean? Please specify the channel using the argument \"--channel\" <channel_name>")
+            self.polling = False
+    
+    
+    # poll: Poll, timeout: integer -> bool
+    def setCountdown(self, poll, timeout):
+        with poll.lock, self.pollLock:
+            now = time.time()
+            poll.countdownTS = now + timeout
+            poll.countdownVal = timeout
+            poll.touch('countdown', { 'end': poll.countdownTS })
+            
+            result = False
+            
+            if poll not in self.cbChan:
+                self.cbChan = self.cbChan + [ poll ]
+                
+                result = True
                 
+            self.startPoller()
+            
+            return result
+    
+    
+    # poll: Poll -> bool
+    def resetCountdown(self, poll):
+        with poll.lock, self.pollLock:
+            if poll not in self.cbChan:
                 return False
-        else: # test if user occupies the requested channel
-            for room in self.rooms():
-                if channel == str(room) and len([ occupant for occupant in room.occupants if str(msg.frm) == occupant.person ]) > 0:
-                    return True
             
-            self.badArgs(msg, "i do only accept commands from users in my channels")
+            self.cbChan = [ p for p in self.cbChan if p != poll ]
             
-            return False
+            poll.resetCountdown()
             
-        return True
+            if len(self.cbChan) == 0 and len(self.dgChan) == 0 and len(self.qvChan) == 0:
+                self.stopPoller()
+            
+            return True
     
     
-    # msg: Message, channel: String -> Room
-    def inferChannel(self, msg, channel):
-        if channel is not None:
-            return self.lookupChannel(msg, channel)
-        elif not msg.is_direct:
-            return msg.to
-        else: # direct message and only one configured channel
-            if len(self.chans) == 1:
-                return self.chans[0].channel
-            else:
-                self.send(msg.frm, "error: could not infer the channel. this is a bug and not your fault. sorry!")
+    # chan: ChanInfo, interval: integer, top: integer
+    def setDigest(self, chan, interval, top):
+        with chan.lock, self.pollLock:
+            chan.digestInterval = interval
+            chan.digestTop = top
+            chan.digestTS = time.time() + interval
+            
+            for poll in chan.polls.values():
+                poll.digestLast = ()
+            
+            if chan not in self.dgChan:
+                self.dgChan = self.dgChan + [ chan ]
+            
+            self.startPoller()
+    
+    
+    # chan: ChanInfo -> bool
+    def resetDigest(self, chan):
+        with chan.lock, self.pollLock:
+            if chan not in self.dgChan:
+                return False
+            
+            self.dgChan = [ c for c in self.dgChan if c != chan ]
+            
+            chan.digestInterval = -1
+            chan.digestTS = -1
+            
+            if len(self.cbChan) == 0 and len(self.dgChan) == 0 and len(self.qvChan) == 0:
+                self.stopPoller()
+            
+            return True
+
+    
+    def pollCallback(self):
+        now = time.time()
+        
+        # cbChan, dgChan and qvChan are replaced, never modified in place: iterating without pollLock is safe
+        for poll in self.cbChan:
+            with poll.lock:
+                if poll.countdownTS < 0:
+                    continue # reset in between
                 
-                return None
+                remaining = int(round(poll.countdownTS - now))
+                steps = [ ]
+                # ensure no time step is skipped
+                while poll.countdownVal > remaining:
+                    poll.countdownVal -= 1
+                    steps.append(poll.countdownVal)
+            
+            for step in steps:
+                self.countdownProcessPoll(poll, step)
+        
+        for chan in self.dgChan:
+            with chan.lock:
+                due = 0 <= chan.digestTS <= now
+                
+                if due:
+                    chan.digestTS = now + chan.digestInterval
+            
+            if due:
+                self.digestProcessPoll(chan)
+        
+        for chan in self.qvChan:
+            self.quickVoteProcessChan(chan)
+        
+        # cleanup ...
+        with self.pollLock:
+            # ...timed-out polls
+            self.cbChan = [ p for p in self.cbChan if (p.countdownTS - now) >= 0 ]
+            # ... and poller itself
+            if len(self.cbChan) == 0 and len(self.dgChan) == 0 and len(self.qvChan) == 0:
+                self.stopPoller()
 
 
-    # person: Person, chan: ChanInfo -> bool
-    def testAdmin(self, person, chan):
-        if not chan.isAdmin(person) and str(person.person) not in self.bot_config.BOT_ADMINS:
-            self.send(person, "Access denied. Administrative privileges are required to run this command.")
+    # poll: Poll, remaining: integer
+    def countdownProcessPoll(self, poll, remaining):
+        if poll.chan not in self.chans or poll.chan.polls.get(poll.name) is not poll:
+            return # got removed in between
+    
+        room = poll.chan.channel
+        tag = self.pollTag(poll)
+        
+        if remaining in [0, -1]: # tolerate rounding errors
+            # time over
+            with poll.lock:
+                poll.resetCountdown()
+                poll.setEnabled(False)
+                
+                self.storage.storePollSettings(poll)
             
-            return False
+            self.send(room, "----- " + tag + "Countdown expired: Voting has been DISABLED")
+            self.printResults(room, poll)
+            
+            self.archivePoll(poll, 'countdown')
+        elif remaining <= 5:
+            self.send(room, "----- " + tag + "Countdown: " + str(remaining) + "sec remaining. Time is running out!")
+        elif remaining <  3*10:
+            # 10s steps
+            if remaining % 10 == 0:
+                self.send(room, "----- " + tag + "Countdown: " + str(remaining) + "sec remaining. Hurry up!")
+        elif remaining <= 3*15:
+            # 15s steps
+            if remaining % 15 == 0:
+                self.send(room, "----- " + tag + "Countdown: " + str(remaining) + "sec remaining. We are getting closer ...")
+        elif remaining <= 3*30:
+            # 30s steps
+            if remaining % 30 == 0:
+                self.send(room, "----- " + tag + "Countdown: " + str(remaining) + "sec remaining.")
+        elif remaining <= 3*60:
+            # 1m steps
+            if remaining % 60 == 0:
+                self.send(room, "----- " + tag + "Countdown: " + str(int(remaining / 60)) + "min remaining.")
+        else:
+            # 5m steps
+            if remaining % (5*60) == 0:
+                self.send(room, "----- " + tag + "Countdown: " + str(int(remaining / 60)) + "min remaining.")
+    
+    
+    # chan: ChanInfo
+    def digestProcessPoll(self, chan):
+        if chan not in self.chans:
+            return
         
-        return True
+        changed = [ ]
+        
+        with chan.lock:
+            for poll in chan.polls.values():
+                if not poll.enabled:
+                    continue
+                
+                ranking = poll.snapshot().ranking(chan.digestTop)
+                
+                if len(ranking) == 0 or ranking == poll.digestLast:
+                    continue # nothing new to report
+                
+                poll.digestLast = ranking
+                changed.append(poll)
+        
+        for poll in changed:
+            self.printStandings(chan.channel, poll)
     
     
-    # msg: Message
-    def testOwner(self, msg):
-        if str(msg.frm.person) not in self.bot_config.BOT_ADMINS:
-            self.send(msg.frm, "Access denied. Only bot owners are allowed to run this command.")
+    # confirms the quick votes of a channel since the last poller run in one message per poll
+    # chan: ChanInfo
+    def quickVoteProcessChan(self, chan):
+        with chan.lock, self.pollLock:
+            acks = chan.quickAcks
+            chan.quickAcks = [ ]
             
-            return False
+            if len(acks) == 0:
+                self.qvChan = [ c for c in self.qvChan if c != chan ]
+                return
         
-        return True
-
-
-    # msg: Message, channel: String -> (room, ChanInfo)
-    def parseParams(self, msg, channel):
-        if channel is not None:
-            chanStr = '#' + channel
-        else:
-            chanStr = None
+        if chan not in self.chans:
+            return
         
-        if not self.testChannel(msg, chanStr):
-            raise ValueError()
+        polls = [ ]
         
-        room = self.inferChannel(msg, chanStr)
-        if room is None:
-            raise ValueError()
-                 
-        chan = self.lookupChanInfo(msg, room)
-        if chan is None:
-            raise ValueError()
+        for ack in acks:
+            if ack[0] not in polls:
+                polls.append(ack[0])
         
-        return (room, chan)
+        for poll in polls:
+            accepted = collections.Counter()
+            rejected = collections.OrderedDict([ ("already voted", [ ]), ("no such option", [ ]), ("voting disabled", [ ]) ])
+            
+            for _, user, option, result in [ ack for ack in acks if ack[0] is poll ]:
+                if result is None:
+                    rejected["voting disabled"].append(user)
+                elif result[0]:
+                    accepted[option] += 1
+                elif result[1] is None:
+                    rejected["no such option"].append(user + " (" + str(option) + ")")
+                else:
+                    rejected["already voted"].append(user + " (" + str(result[1].option + 1) + ")")
+            
+            out = self.pollTag(poll) + "Quick votes: " + str(sum(accepted.values())) + " accepted"
+            
+            if len(accepted) > 0:
+                out += " (" + ", ".join("option " + str(option) + ": " + str(count) for option, count in accepted.most_common()) + ")"
+            
+            for reason, users in rejected.items():
+                if len(users) > 0:
+                    more = len(users) - Titlebot.QUICK_VOTE_NAMES
+                    out += "; " + reason + ": " + ", ".join(users[:Titlebot.QUICK_VOTE_NAMES]) + (" and " + str(more) + " more" if more > 0 else "")
+            
+            self.send(chan.channel, "----- " + out)
 
 
+    @timedCommand
+    @limitedCommand('admin')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    @arg_botcmd('--quiet', '-q', '--silent', '-s', action='store_true', help='do not reply to confirm a successful vote')
-    @arg_botcmd('option', metavar='option_id', type=int, help='the option number you want to vote for')
-    def vote(self, msg, channel, quiet, option):
-        """vote for option <option_id>"""
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    def reset(self, msg, channel, pollName):
+        """resets (and disables) the voting, drops all options and votes (admin only command)"""
         
         try:
             room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
         except ValueError as e:
             return
         
-        if not chan.enabled:
-            self.send(msg.frm, "Voting has been disabled")
-            
+        if not self.testAdmin(msg.frm, chan):
             return
         
-        result = chan.vote(msg.frm, option - 1)
-        
-        if result == option - 1:
-            self.updateChanConfig(chan)
+        with chan.lock:
+            entry = self.archivePoll(poll, 'reset')
             
-            if not quiet:
-                self.send(msg.frm, "Vote for option " + str(option) + " accepted")
-        elif result == -1:
-            self.send(msg.frm, "Failed: There is no such option. Maybe it has been deleted?")
+            self.resetCountdown(poll)
+            poll.reset()
+            
+            self.storage.storePoll(poll)
+        
+        if entry is not None:
+            self.send(room, "----- " + self.pollTag(poll) + "All votes have been reset, the previous poll has been archived as #" + str(entry.id) + " -----")
         else:
-            self.send(msg.frm, "Vote rejected, you have already voted for option " + str(-result - 1))
+            self.send(room, "----- " + self.pollTag(poll) + "All votes have been reset -----")
 
 
+    @timedCommand
+    @limitedCommand('list')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    @arg_botcmd('user', nargs='?', type=str, help='the user whose vote is to be revoked (admin-only)')
-    def revoke(self, msg, channel, user):
-        """revoke (your) vote"""
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('--public', '-p', action='store_true', help='send list public to channel (default: private as query/direct message)')
+    @arg_botcmd('sListMode', metavar='list_mode', nargs='?', type=str, default='options', choices=['options', 'results', 'votes'], help='listing modes: options, results, votes')
+    def list(self, msg, channel, pollName, public, sListMode):
+        """lists vote options, voting results or individual votes optionally public in channel (otherwise as query/direct message). admin-only: individual votes and public listing"""
         
         try:
             room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
         except ValueError as e:
             return
         
-        person = msg.frm
-        isAdmin = False
+        if (public or sListMode == "votes") and not self.testAdmin(msg.frm, chan):
+            return
         
-        if user is not None and str(person.person) != user:
-            isAdmin = self.testAdmin(person, chan)
-            
-            if isAdmin:
-                try:
-                    person = self.build_identifier(user)
-                except (UserDoesNotExistError, ValueError) as e:
-                    self.badArgs(msg, "unknown user or invalid syntax, can not revoke vote. details:\n" + str(e))
-                    
-                    return
-            else:
-                return
+        msgTo = msg.frm if not public else room
         
-        msgTo = msg.frm if not isAdmin else room
+        if sListMode == "options":
+            self.printOptions(msgTo, poll)
+        elif sListMode == "results":
+            self.printResults(msgTo, poll)
+        elif sListMode == "votes":
+            self.printVotes(msgTo, poll)
+    
+    
+    @timedCommand
+    @limitedCommand('list')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('--top', '-t', type=int, default=5, help='number of options shown, the currently leading ones. default=5')
+    @arg_botcmd('--points', '-n', type=int, default=10, help='number of points in time shown. default=10')
+    @arg_botcmd('minutes', nargs='?', type=int, default=60, help='time range to show, the last <minutes>. default=60')
+    def history(self, msg, channel, pollName, top, points, minutes):
+        """shows how the vote counts of the leading options evolved over the last <minutes> (as query/direct message)"""
         
-        if not chan.enabled and not isAdmin:
-            self.send(msg.frm, "Voting has been disabled")
-            
+        try:
+            room, chan = self.parseParams(msg, channel)
+            poll = self.lookupPoll(msg, chan, pollName)
+        except ValueError as e:
+            return
+        
+        if top <= 0 or minutes <= 0 or not 0 < points <= Titlebot.HISTORY_MAX_POINTS:
+            self.badArgs(msg, "top and minutes must be positive, points between 1 and " + str(Titlebot.HISTORY_MAX_POINTS))
+            return
+        
+        end = time.time()
+        
+        options = poll.snapshot().results[:top]
+        
+        samples = poll.historyView().sample(end - minutes * 60, end, points)
+        
+        out = [ ]
+        
+        out.append("----- " + self.pollTag(poll) + "Vote history of the last " + str(minutes) + "min (top " + str(top) + ") -----")
+        
+        for option in options:
+            out.append("  " + str(option.id + 1) + ") " + option.text)
+        
+        for ts, counts in samples:
+            out.append("  " + time.strftime('%H:%M:%S', time.localtime(ts)) + "  " + ", ".join(str(option.id + 1) + ": " + str(counts.get(option.id, 0)) for option in options))
+        
+        out.append("----- Vote history end -----")
+        
+        self.send(msg.frm, '\n'.join(out))
+    
+    
+    @timedCommand
+    @limitedCommand('list')
+    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
+    @arg_botcmd('id', nargs='?', type=int, help='number of the archived poll, required for operation "show"')
+    @arg_botcmd('op', metavar='operation', nargs='?', type=str, default='list', choices=['list', 'show'], help='operations: list, show. default=list')
+    def archive(self, msg, channel, id, op):
+        """lists the finished polls of this channel (countdown expired, reset or removed) or shows the results of an archived poll (as query/direct message)"""
+        
+        try:
+            room, chan = self.parseParams(msg, channel)
+        except ValueError as e:
             return
         
-        result = chan.revoke(person)
+        out = [ ]
         
-        if result >= 0:
-            self.updateChanConfig(chan)
+        if op == "list":
+            out.append("----- Archived polls (first number: id) -----")
+            
+            for entry in chan.archive:
+                winner = ", winner: " + entry.winner if entry.winner is not None else ""
+                
+                out.append("  #" + str(entry.id) + " " + time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.finished)) + " poll " + entry.poll + " (" + entry.reason + "): " + str(entry.options) + " options, " + str(entry.voters) + " voters" + winner)
             
-            self.send(msgTo, "----- Vote by user " + str(person.person) + " for option " + str(result + 1) + " has been revoked")
+            out.append("----- Archived polls end -----")
         else:
-            self.send(msg.frm, "Failed: No vote to revoke for user " + str(person.person))
-
-
+            record = self.loadArchived(chan, id) if id is not None else None
+            
+            if record is None:
+                self.badArgs(msg, "there is no archived poll #" + str(id) + ". see: !archive list")
+                return
+            
+            # the placements as archived, the export falls back to the vote counts for records of older releases
+            mode = record.get('mode', 'single')
+            
+            out.append("----- Archived poll #" + str(id) + " (" + record['poll'] + ", " + time.strftime('%Y-%m-%d %H:%M', time.localtime(record['finished'])) + ") results -----")
+            
+            if mode == 'ranked':
+                out.append("  instant-runoff: votes in the final round, eliminated options with their votes when they were eliminated")
+            
+            for place, option, text, votes in Export.fromArchive(id, record, 'results').rows:
+                out.append("  " + str(place) + ". " + str(text) + " (Option " + str(option) + " with " + str(votes) + " " + ("approvals" if mode == 'approval' else "votes") + ")")
+            
+            out.append("----- Archived poll results end -----")
+        
+        self.send(msg.frm, '\n'.join(out))
+    
+    
+    @timedCommand
+    @limitedCommand('list')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    @arg_botcmd('lText', metavar='option_text', nargs='+', type=str, help='the text of your proposed option')
-    def add(self, msg, channel, lText):
-        """add an option with text <option_text> to the vote"""
+    @arg_botcmd('-P', '--poll', dest='pollName', type=str, help='the poll, default: the default poll of the channel')
+    @arg_botcmd('--archive', '-a', dest='archiveId', type=int, help='export the archived poll with this number instead. see: !archive list')
+    @arg_botcmd('--format', '-f', dest='fileFormat', type=str, default='csv', choices=['csv', 'json'], help='file format: csv, json. default=csv')
+    @arg_botcmd('kind', nargs='?', type=str, default='results', choices=['options', 'results', 'votes'], help='data to export: options, results, votes. default=results')
+    def export(self, msg, channel, pollName, archiveId, fileFormat, kind):
+        """sends the options, results or individual votes of a poll as CSV or JSON file (as query/direct message). admin-only: individual votes"""
         
         try:
             room, chan = self.parseParams(msg, channel)
+            export = self.lookupExport(msg, chan, pollName, archiveId, kind)
         except ValueError as e:
             return
         
-        option = ' '.join(lText)
-        
-        if not chan.enabled:
-            self.send(msg.frm, "Voting has been disabled")
+        if kind == "votes" and not self.testAdmin(msg.frm, chan):
             return
         
-        result = chan.addOption(option)
+        # spooled to a temporary file, the chat backend reads it in its own thread
+        output = tempfile.TemporaryFile()
+        
+        for chunk in export.render(fileFormat):
+            output.write(chunk.encode('utf-8'))
+        
+        size = output.tell()
+        output.seek(0)
         
-        if result >= 0:
-            self.updateChanConfig(chan)
+        try:
+            self.send_stream_request(msg.frm, output, name=export.name + '.' + fileFormat, size=size, stream_type=Export.FORMATS[fileFormat])
+        except Exception as e:
+            output.close()
             
-            self.send(room, "----- Option " + str(result + 1) + " added: " + option)
-        else:
-            self.send(msg.frm, "----- Failed to add option")
+            self.log.warning("can not send export " + export.name + ": " + str(e))
+            self.send(msg.frm, "Sorry, i can not send files using this chat service. Please use the export webhook instead.")
+    
+    
+    # msg: Message, chan: ChanInfo, pollName: string, archiveId: int (None: live poll), kind: string -> Export
+    def lookupExport(self, msg, chan, pollName, archiveId, kind):
+        if archiveId is None:
+            return self.lookupPoll(msg, chan, pollName).export(kind)
+        
+        record = self.loadArchived(chan, archiveId)
         
+        if record is None:
+            self.badArgs(msg, "there is no archived poll #" + str(archiveId) + ". see: !archive list")
+            
+            raise ValueError()
         
+        return Export.fromArchive(archiveId, record, kind)
+    
+    
+    @timedCommand
+    @limitedCommand('list')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    @arg_botcmd('option', metavar='option_id', type=int, help='the option number you want to delete')
-    def rm(self, msg, channel, option):
-        """delete the voting option <option_id> (admin only command)"""
+    @arg_botcmd('name', nargs='?', type=str, help='name of the poll, required for operations "add", "rm" and "default"')
+    @arg_botcmd('op', metavar='operation', type=str, choices=['add', 'rm', 'default', 'list'], help='operations: add, rm, default, list')
+    def poll(self, msg, channel, name, op):
+        """manages the polls of a channel: add and rm polls, choose the default poll addressed by commands without --poll (admin only command except list)"""
         
         try:
             room, chan = self.parseParams(msg, channel)
         except ValueError as e:
             return
         
-        if not self.testAdmin(msg.frm, chan):
+        if op == "list":
+            with chan.lock:
+                polls = sorted(chan.polls.values(), key=lambda poll: poll.name)
+                
+                out = [ "----- Polls -----" ]
+                
+                for poll in polls:
+                    state = "enabled" if poll.enabled else "disabled"
+                    default = ", default" if poll.name == chan.defaultPoll else ""
+                    
+                    snapshot = poll.snapshot()
+                    
+                    out.append("  " + poll.name + " (" + state + default + ", " + snapshot.mode + ", " + str(snapshot.voters) + " votes)")
+                
+                out.append("----- Polls end -----")
+            
+            self.send(msg.frm, '\n'.join(out))
             return
         
-        revoked = chan.delOption(option - 1)
+        if not self.testAdmin(msg.frm, chan):
+            return
         
-        out = [ ]
+        if name is None or not name.strip() or len(name.split()) > 1:
+            self.badArgs(msg, "the poll name must be a single word")
+            return
         
-        if revoked is not None:
-            self.updateChanConfig(chan)
+        if op == "add":
+            with chan.lock:
+                poll = chan.addPoll(name)
+                
+                if poll is not None:
+                    self.storage.storePoll(poll)
             
-            for user in revoked:
-                out.append("----- Vote by user " + str(user.person) + " for option " + str(option) + " has been revoked -----")
+            if poll is not None:
+                self.send(room, "----- Poll " + name + " has been added. Vote with: " + self.bot_config.BOT_PREFIX + "vote --poll " + name + " <option_id> -----")
+            else:
+                self.send(msg.frm, "Failed: A poll named " + name + " already exists")
+        elif op == "rm":
+            with chan.lock:
+                poll = chan.findPoll(name) if name != chan.defaultPoll else None
+                entry = self.archivePoll(poll, 'removed') if poll is not None else None
+                poll = chan.delPoll(name)
                 
-            out.append("----- Option " + str(option) + " has been deleted by admin " + str(msg.frm.person) + " -----")
+                if poll is not None:
+                    self.resetCountdown(poll)
+                    self.storage.removePoll(chan, name)
+                    self.evictWebCache(str(chan.channel), name)
             
-            self.send(room, '\n'.join(out))
-        else:
-            self.send(msg.frm, "Failed to delete option. Does it exist or has it already been deleted by someone else?")
+            if poll is not None and entry is not None:
+                self.send(room, "----- Poll " + name + " has been deleted by admin " + str(msg.frm.person) + ", its options and votes have been archived as #" + str(entry.id) + " -----")
+            elif poll is not None:
+                self.send(room, "----- Poll " + name + " has been deleted by admin " + str(msg.frm.person) + " -----")
+            elif name == chan.defaultPoll:
+                self.send(msg.frm, "Failed: The default poll can not be deleted, choose another default poll first")
+            else:
+                self.send(msg.frm, "Failed: There is no poll named " + name)
+        elif op == "default":
+            with chan.lock:
+                changed = chan.setDefaultPoll(name)
+                
+                if changed:
+                    self.storage.storeSettings(chan)
+            
+            if changed:
+                self.send(room, "----- Commands without --poll address the poll " + name + " from now on -----")
+            else:
+                self.send(msg.frm, "Failed: There is no poll named " + name)
 
 
-    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    def enable(self, msg, channel):
-        """enable/resume voting (admin only command)"""
+    # drops the tombstones of options deleted longer than TOMBSTONE_RETENTION ago
+    # poll: Poll
+    def compactPoll(self, poll):
+        config = self.config if self.config is not None else Titlebot.CONFIG_TEMPLATE
+        retention = config['TOMBSTONE_RETENTION']
         
-        try:
-            room, chan = self.parseParams(msg, channel)
-        except ValueError as e:
+        if retention < 0:
             return
         
-        if not self.testAdmin(msg.frm, chan):
-            return
+        with poll.lock:
+            purged = poll.compact(time.time() - retention)
+            
+            if len(purged) > 0:
+                self.storage.purgeOptions(poll, purged)
+
+
+    # archives the options, votes and history of a finished poll, once: a poll unchanged since it has been archived
+    # (e.g. reset after its countdown expired) keeps its archive entry
+    # poll: Poll, reason: string -> ArchiveEntry (None: empty poll, nothing archived)
+    def archivePoll(self, poll, reason):
+        with poll.lock:
+            if poll.archived is not None:
+                return poll.archived
             
-        if not chan.enabled:
-            self.updateChanConfig(chan)
+            record = poll.exportArchive(reason)
             
-            self.send(room, "----- Voting has been ENABLED! -----")
-        else:
-            self.send(msg.frm, "Voting was already " + "enabled" if chan.enabled else "disabled")
+            if record is None:
+                return None
             
-        chan.enabled = True
+            options = [ option for option in record['options'] if not option['deleted'] ]
+            texts = { option['id']: option['text'] for option in options }
+            winner = texts[record['results'][0]['id']] if len(record['results']) > 0 else None
+            
+            entry = ArchiveEntry(poll.name, record['finished'], reason, len(options), len(record['votes']), winner)
+            
+            self.storage.archivePoll(str(poll.chan.channel), entry, zlib.compress(json.dumps(record).encode('utf-8')))
+            
+            poll.chan.archive = poll.chan.archive + [ entry ]
+            poll.archived = entry
+        
+        return entry
+    
+    
+    # chan: ChanInfo, id: int -> dict (None: unknown)
+    def loadArchived(self, chan, id):
+        data = self.storage.loadArchive(str(chan.channel), id)
+        
+        if data is None:
+            return None
+        
+        return json.loads(zlib.decompress(data).decode('utf-8'))
 
 
-    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    def disable(self, msg, channel):
-        """disable/pause voting. It might be continued later. Also resets the countdown timer, if running (admin only command)"""
+    # msgTo: Identity, poll: Poll
+    @timedPhase('render')
+    def printOptions(self, msgTo, poll):
+        out = [ ]
         
-        try:
-            room, chan = self.parseParams(msg, channel)
-        except ValueError as e:
-            return
+        snapshot = poll.snapshot()
+        unit = Tally.UNITS[snapshot.mode]
         
-        if not self.testAdmin(msg.frm, chan):
-            return
+        out.append("----- " + self.pollTag(poll) + "Vote options (first number: id) -----")
         
-        if chan.enabled:
-            self.updateChanConfig(chan)
-            
-            self.send(room, "----- Voting has been DISABLED! -----")
-            self.resetCountdown(chan)
-        else:
-            self.send(msg.frm, "Voting was already " + "enabled" if chan.enabled else "disabled")
-            
-        chan.enabled = False
+        for option in snapshot.live():
+            out.append("  " + str(option.id + 1) + ") " + option.text + " (" + str(option.votes) + " " + unit + ")")
+        
+        out.append("----- Vote options end -----")
+        
+        self.send(msgTo, '\n'.join(out))
 
 
-    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    @arg_botcmd('--disable', '-d', action='store_true', help='disables a running countdown')
-    @arg_botcmd('--list', '-l', dest='doList', action='store_true', help='lists all vote options before the countdown starts')
-    @arg_botcmd('delay', nargs='?', type=int, default='120', help='countdown delay (in seconds). Negative values have the same effect as --disable. A value of zero ends the voting immediately. default=60sec')
-    def countdown(self, msg, channel, disable, doList, delay):
-        """start/stop a countdown to end the voting. Might be called again to change the counter value (admin only command)"""
+    # msgTo: Identity, poll: Poll
+    @timedPhase('render')
+    def printResults(self, msgTo, poll):
+        out = [ ]
         
-        try:
-            room, chan = self.parseParams(msg, channel)
-        except ValueError as e:
-            return
+        snapshot = poll.snapshot()
+        results = snapshot.results
         
-        if not self.testAdmin(msg.frm, chan):
-            return
+        out.append("----- " + self.pollTag(poll) + "Vote results (first number is the placement, NOT the id) -----")
         
-        if not chan.enabled:
-            self.send(msg.frm, "Failed: Voting is disabled")
-            return
+        if snapshot.mode == 'ranked':
+            out.append("  instant-runoff: votes in the final round, eliminated options with their votes when they were eliminated")
         
-        if disable or delay < 0:
-            if self.resetCountdown(chan):
-                self.send(room, "----- Countdown timer has been disabled")
-            else:
-                self.send(msg.frm, "Countdown timer was not running")
-            return
+        for index, option in enumerate(results):
+            out.append("  " + str(index + 1) + ". " + option.text + " (Option " + str(option.id + 1) + " with " + str(option.votes) + " " + ("approvals" if snapshot.mode == 'approval' else "votes") + ")")
         
-        if delay == 0:
-            self.setCountdown(chan, delay)
-            return
+        if snapshot.mode == 'ranked' and len(results) > 0:
+            out.append("  decided in " + str(snapshot.rounds) + (" round, " if snapshot.rounds == 1 else " rounds, ") + str(snapshot.exhausted) + " ballots exhausted")
         
-        # regular case, delay > 0
-        delayMins = math.floor(delay / 60)
-        delaySecs = delay % 60
-        delayStr = ""
+        out.append("----- Vote results end -----")
         
-        if delayMins > 0:
-            delayStr = " " + str(delayMins) + "min"
-        if delaySecs > 0:
-            delayStr = delayStr + " " + str(delaySecs) + "sec"
+        self.send(msgTo, '\n'.join(out))
+    
+    
+    # msgTo: Identity, poll: Poll
+    @timedPhase('render')
+    def printStandings(self, msgTo, poll):
+        out = [ ]
+        top = poll.chan.digestTop
         
-        if doList:
-            self.printOptions(room, chan)
+        out.append("----- " + self.pollTag(poll) + "Current standings (top " + str(top) + ") -----")
         
-        if self.setCountdown(chan, delay):
-            self.send(room, "----- Countdown timer has been enabled. Voting will end in" + delayStr)
-        else:
-            self.send(room, "----- Countdown timer has been changed. Voting will end in" + delayStr)
+        for index, option in enumerate(poll.snapshot().results[:top]):
+            out.append("  " + str(index + 1) + ". " + option.text + " (" + str(option.id + 1) + ": " + str(option.votes) + ")")
+        
+        self.send(msgTo, '\n'.join(out))
+
+
+    # msgTo: Identity, poll: Poll
+    @timedPhase('render')
+    def printVotes(self, msgTo, poll):
+        out = [ ]
+        votes = collections.defaultdict(list)
+        snapshot = poll.snapshot()
+        
+        # approvals are listed under each approved option, ranked ballots under their first choice
+        for vote in snapshot.votes:
+            for option in (vote.ballot if snapshot.mode == 'approval' else vote.ballot[:1]):
+                votes[option].append(vote)
+        
+        out.append("----- " + self.pollTag(poll) + "Vote list begin -----")
+        
+        for option in snapshot.options:
+            if option.votes > 0:
+                out.append("  Option " + str(option.id + 1) + " (deleted=" + str(option.deleted) + "): " + option.text)
+            
+                for vote in votes[option.id]:
+                    if snapshot.mode == 'ranked' and len(vote.ballot) > 1:
+                        out.append("    " + vote.name + " (" + " > ".join(str(id + 1) for id in vote.ballot) + ")")
+                    else:
+                        out.append("    " + vote.name)
+        
+        out.append("----- Vote list end -----")
+        
+        self.send(msgTo, '\n'.join(out))
     
     
-    def startPoller(self):
-        if not self.polling:
-            self.start_poller(1, self.pollCallback)
+    # channel: string (without leading '#') -> ChanInfo
+    def findChanInfo(self, channel):
+        self.awaitRoom('#' + channel)
+        
+        for chan in self.chans:
+            if str(chan.channel) == '#' + channel:
+                return chan
         
-        self.polling = True
+        return None
     
     
-    def stopPoller(self):
-        if self.polling:
-            self.stop_poller(self.pollCallback)
+    # individual votes are only served to the website of the channel
+    # request: flask.Request, chan: ChanInfo -> bool
+    def testApiKey(self, request, chan):
+        return chan.apiKey is not None and request.headers.get('Authorization') == 'Bearer ' + chan.apiKey
+    
+    
+    # drops the rendered webhook responses of a removed channel or poll
+    # channel: string, pollName: string (None: all polls of the channel)
+    def evictWebCache(self, channel, pollName = None):
+        for key in list(self.webCache):
+            if key[0] == channel and (pollName is None or key[1] == pollName):
+                self.webCache.pop(key, None)
+    
+    
+    # request: flask.Request, channel: string, kind: string, export: function Poll -> object -> flask.Response
+    def serveJson(self, request, channel, kind, export):
+        chan = self.findChanInfo(channel)
+        
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
         
-        self.polling = False
+        poll = chan.findPoll(request.args.get('poll'))
+        
+        if poll is None:
+            return Response(json.dumps({ 'error': 'unknown poll' }), status=404, mimetype='application/json')
+        
+        key = (str(chan.channel), poll.name, kind)
+        snapshot = poll.snapshot()
+        cached = self.webCache.get(key)
+        
+        # rendered once per snapshot, concurrent requests might render twice which is harmless
+        if cached is None or cached[0] is not snapshot:
+            cached = (snapshot, '"' + chan.epoch + '-' + str(snapshot.version) + '"', json.dumps(export(snapshot)))
+            self.webCache[key] = cached
+        
+        etag = cached[1]
+        headers = { 'ETag': etag, 'Cache-Control': 'no-cache' }
+        
+        matches = [ tag.strip() for tag in request.headers.get('If-None-Match', '').split(',') ]
+        
+        if etag in matches or 'W/' + etag in matches or '*' in matches:
+            return Response(status=304, headers=headers)
+        
+        return Response(cached[2], mimetype='application/json', headers=headers)
     
     
-    # chan: ChanInfo, timeout: integer -> bool
-    def setCountdown(self, chan, timeout):
-        now = time.time()
-        chan.countdownTS = now + timeout
-        chan.countdownVal = timeout
+    @webhook('/titlebot/<channel>/options', methods=('GET', ), raw=True)
+    def web_options(self, request, channel):
+        """vote options of <channel> (without leading '#') as JSON, ?poll=<name> selects the poll, supports If-None-Match"""
         
-        result = False
+        return self.serveJson(request, channel, 'options', PollSnapshot.exportOptions)
+    
+    
+    @webhook('/titlebot/<channel>/results', methods=('GET', ), raw=True)
+    def web_results(self, request, channel):
+        """voting results of <channel> (without leading '#') as JSON, ?poll=<name> selects the poll, supports If-None-Match"""
         
-        if chan not in self.cbChan:
-            self.cbChan.append(chan)
-            
-            result = True
-            
-        self.startPoller()
+        return self.serveJson(request, channel, 'results', PollSnapshot.exportResults)
+    
+    
+    @webhook('/titlebot/<channel>/votes', methods=('GET', ), raw=True)
+    def web_votes(self, request, channel):
+        """vote counts of <channel> (without leading '#') as JSON, ?poll=<name> selects the poll, supports If-None-Match"""
         
-        return result
+        return self.serveJson(request, channel, 'votes', PollSnapshot.exportCounts)
     
     
-    # chan: ChanInfo -> bool
-    def resetCountdown(self, chan):
-        if chan not in self.cbChan:
-            return False
+    @webhook('/titlebot/<channel>/history', methods=('GET', ), raw=True)
+    def web_history(self, request, channel):
+        """vote counts of <channel> (without leading '#') between ?from=<unix time> and ?to=<unix time> (default: the last hour) as JSON: the counts at "from" and the changes after"""
         
-        self.cbChan = [ c for c in self.cbChan if c != chan ]
+        chan = self.findChanInfo(channel)
         
-        chan.resetCountdown()
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
         
-        if len(self.cbChan) == 0:
-            self.stopPoller()
+        poll = chan.findPoll(request.args.get('poll'))
         
-        return True
-
+        if poll is None:
+            return Response(json.dumps({ 'error': 'unknown poll' }), status=404, mimetype='application/json')
+        
+        try:
+            end = float(request.args.get('to', time.time()))
+            begin = float(request.args.get('from', end - 3600))
+        except ValueError:
+            return Response(json.dumps({ 'error': 'invalid time range' }), status=400, mimetype='application/json')
+        
+        return Response(json.dumps(poll.exportHistory(begin, end)), mimetype='application/json', headers={ 'Cache-Control': 'no-cache' })
     
-    def pollCallback(self):
-        now = time.time()
+    
+    @webhook('/titlebot/<channel>/archive', methods=('GET', ), raw=True)
+    def web_archive(self, request, channel):
+        """index of the archived polls of <channel> (without leading '#') as JSON"""
         
-        for chan in self.cbChan:
-            remaining = int(round(chan.countdownTS - now))
-            # ensure no time step is skipped
-            while chan.countdownVal > remaining:
-                chan.countdownVal -= 1
-                self.countdownProcessPoll(chan, chan.countdownVal)
+        chan = self.findChanInfo(channel)
         
-        # cleanup ...
-        # ...timed-out channels
-        self.cbChan = [ c for c in self.cbChan if (c.countdownTS - now) >= 0 ]
-        # ... and poller itself
-        if len(self.cbChan) == 0:
-            self.stopPoller()
-
-
-    # chan: ChanInfo, remaining: integer
-    def countdownProcessPoll(self, chan, remaining):
-        if chan not in self.chans:
-            return # got removed in between
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
+        
+        index = [ { 'id': entry.id, 'poll': entry.poll, 'finished': entry.finished, 'reason': entry.reason, 'options': entry.options, 'voters': entry.voters, 'winner': entry.winner } for entry in chan.archive ]
+        
+        return Response(json.dumps(index), mimetype='application/json')
     
-        room = chan.channel
+    
+    @webhook('/titlebot/<channel>/archive/<int:id>', methods=('GET', ), raw=True)
+    def web_archived(self, request, channel, id):
+        """archived poll <id> of <channel> (without leading '#') as JSON: options, final counts, votes and history. requires the API key of the channel (Authorization: Bearer <key>)"""
         
-        if remaining in [0, -1]: # tolerate rounding errors
-            # time over
-            chan.resetCountdown()
-            chan.enabled = False
+        chan = self.findChanInfo(channel)
+        
+        if chan is not None and not self.testApiKey(request, chan):
+            return Response(json.dumps({ 'error': 'the API key of the channel is required' }), status=403, mimetype='application/json')
+        
+        data = self.storage.loadArchive(str(chan.channel), id) if chan is not None else None
+        
+        if data is None:
+            return Response(json.dumps({ 'error': 'unknown channel or archived poll' }), status=404, mimetype='application/json')
+        
+        # archived polls never change, the stored zlib stream is a valid deflate content encoding. caches keep both encodings apart
+        headers = { 'Cache-Control': 'max-age=86400', 'Vary': 'Accept-Encoding' }
+        
+        if 'deflate' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'deflate'
+        else:
+            data = zlib.decompress(data)
+        
+        return Response(data, mimetype='application/json', headers=headers)
+    
+    
+    @webhook('/titlebot/<channel>/export/<kind>', methods=('GET', ), raw=True)
+    def web_export(self, request, channel, kind):
+        """options, results or votes of <channel> (without leading '#') as streamed CSV or JSON (?format=csv|json), ?poll=<name> selects the poll, ?archive=<id> an archived poll. votes require the API key of the channel (Authorization: Bearer <key>)"""
+        
+        chan = self.findChanInfo(channel)
+        
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
+        
+        fileFormat = request.args.get('format', 'csv')
+        
+        if kind not in Export.KINDS or fileFormat not in Export.FORMATS:
+            return Response(json.dumps({ 'error': 'unknown export or format' }), status=404, mimetype='application/json')
+        
+        if kind == 'votes' and not self.testApiKey(request, chan):
+            return Response(json.dumps({ 'error': 'the API key of the channel is required' }), status=403, mimetype='application/json')
+        
+        if 'archive' in request.args:
+            try:
+                record = self.loadArchived(chan, int(request.args['archive']))
+            except ValueError:
+                record = None
             
-            self.updateChanConfig(chan)
+            if record is None:
+                return Response(json.dumps({ 'error': 'unknown archived poll' }), status=404, mimetype='application/json')
             
-            self.send(room, "----- Countdown expired: Voting has been DISABLED")
-            self.printResults(room, chan)
-        elif remaining <= 5:
-            self.send(room, "----- Countdown: " + str(remaining) + "sec remaining. Time is running out!")
-        elif remaining <  3*10:
-            # 10s steps
-            if remaining % 10 == 0:
-                self.send(room, "----- Countdown: " + str(remaining) + "sec remaining. Hurry up!")
-        elif remaining <= 3*15:
-            # 15s steps
-            if remaining % 15 == 0:
-                self.send(room, "----- Countdown: " + str(remaining) + "sec remaining. We are getting closer ...")
-        elif remaining <= 3*30:
-            # 30s steps
-            if remaining % 30 == 0:
-                self.send(room, "----- Countdown: " + str(remaining) + "sec remaining.")
-        elif remaining <= 3*60:
-            # 1m steps
-            if remaining % 60 == 0:
-                self.send(room, "----- Countdown: " + str(int(remaining / 60)) + "min remaining.")
+            export = Export.fromArchive(int(request.args['archive']), record, kind)
         else:
-            # 5m steps
-            if remaining % (5*60) == 0:
-                self.send(room, "----- Countdown: " + str(int(remaining / 60)) + "min remaining.")
-
-
-    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    def reset(self, msg, channel):
-        """resets (and disables) the voting, drops all options and votes (admin only command)"""
+            poll = chan.findPoll(request.args.get('poll'))
+            
+            if poll is None:
+                return Response(json.dumps({ 'error': 'unknown poll' }), status=404, mimetype='application/json')
+            
+            export = poll.export(kind)
+        
+        headers = { 'Cache-Control': 'no-cache', 'Content-Disposition': 'attachment; filename="' + export.name + '.' + fileFormat + '"' }
+        
+        return Response(export.render(fileFormat), mimetype=Export.FORMATS[fileFormat], headers=headers)
+    
+    
+    # chan: ChanInfo, cursor: string -> int (None: unknown cursor, reload required)
+    def parseCursor(self, chan, cursor):
+        try:
+            epoch, seq = cursor.split('-')
+            
+            if epoch == chan.epoch:
+                return int(seq)
+        except (AttributeError, ValueError):
+            pass
+        
+        return None
+    
+    
+    @webhook('/titlebot/metrics', methods=('GET', ), raw=True)
+    def web_metrics(self, request):
+        """metrics of all channels, the storage and the HSLive forwarders in the Prometheus text format"""
+        
+        out = [ ]
+        
+        def metric(name, kind, help, samples):
+            out.append("# HELP " + name + " " + help)
+            out.append("# TYPE " + name + " " + kind)
+            
+            for labels, value in samples:
+                out.append(name + self.metricLabels(labels) + " " + repr(value))
+        
+        chans = self.chans
+        changes = [ ]
+        
+        for chan in chans:
+            with chan.lock:
+                changes += [ ({ 'channel': str(chan.channel), 'kind': kind }, count) for kind, count in sorted(chan.changes.items()) ]
+        
+        metric('titlebot_changes_total', 'counter', 'State changes per channel and kind (vote, revoke, option, delete, ...), rate(kind="vote") gives the votes per second', changes)
+        metric('titlebot_countdowns_active', 'gauge', 'Running countdowns', [ ({ }, len(self.cbChan)) ])
+        metric('titlebot_options', 'gauge', 'Options held per poll (without deleted options)', [ ({ 'channel': str(chan.channel), 'poll': poll.name }, len(poll.snapshot().live())) for chan in chans for poll in list(chan.polls.values()) ])
+        metric('titlebot_votes', 'gauge', 'Votes held per poll', [ ({ 'channel': str(chan.channel), 'poll': poll.name }, poll.snapshot().voters) for chan in chans for poll in list(chan.polls.values()) ])
+        with self.floodControl.lock:
+            shed = sorted(self.floodControl.shed.items())
+        
+        metric('titlebot_shed_total', 'counter', 'Commands rejected by the flood control by channel, command and reason (user or channel limit)', [ ({ 'channel': channel, 'command': command, 'reason': reason }, count) for (channel, command, reason), count in shed ])
+        metric('titlebot_stream_clients', 'gauge', 'Connected server-sent events listeners', [ ({ }, self.streamClients) ])
+        
+        store = self.storage.metrics
+        storage = 'sqlite' if isinstance(getattr(self.storage, 'storage', self.storage), SqliteStorage) else 'kv'
+        
+        metric('titlebot_store_writes_total', 'counter', 'Write transactions of the storage', [ ({ 'storage': storage }, store.writes) ])
+        metric('titlebot_store_rows_total', 'counter', 'Rows changed by the storage (SQLite only)', [ ({ 'storage': storage }, store.rows) ])
+        metric('titlebot_store_bytes_total', 'counter', 'Bytes written to the errbot key/value store (estimated) or archived as blobs', [ ({ 'storage': storage }, store.bytes) ])
+        
+        workers = [ (chan, chan.streamQueue, chan.streamWorker) for chan in chans ]
+        workers = [ (str(chan.channel), queue, worker) for chan, queue, worker in workers if queue is not None and worker is not None ]
+        
+        metric('titlebot_backlog_lines', 'gauge', 'Forwarded lines kept for the website catch-up', [ ({ 'channel': str(chan.channel) }, len(chan.backlog.lines)) for chan in chans ])
+        metric('titlebot_backlog_bytes', 'gauge', 'Encoded size of the forwarded lines kept for the website catch-up', [ ({ 'channel': str(chan.channel) }, chan.backlog.size) for chan in chans ])
+        metric('titlebot_forward_queue_depth', 'gauge', 'Messages waiting for the HSLive forwarder', [ ({ 'channel': channel }, queue.qsize()) for channel, queue, worker in workers ])
+        metric('titlebot_forward_messages_total', 'counter', 'Messages handled by the HSLive forwarder by result', [ ({ 'channel': channel, 'result': result }, getattr(worker, result)) for channel, queue, worker in workers for result in ('sent', 'failed', 'dropped', 'filtered') ])
+        
+        out.append("# HELP titlebot_forward_post_seconds Request latency of the HSLive forwarder")
+        out.append("# TYPE titlebot_forward_post_seconds histogram")
+        
+        for channel, queue, worker in workers:
+            histogram = worker.latency
+            counts = list(histogram.counts)
+            total = 0
+            
+            for bound, count in zip(Histogram.BOUNDS + [ float('inf') ], counts):
+                total += count
+                out.append("titlebot_forward_post_seconds_bucket" + self.metricLabels({ 'channel': channel, 'le': '{:g}'.format(bound) if bound != float('inf') else '+Inf' }) + " " + str(total))
+            
+            out.append("titlebot_forward_post_seconds_sum" + self.metricLabels({ 'channel': channel }) + " " + repr(histogram.total))
+            out.append("titlebot_forward_post_seconds_count" + self.metricLabels({ 'channel': channel }) + " " + str(total))
+        
+        return Response('\n'.join(out) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8', headers={ 'Cache-Control': 'no-cache' })
+    
+    
+    # labels: dict of string -> string -> string, Prometheus label set
+    def metricLabels(self, labels):
+        if len(labels) == 0:
+            return ""
+        
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        
+        return "{" + ",".join(name + '="' + escape(value) + '"' for name, value in labels.items()) + "}"
+    
+    
+    @webhook('/titlebot/<channel>/events', methods=('GET', ), raw=True)
+    def web_events(self, request, channel):
+        """long-poll for state changes of <channel> (without leading '#') after ?cursor=<cursor>, waits up to ?wait=<seconds> for new events"""
+        
+        chan = self.findChanInfo(channel)
+        
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
+        
+        try:
+            wait = min(max(float(request.args.get('wait', 25)), 0), Titlebot.LONG_POLL_MAX_WAIT)
+        except ValueError:
+            wait = 0
+        
+        cursor = self.parseCursor(chan, request.args.get('cursor'))
+        
+        if cursor is None:
+            seq, events, reset = (chan.events.seq, [ ], True)
+        else:
+            seq, events, reset = chan.events.read(cursor, wait)
+            reset = reset or chan.events.closed
+        
+        body = '{"cursor": ' + json.dumps(chan.epoch + '-' + str(seq)) + ', "reset": ' + json.dumps(reset) + ', "events": [' + ', '.join(events) + ']}'
+        
+        return Response(body, mimetype='application/json', headers={ 'Cache-Control': 'no-cache' })
+    
+    
+    @webhook('/titlebot/<channel>/backlog', methods=('GET', ), raw=True)
+    def web_backlog(self, request, channel):
+        """the recent lines forwarded to HSLive from <channel> (without leading '#') after ?cursor=<cursor>, requires the API key"""
         
-        try:
-            room, chan = self.parseParams(msg, channel)
-        except ValueError as e:
-            return
+        chan = self.findChanInfo(channel)
         
-        if not self.testAdmin(msg.frm, chan):
-            return
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
         
-        self.resetCountdown(chan)
-        chan.reset()
+        if not self.testApiKey(request, chan):
+            return Response(json.dumps({ 'error': 'the API key of the channel is required' }), status=403, mimetype='application/json')
         
-        self.updateChanConfig(chan)
+        seq, lines, gap = chan.backlog.read(self.parseCursor(chan, request.args.get('cursor')))
         
-        self.send(room, "----- All votes have been reset -----")
-
-
-    @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
-    @arg_botcmd('--public', '-p', action='store_true', help='send list public to channel (default: private as query/direct message)')
-    @arg_botcmd('sListMode', metavar='list_mode', nargs='?', type=str, default='options', choices=['options', 'results', 'votes'], help='listing modes: options, results, votes')
-    def list(self, msg, channel, public, sListMode):
-        """lists vote options, voting results or individual votes optionally public in channel (otherwise as query/direct message). admin-only: individual votes and public listing"""
+        body = '{"cursor": ' + json.dumps(chan.epoch + '-' + str(seq)) + ', "gap": ' + json.dumps(gap) + ', "lines": [' + ', '.join(lines) + ']}'
         
-        try:
-            room, chan = self.parseParams(msg, channel)
-        except ValueError as e:
-            return
+        return Response(body, mimetype='application/json', headers={ 'Cache-Control': 'no-cache' })
+    
+    
+    @webhook('/titlebot/<channel>/stream', methods=('GET', ), raw=True)
+    def web_stream(self, request, channel):
+        """server-sent events stream of the state changes of <channel> (without leading '#'), resumes after the Last-Event-ID header"""
         
-        if (public or sListMode == "votes") and not self.testAdmin(msg.frm, chan):
-            return
+        chan = self.findChanInfo(channel)
         
-        msgTo = msg.frm if not public else room
+        if chan is None:
+            return Response(json.dumps({ 'error': 'unknown channel' }), status=404, mimetype='application/json')
         
-        if sListMode == "options":
-            self.printOptions(msgTo, chan)
-        elif sListMode == "results":
-            self.printResults(msgTo, chan)
-        elif sListMode == "votes":
-            self.printVotes(msgTo, chan)
-
-
-    # msgTo: Identity, chanInfo: chanInfo
-    def printOptions(self, msgTo, chanInfo):
-        out = [ ]
+        config = self.config if self.config is not None else Titlebot.CONFIG_TEMPLATE
         
-        out.append("----- Vote options (first number: id) -----")
+        with self.streamLock:
+            if self.streamClients >= config['STREAM_CLIENTS']:
+                return Response(json.dumps({ 'error': 'too many listeners, use /events' }), status=503, mimetype='application/json')
+            
+            self.streamClients += 1
         
-        for option in chanInfo.options:
-            if not option.deleted:
-                out.append("  " + str(option.id + 1) + ") " + option.text + " (" + str(option.votes) + " votes)")
+        cursor = self.parseCursor(chan, request.headers.get('Last-Event-ID', request.args.get('cursor')))
         
-        out.append("----- Vote options end -----")
+        def stream(cursor):
+            try:
+                if cursor is None:
+                    # unknown position, the listener has to load the current state and continue from here
+                    cursor = chan.events.seq
+                    
+                    yield 'id: ' + chan.epoch + '-' + str(cursor) + '\nevent: reset\ndata: {}\n\n'
+                
+                while True:
+                    seq, events, reset = chan.events.read(cursor, Titlebot.STREAM_KEEPALIVE)
+                    
+                    if reset or chan.events.closed:
+                        yield 'event: reset\ndata: {}\n\n'
+                        return # the listener reconnects without Last-Event-ID
+                    
+                    if len(events) == 0:
+                        yield ': keepalive\n\n'
+                    
+                    for index, event in enumerate(events):
+                        yield 'id: ' + chan.epoch + '-' + str(seq - len(events) + index + 1) + '\ndata: ' + event + '\n\n'
+                    
+                    cursor = seq
+            finally:
+                with self.streamLock:
+                    self.streamClients -= 1
         
-        self.send(msgTo, '\n'.join(out))
-
-
-    # msgTo: Identity, chanInfo: chanInfo
-    def printResults(self, msgTo, chanInfo):
-        out = [ ]
+        return Response(stream(cursor), mimetype='text/event-stream', headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+    
+    
+    @timedCommand
+    @arg_botcmd('op', metavar='operation', nargs='?', type=str, default='show', choices=['show', 'on', 'off', 'reset'], help='operations: show, on, off, reset. default=show')
+    def tb_stats(self, msg, op):
+        """ shows the latency percentiles of the bot commands and their phases, on/off toggles the recording (owner-only command) """
         
-        options = chanInfo.options.copy()
-        options.sort(key=lambda option :option.votes, reverse=True)
+        if not self.testOwner(msg):
+            return
         
-        out.append("----- Vote results (first number is the placement, NOT the id) -----")
+        if op == "on" or op == "off":
+            self.setStats(op == "on")
+            self.send(msg.frm, "Command statistics " + ("enabled" if op == "on" else "disabled"))
+            return
         
-        index = 1
-        for option in options:
-            if not option.deleted and option.votes > 0:
-                out.append("  " + str(index) + ". " + option.text + " (Option " + str(option.id + 1) + " with " + str(option.votes) + " votes)")
-                index += 1
+        if op == "reset":
+            self.stats.reset()
+            self.send(msg.frm, "Command statistics cleared")
+            return
         
-        out.append("----- Vote results end -----")
+        ms = lambda seconds: '{:.2f}'.format(1000 * seconds)
+        state = "recording" if self.stats.enabled else "disabled, see: !tb stats on"
         
-        self.send(msgTo, '\n'.join(out))
-
-
-    # msgTo: Identity, chanInfo: chanInfo
-    def printVotes(self, msgTo, chanInfo):
         out = [ ]
-        options = [ ]
+        out.append("----- Command latency in ms since " + time.strftime('%Y-%m-%d %H:%M', time.localtime(self.stats.since)) + " (" + state + ") -----")
+        
+        for command, histogram, phases in self.stats.snapshot():
+            out.append("  " + command + ": " + str(histogram.count) + " calls, p50 " + ms(histogram.percentile(0.5)) + ", p90 " + ms(histogram.percentile(0.9)) + ", p99 " + ms(histogram.percentile(0.99)) + ", max " + ms(histogram.max))
+            out.append("    phases (mean/p99): " + ", ".join(name + " " + ms(phase.total / histogram.count) + "/" + ms(phase.percentile(0.99)) for name, phase in phases.items()))
+        
+        shed = self.floodControl.shedCounts()
         
-        for i in range(len(chanInfo.options)):
-            options.append([ ])
+        if len(shed) > 0:
+            out.append("  shed by flood control: " + ", ".join(command + " " + str(count) + " (" + reason + ")" for (command, reason), count in shed.most_common()))
         
-        for vote in chanInfo.userVotes:
-            options[vote.option].append(vote)
+        if len(self.pendingRooms) > 0:
+            out.append("  channels waiting for their restore: " + str(len(self.pendingRooms)))
+        elif self.restoreTime >= 0:
+            out.append("  channels restored in " + ms(self.restoreTime) + " ms")
+        
+        out.append("----- Command latency end -----")
+        
+        self.send(msg.frm, '\n'.join(out))
+    
+    
+    # enabled: bool
+    def setStats(self, enabled):
+        self.stats.enabled = enabled
+        
+        # the storage calls are only wrapped while recording, nothing is timed otherwise
+        storage = self.storage.storage if isinstance(self.storage, TimedStorage) else self.storage
+        self.storage = TimedStorage(storage, self.stats) if enabled else storage
+    
+    
+    @timedCommand
+    @arg_botcmd('--interval', '-i', dest='interval', type=int, default=10, help='milliseconds between two samples. default=10')
+    @arg_botcmd('duration', metavar='seconds', nargs='?', type=str, default='30', help='seconds to sample or stop to finish a running profile early. default=30')
+    def tb_profile(self, msg, duration, interval):
+        """ samples the stacks of all plugin threads for some seconds and writes them to a folded stacks file for flame graphs (owner-only command) """
         
-        out.append("----- Vote list begin -----")
+        if not self.testOwner(msg):
+            return
         
-        for optionId, votes in enumerate(options):
-            option = chanInfo.options[optionId]
+        with self.pollLock:
+            profiler = self.profiler
             
-            if option.votes > 0:
-                out.append("  Option " + str(optionId + 1) + " (deleted=" + str(option.deleted) + "): " + option.text)
+            if duration == "stop":
+                if profiler is None:
+                    self.send(msg.frm, "No profile is running")
+                else:
+                    profiler.stopped.set()
+                
+                return
             
-                for vote in votes:
-                    out.append("    " + str(vote.user))
-        
-        out.append("----- Vote list end -----")
+            if profiler is not None:
+                self.send(msg.frm, "A profile is already running, writing to " + profiler.path + ". see: !tb profile stop")
+                return
+            
+            try:
+                seconds = float(duration)
+            except ValueError:
+                seconds = -1
+            
+            if not 0 < seconds <= Titlebot.PROFILE_MAX_DURATION or not 1 <= interval <= 1000:
+                self.badArgs(msg, "the duration must be between 0 and " + str(Titlebot.PROFILE_MAX_DURATION) + " seconds, the interval between 1 and 1000 ms")
+                return
+            
+            path = os.path.join(self.bot_config.BOT_DATA_DIR, 'titlebot-profile-' + time.strftime('%Y%m%d-%H%M%S') + '.folded')
+            user = msg.frm
+            
+            def done(profiler):
+                with self.pollLock:
+                    if self.profiler is profiler:
+                        self.profiler = None
+                
+                if profiler.error is not None:
+                    self.send(user, "Profile failed, " + path + " could not be written: " + str(profiler.error))
+                else:
+                    self.send(user, "Profile finished: " + str(profiler.samples) + " samples, " + str(len(profiler.stacks)) + " distinct stacks written to " + path)
+            
+            self.profiler = SamplingProfiler(seconds, interval / 1000, path, done)
+            self.profiler.start()
         
-        self.send(msgTo, '\n'.join(out))
+        self.send(msg.frm, "Profiling all plugin threads for " + duration + " seconds every " + str(interval) + " ms, see: !tb profile stop")
     
     
     @botcmd
@@ -832,31 +4850,52 @@ class Titlebot(BotPlugin):
             for admin in info.admins:
                 out.append("    admin: " + admin)
             out.append("  ----- admins end -----")
-            out.append("  ----- options begin -----")
-            # options       list of VotingOption
-            for option in info.options:
-                out.append("    id: " + str(option.id))
-                out.append("    text: " + option.text)
-                out.append("    votes: " + str(option.votes))
-                out.append("    deleted: " + str(option.deleted))
-                out.append("    ----------")
-            out.append("  ----- options end -----")
-            out.append("  ----- userVotes begin -----")
-            # userVotes     list of UserVote
-            for userVote in info.userVotes:
-                out.append("    " + str(userVote.user) + " -> " + str(userVote.option))
-            out.append("  ----- userVotes end -----")
-            out.append("  enabled: " + str(info.enabled))
+            out.append("  default poll: " + info.defaultPoll)
+            out.append("  duplicates rejected: " + str(info.duplicates))
+            out.append("  similarity: " + str(info.similarity))
+            out.append("  quick votes: " + str(info.quickVotes))
+            out.append("  flood limits: " + str(info.floodUser) + "/min per user, " + str(info.floodChannel) + "/s per channel")
+            # polls         dict of string -> Poll
+            for poll in info.polls.values():
+                snapshot = poll.snapshot()
+                out.append("  ----- poll " + poll.name + " begin -----")
+                out.append("  ----- options begin -----")
+                # options       tuple of VotingOption
+                for option in snapshot.options:
+                    out.append("    id: " + str(option.id))
+                    out.append("    text: " + option.text)
+                    out.append("    votes: " + str(option.votes))
+                    out.append("    deleted: " + str(option.deleted))
+                    out.append("    ----------")
+                out.append("  ----- options end -----")
+                out.append("  ----- userVotes begin -----")
+                # votes         tuple of UserVote
+                for userVote in snapshot.votes:
+                    out.append("    " + userVote.name + " (" + str(userVote.uid) + ") -> " + " ".join(str(option) for option in userVote.ballot))
+                out.append("  ----- userVotes end -----")
+                out.append("  enabled: " + str(snapshot.enabled))
+                out.append("  mode: " + snapshot.mode)
+                out.append("  ----- poll " + poll.name + " end -----")
+            for problem in info.verify():
+                out.append("  INCONSISTENT: " + problem)
             out.append("----------")
         
         out.append("----- callback polling chans -----")
         out.append("  polling: " + str(self.polling))
-        for info in self.cbChan:
+        for poll in self.cbChan:
+            out.append("  name: " + str(poll.chan.channel))
+            out.append("  poll: " + poll.name)
+            out.append("----------")
+        
+        out.append("----- digest polling chans -----")
+        for info in self.dgChan:
             out.append("  name: " + str(info.channel))
+            out.append("  interval: " + str(info.digestInterval))
+            out.append("  top: " + str(info.digestTop))
             out.append("----------")
         
         out.append("----- config -----")
-        ccfg = self.tryLoadCfg()
+        ccfg = self.storage.loadAll()
         for cfg in ccfg:
             out.append("  name: " + cfg.channel)
             out.append("  API key: " + str(cfg.apiKey))
@@ -865,20 +4904,27 @@ class Titlebot(BotPlugin):
             for admin in cfg.admins:
                 out.append("    admin: " + admin)
             out.append("  ----- admins end -----")
-            # options       list of VotingOption
-            for option in cfg.options:
-                out.append("    id: " + str(option.id))
-                out.append("    text: " + option.text)
-                out.append("    votes: " + str(option.votes))
-                out.append("    deleted: " + str(option.deleted))
-                out.append("    ----------")
-            out.append("  ----- options end -----")
-            out.append("  ----- userVotes begin -----")
-            # userVotes     list of PersistedVote
-            for userVote in cfg.userVotes:
-                out.append("    " + userVote.user + " -> " + str(userVote.option))
-            out.append("  ----- userVotes end -----")
-            out.append("  enabled: " + str(cfg.enabled))
+            out.append("  default poll: " + cfg.defaultPoll)
+            # polls         list of PollConfig
+            for poll in cfg.polls:
+                out.append("  ----- poll " + poll.name + " begin -----")
+                out.append("  ----- options begin -----")
+                # options       list of VotingOption
+                for option in poll.options:
+                    out.append("    id: " + str(option.id))
+                    out.append("    text: " + option.text)
+                    out.append("    votes: " + str(option.votes))
+                    out.append("    deleted: " + str(option.deleted))
+                    out.append("    ----------")
+                out.append("  ----- options end -----")
+                out.append("  ----- userVotes begin -----")
+                # userVotes     list of PersistedVote
+                for userVote in poll.userVotes:
+                    out.append("    " + userVote.user + " -> " + " ".join(str(option) for option in (getattr(userVote, 'ballot', None) or (userVote.option, ))))
+                out.append("  ----- userVotes end -----")
+                out.append("  enabled: " + str(poll.enabled))
+                out.append("  mode: " + getattr(poll, 'mode', 'single'))
+                out.append("  ----- poll " + poll.name + " end -----")
             out.append("----------")
         
         out.append("----- dump end -----")
@@ -897,6 +4943,7 @@ class Titlebot(BotPlugin):
     
     
     # msg: Message, channel: String -> Room
+    @timedPhase('resolve')
     def inferAdminChannel(self, msg, channel):
         if channel is not None:
             return self.lookupChannel(msg, channel)
@@ -911,24 +4958,71 @@ class Titlebot(BotPlugin):
                 return None
     
     
-    # -> list of ChanConfig
-    def tryLoadCfg(self):
-        try:
-            return self['ccfg']
-        except:
-            return [ ]
+    def get_configuration_template(self):
+        return Titlebot.CONFIG_TEMPLATE
+    
     
+    def configure(self, configuration):
+        config = dict(Titlebot.CONFIG_TEMPLATE)
+        
+        if configuration is not None:
+            config.update(configuration)
+        
+        super(Titlebot, self).configure(config)
     
     
-    # chan: ChanInfo
-    def updateChanConfig(self, chan):
-        ccfg = self.tryLoadCfg()
-        ccfg[:] = [ cfg for cfg in ccfg if cfg.channel != str(chan.channel) ]
-        ccfg.append(chan.exportConfig())
-        self['ccfg'] = ccfg
+    # -> (string, float), URL and request timeout of the HSLive Slack Streaming forwarder
+    def forwardTarget(self):
+        config = self.config if self.config is not None else Titlebot.CONFIG_TEMPLATE
+        
+        return (config['HSLIVE_URL'], config['HSLIVE_TIMEOUT'])
+    
+    
+    # -> KVStorage or SqliteStorage
+    def openStorage(self):
+        config = self.config if self.config is not None else Titlebot.CONFIG_TEMPLATE
+        
+        self.instance = None
+        
+        if config['STORAGE'] == 'kv':
+            if config['SHARED']:
+                self.log.warning("sharing the state with other bot processes requires the SQLite storage")
+            
+            return KVStorage(self)
+        
+        if config['STORAGE'] != 'sqlite':
+            self.log.warning("unknown storage " + str(config['STORAGE']) + ", using the errbot key/value store")
+            
+            return KVStorage(self)
+        
+        path = config['SQLITE_PATH']
+        
+        if not path:
+            path = os.path.join(self.bot_config.BOT_DATA_DIR, 'titlebot.sqlite')
+        
+        storage = SqliteStorage(path)
+        
+        if config['SHARED']:
+            self.instance = config['INSTANCE'] or socket.gethostname() + ":" + str(os.getpid())
+            self.leaseTime = config['LEASE_TIME']
+            
+            storage.enableNotifications(self.instance)
+        
+        if storage.isEmpty():
+            # first start with SQLite, migrate the configuration kept in the errbot key/value store
+            ccfg = KVStorage(self).loadAll()
+            
+            if len(ccfg) > 0:
+                storage.importConfigs(ccfg)
+                
+                self.log.info("migrated " + str(len(ccfg)) + " channels from the errbot key/value store to " + path)
+        
+        return storage
     
     
     
+    @timedCommand
+    @limitedCommand('admin')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
     @arg_botcmd('-o', '--oldname', type=str, help='old channel name, required for operation "mv"')
     @arg_botcmd('op', metavar='operation', type=str, choices=['add', 'rm', 'mv'], help='operations: add, rm, mv')
@@ -960,34 +5054,34 @@ class Titlebot(BotPlugin):
         if room is None:
             return
         
-        for chan in self.chans:
-            if chan.channel == room:
-                self.send(msg.frm, "Channel is already configured")
-                
-                return
-        
-        ccfg = self.tryLoadCfg()
-        
-        for cfg in ccfg:
-            if cfg.channel == channel:
+        with self.chansLock:
+            for chan in self.chans:
+                if chan.channel == room:
+                    self.send(msg.frm, "Channel is already configured")
+                    
+                    return
+            
+            chan = ChanInfo(room, [], None, self.identities)
+            
+            if not self.storage.addChannel(chan.exportConfig()):
                 self.send(msg.frm, "Channel is already configured")
                 
                 return
-        
-        chan = ChanInfo(room, [], None)
-        self.chans.append(chan)
-        ccfg.append(chan.exportConfig())
-        
-        self['ccfg'] = ccfg
+            
+            if self.instance is not None:
+                self.storage.acquireLease(str(room), self.instance, self.leaseTime)
+            
+            self.chans = self.chans + [ chan ]
         
         self.send(room, "titlebot was configured to serve in this channel by " + str(msg.frm.person))
     
     
     # msg: Message, channel: String
     def doRemoveChannel(self, msg, channel):        
-        ccfg = self.tryLoadCfg()
-        ccfg[:] = [ cfg for cfg in ccfg if cfg.channel != channel ]
-        self['ccfg'] = ccfg
+        self.storage.removeChannel(channel)
+        
+        if self.instance is not None:
+            self.storage.releaseLease(channel, self.instance)
         
         room = None
         
@@ -1014,16 +5108,16 @@ class Titlebot(BotPlugin):
                 
                 return
         
-        ccfg = self.tryLoadCfg()
-        
-        chan_cfg = [ cfg for cfg in ccfg if cfg.channel == oldname ]
-        ccfg[:] = [ cfg for cfg in ccfg if cfg.channel != oldname ]
+        chan_cfg = self.storage.removeChannel(oldname)
         
-        if len(chan_cfg) == 1:
-            chan = ChanInfo(room, chan_cfg[0].admins, chan_cfg[apiKey]) # safe, because channel was unconfigured before
-            ccfg.append(chan.exportConfig())
+        if chan_cfg is not None:
+            chan_cfg.upgrade()
+            chan_cfg.channel = str(room) # safe, because channel was unconfigured before
             
-            self['ccfg'] = ccfg
+            for poll in chan_cfg.polls:
+                poll.channel = str(room)
+            
+            self.storage.storeConfig(chan_cfg)
             
             self.tryAddRoom(room) # join officially and setup internal state
             
@@ -1032,6 +5126,8 @@ class Titlebot(BotPlugin):
             self.send(msg.frm, "error: a channel named " + oldname + " has not been configured previously")
     
     
+    @timedCommand
+    @limitedCommand('admin')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
     @arg_botcmd('lAdmins', metavar='admins', nargs='+', type=str, help='a list of admins')
     @arg_botcmd('op', metavar='operation', type=str, choices=['add', 'rm'], help='operations: add, rm')
@@ -1059,17 +5155,20 @@ class Titlebot(BotPlugin):
             
             return
         
-        for admin in lAdmins:
-            if op == "add":
-                chan.addAdmin(admin)
-            else:
-                chan.delAdmin(admin)
-        
-        self.updateChanConfig(chan)
+        with chan.lock:
+            for admin in lAdmins:
+                if op == "add":
+                    chan.addAdmin(admin)
+                else:
+                    chan.delAdmin(admin)
+            
+            self.storage.storeSettings(chan)
         
         self.send(msg.frm, "admins configured")
     
     
+    @timedCommand
+    @limitedCommand('admin')
     @arg_botcmd('-c', '--channel', type=str, help='required if you send the command as query/direct message')
     @arg_botcmd('key', nargs='?', type=str, help='HSLive Slack Streaming API-Key, a sequence of characters and numbers')
     def tb_apikey(self, msg, channel, key):
@@ -1087,20 +5186,102 @@ class Titlebot(BotPlugin):
         if chan is None:
             return        
         
-        chan.changeStreamingAPIKey(self.log, key)
-        
-        self.updateChanConfig(chan)
+        with chan.lock:
+            chan.changeStreamingAPIKey(self.log, key, self.forwardTarget())
+            
+            self.storage.storeSettings(chan)
         
         self.send(msg.frm, "HSLive Slack Stream API Key configured")
     
     
-    # room: Room
-    def tryAddRoom(self, room):
+    # room: Room, announce: bool, preloaded: ChanConfig (None: loaded from the storage)
+    def tryAddRoom(self, room, announce = True, preloaded = None):
+        with self.chansLock:
+            self.pendingRooms.pop(str(room), None)
+            self.doAddRoom(room, announce, preloaded)
+    
+    
+    # restores the rooms in the background, the bot answers meanwhile. a room is restored right away once a command,
+    # message or webhook request needs it (see awaitRoom), so it only waits for its own channel
+    # rooms: list of Room
+    def restoreRooms(self, rooms):
+        with self.chansLock:
+            served = { str(chan.channel) for chan in self.chans }
+            
+            for room in rooms:
+                if str(room) not in served:
+                    self.pendingRooms[str(room)] = room
+            
+            if len(self.pendingRooms) == 0 or self.restorer is not None:
+                return
+            
+            self.restored.clear()
+            self.restoreTime = -1
+            self.restorer = Thread(target=self.restorePending, name='titlebot-restore', daemon=True)
+            self.restorer.start()
+    
+    
+    # runs in the restorer thread until no room is pending
+    def restorePending(self):
+        begin = time.perf_counter()
+        count = 0
+        
+        # loaded at once, the key/value storage would unpickle all channels for every single one
+        pending = set(self.pendingRooms)
+        configs = { cfg.channel: cfg for cfg in self.storage.loadAll() if cfg.channel in pending }
+        
+        while True:
+            with self.chansLock:
+                if len(self.pendingRooms) == 0:
+                    self.restorer = None
+                    self.restoreTime = time.perf_counter() - begin
+                    self.restored.set()
+                    break
+                
+                name, room = next(iter(self.pendingRooms.items()))
+                
+                try:
+                    # the configs of pending rooms only change once they have been restored
+                    self.tryAddRoom(room, True, configs.pop(name, None))
+                    count += 1
+                except Exception:
+                    self.pendingRooms.pop(name, None)
+                    self.log.exception("failed to restore room " + name)
+        
+        self.log.info("restored " + str(count) + " rooms in " + '{:.2f}'.format(self.restoreTime) + "s")
+    
+    
+    # room: Room or string
+    def awaitRoom(self, room):
+        if len(self.pendingRooms) == 0:
+            return # fast path, checked without locking
+        
+        with self.chansLock:
+            pending = self.pendingRooms.get(str(room))
+            
+            if pending is not None:
+                self.tryAddRoom(pending)
+    
+    
+    # room: Room, announce: bool, preloaded: ChanConfig (None: loaded from the storage)
+    def doAddRoom(self, room, announce, preloaded):
         if len( [ chan for chan in self.chans if chan.channel == room ] ) > 0:
             return
         
-        ccfg = self.tryLoadCfg()
-        candidate = [ cfg for cfg in ccfg if cfg.channel == str(room) ]
+        candidate = [ preloaded if preloaded is not None else self.storage.loadChannel(str(room)) ]
+        candidate = [ cfg for cfg in candidate if cfg is not None ]
+        
+        if len(candidate) > 0 and self.instance is not None:
+            if not self.storage.acquireLease(str(room), self.instance, self.leaseTime):
+                self.foreignChans.add(str(room))
+                
+                return # served by another bot process
+            
+            self.foreignChans.discard(str(room))
+            
+            # reload, the previous owner might have changed the channel in between
+            self.knownVersions[str(room)] = self.storage.versions().get(str(room), (0, None))[0]
+            candidate = [ self.storage.loadChannel(str(room)) ]
         
         if len(candidate) > 0:
             try:
@@ -1114,46 +5295,161 @@ class Titlebot(BotPlugin):
                 apiKey = None
             
             try:
-                enabled = candidate[0].enabled
-                options = candidate[0].options
-                persistedVotes = candidate[0].userVotes 
-                userVotes = []
+                digestInterval = candidate[0].digestInterval
+                digestTop = candidate[0].digestTop
+            except AttributeError:
+                digestInterval = -1
+                digestTop = 5
+            
+            try:
+                duplicates = candidate[0].duplicates
+                similarity = candidate[0].similarity
+            except AttributeError:
+                duplicates = True
+                similarity = 0
+            
+            quickVotes = getattr(candidate[0], 'quickVotes', False)
+            floodUser = getattr(candidate[0], 'floodUser', -1)
+            floodChannel = getattr(candidate[0], 'floodChannel', -1)
+            
+            config = candidate[0].upgrade()
+            occupants = { str(occupant.person): occupant for occupant in room.occupants }
+            
+            chan = ChanInfo(room, admins, apiKey, self.identities)
+            chan.duplicates = duplicates
+            chan.similarity = similarity
+            chan.quickVotes = quickVotes
+            chan.floodUser = floodUser
+            chan.floodChannel = floodChannel
+            chan.archive = self.storage.loadArchiveIndex(str(room))
+            chan.polls = { }
+            droppedVotes = { }
+            
+            for pollCfg in config.polls:
+                poll = Poll(chan, pollCfg.name)
+                poll.enabled = pollCfg.enabled
+                poll.countdownTS = pollCfg.countdownTS
+                poll.tally = Tally(getattr(pollCfg, 'mode', 'single'))
+                poll.setOptions(pollCfg.options, getattr(pollCfg, 'nextOption', len(pollCfg.options)))
+                droppedVotes[poll.name] = [ ]
                 
-                for pVote in persistedVotes:
-                    occupants = [ occupant for occupant in room.occupants if pVote.user == str(occupant.person) ]
+                for pVote in pollCfg.userVotes:
+                    ballot = getattr(pVote, 'ballot', None) or (pVote.option, )
                     
-                    if len(occupants) > 0:
-                        userVotes.append(UserVote(occupants[0], pVote.option))
-                    else:
-                        options[pVote.option].votes -= 1
+                    if pVote.user not in occupants:
+                        droppedVotes[poll.name].append(pVote.user)
                         
-                        self.log.info("unable to find user " + pVote.user + " dropping vote for option " + str(pVote.option))
-            except AttributeError:
-                enabled = False
-                options = []
-                userVotes = []
+                        self.log.info("unable to find user " + pVote.user + " dropping vote for option " + str(pVote.option) + " of poll " + poll.name)
+                    elif not poll.restoreVote(occupants[pVote.user], ballot):
+                        droppedVotes[poll.name].append(pVote.user)
+                
+                poll.restartHistory()
+                chan.polls[poll.name] = poll
+            
+            if len(chan.polls) == 0:
+                chan.polls[ChanInfo.DEFAULT_POLL] = Poll(chan, ChanInfo.DEFAULT_POLL)
             
-            chan = ChanInfo(room, admins, apiKey)
-            chan.enabled = enabled
-            chan.options = options
-            chan.userVotes = userVotes
+            if config.defaultPoll in chan.polls:
+                chan.defaultPoll = config.defaultPoll
+            else:
+                chan.defaultPoll = sorted(chan.polls.keys())[0]
+            
+            self.chans = self.chans + [ chan ]
+            
+            for poll in chan.polls.values():
+                if len(droppedVotes[poll.name]) > 0:
+                    self.storage.dropVotes(poll, droppedVotes[poll.name])
+                
+                self.compactPoll(poll)
+                
+                if poll.enabled and poll.countdownTS > time.time():
+                    countdownTS = poll.countdownTS
+                    poll.countdownTS = -1
+                    
+                    self.setCountdown(poll, int(round(countdownTS - time.time())))
+                elif poll.countdownTS >= 0:
+                    # expired while the bot was away, not published as a change
+                    poll.countdownTS = -1
+                    poll.publish()
             
-            self.chans.append(chan)
+            if digestInterval > 0:
+                self.setDigest(chan, digestInterval, digestTop)
             
-            if enabled:
+            if announce and len([ poll for poll in chan.polls.values() if poll.enabled ]) > 0:
                 self.send(room, "Oops, titlebot reconnected/restarted during running poll. Options and votes have been restored. Voting is ENABLED again.")
             
-            chan.setupSlackStreaming(self.log)
+            chan.setupSlackStreaming(self.log, self.forwardTarget())
         else:
             self.log.info("ignored unconfigured room " + str(room))
     
     
     def tryDisableRoom(self, room):
+        with self.chansLock:
+            for chan in self.chans:
+                if room == chan.channel:
+                    chan.stopSlackStreaming()
+                    self.resetDigest(chan)
+                    
+                    for poll in chan.polls.values():
+                        self.resetCountdown(poll)
+                    
+                    chan.events.close()
+            
+            self.chans = [ chan for chan in self.chans if room != chan.channel ]
+            self.evictWebCache(str(room))
+    
+    
+    def sharedCallback(self):
+        now = time.time()
+        leases = self.storage.leases()
+        
+        # keep the leases of the served channels, drop channels taken over by another bot process
         for chan in self.chans:
-            if room == chan.channel:
-                chan.stopSlackStreaming()
+            name = str(chan.channel)
+            owner, expires = leases.get(name, (None, 0))
+            
+            if owner == self.instance and expires - now > self.leaseTime / 3:
+                continue
+            
+            if owner != self.instance or not self.storage.acquireLease(name, self.instance, self.leaseTime):
+                self.log.warning("lost the lease of channel " + name + " to bot process " + str(owner))
+                
+                with self.chansLock:
+                    self.tryDisableRoom(chan.channel)
+                    self.foreignChans.add(name)
         
-        self.chans[:] = [ chan for chan in self.chans if room != chan.channel ]
+        # take over channels whose bot process has stopped renewing its lease, including channels another process
+        # configured after this one had started
+        for room in self.rooms():
+            name = str(room)
+            
+            if name in leases and leases[name][0] != self.instance:
+                self.foreignChans.add(name)
+            
+            if name in self.foreignChans and leases.get(name, (None, 0))[1] < now:
+                self.tryAddRoom(room)
+                
+                if name not in self.foreignChans:
+                    self.log.warning("took over channel " + name + " from bot process " + str(leases.get(name, (None, 0))[0]))
+        
+        # reload served channels changed by another bot process
+        versions = self.storage.versions()
+        
+        for chan in self.chans:
+            name = str(chan.channel)
+            version, writer = versions.get(name, (0, None))
+            
+            if version == self.knownVersions.get(name, 0):
+                continue
+            
+            self.knownVersions[name] = version
+            
+            if writer != self.instance:
+                self.log.info("channel " + name + " has been changed by bot process " + str(writer) + ", reloading")
+                
+                with self.chansLock:
+                    self.tryDisableRoom(chan.channel)
+                    self.tryAddRoom(chan.channel, False)
     
     
     def activate(self):
@@ -1164,8 +5460,19 @@ class Titlebot(BotPlugin):
         
         self.resetState()
         
-        for room in self.rooms():
-            self.tryAddRoom(room)
+        self.storage = self.openStorage()
+        self.foreignChans = set()
+        
+        config = self.config if self.config is not None else Titlebot.CONFIG_TEMPLATE
+        self.setStats(self.stats.enabled or config['COMMAND_STATS'])
+        self.floodControl.userLimit = config['FLOOD_USER']
+        self.floodControl.chanLimit = config['FLOOD_CHANNEL']
+        self.knownVersions = { }
+        
+        self.restoreRooms(self.rooms())
+        
+        if self.instance is not None:
+            self.start_poller(1, self.sharedCallback)
 
 
     def deactivate(self):
@@ -1175,8 +5482,27 @@ class Titlebot(BotPlugin):
         
         self.stopPoller()
         
+        if self.instance is not None:
+            self.stop_poller(self.sharedCallback)
+        
+        with self.pollLock:
+            if self.profiler is not None:
+                self.profiler.stopped.set()
+        
+        with self.chansLock:
+            self.pendingRooms = { }
+            restorer = self.restorer
+        
+        if restorer is not None:
+            restorer.join() # finishes the room it is restoring
+        
         for chan in self.chans:
             self.tryDisableRoom(chan.channel)
+            
+            if self.instance is not None:
+                self.storage.releaseLease(str(chan.channel), self.instance)
+        
+        self.storage.close()
         
         super(Titlebot, self).deactivate()
 
@@ -1186,8 +5512,7 @@ class Titlebot(BotPlugin):
         Triggers when bot is connected
         """
         
-        for room in self.rooms():
-            self.tryAddRoom(room)
+        self.restoreRooms(self.rooms())
 
 
     def callback_room_joined(self, room):
@@ -1230,14 +5555,66 @@ class Titlebot(BotPlugin):
             self.log.info("filtering direct msg")
             return
         
+        self.awaitRoom(msg.to)
+        
         # find channel
         for chan in self.chans:
             if chan.channel == msg.to:
+                if chan.quickVotes and self.quickVote(chan, msg):
+                    return # votes are not forwarded
+                
                 # filter out bot commands
                 if not msg.body.lstrip().startswith(self.bot_config.BOT_PREFIX):
                     chan.streamMsg(msg)
 
 
+    # applies a quick vote ("+3", or "3" while voting is enabled) without command parsing, it is confirmed by the poller
+    # chan: ChanInfo, msg: Message -> bool (True: the message is a vote)
+    def quickVote(self, chan, msg):
+        text = msg.body.strip()
+        explicit = text.startswith('+')
+        number = text[1:] if explicit else text
+        
+        if not number.isascii() or not number.isdigit() or len(number) > 9:
+            return False
+        
+        option = int(number)
+        poll = chan.polls.get(chan.defaultPoll)
+        
+        if poll is None or not (poll.enabled or explicit):
+            return False
+        
+        if not self.admitCommand(msg, 'quickvote', 'vote', chan, True):
+            return True # shed, still a vote
+        
+        with chan.lock:
+            poll = chan.polls.get(chan.defaultPoll)
+            
+            if poll is None:
+                return True
+            
+            result = None
+            
+            # option 0 is no option
+            if poll.enabled and option < 1:
+                result = (False, None)
+            elif poll.enabled:
+                result = poll.vote(msg.frm, option - 1)
+                
+                if result[0]:
+                    self.storage.storeVote(poll, result[1].name, result[1].ballot)
+            
+            chan.quickAcks.append((poll, str(msg.frm.nick), option, result))
+            
+            with self.pollLock:
+                if chan not in self.qvChan:
+                    self.qvChan = self.qvChan + [ chan ]
+                
+                self.startPoller()
+        
+        return True
+
+
 class WebsiteForwardWorker(Thread):
     """
     Forward messages to the HappyShooting Live Website
@@ -1246,46 +5623,86 @@ class WebsiteForwardWorker(Thread):
     # queue     Queue of Message
     # log       Logger
     # key       HSLive API Key
+    # url       string, HSLive endpoint
+    # timeout   float, request timeout (seconds)
+    # backlog   ChatBacklog, keeps the forwarded lines (None: not kept)
+    # sent      int, messages accepted by HSLive
+    # failed    int, messages HSLive did not accept or could not be reached for
+    # dropped   int, messages discarded without request (no key, broken message)
+    # filtered  int, messages not meant for HSLive (other Slack event types)
+    # latency   Histogram of the requests
+    #
+    # the counters are only written by the worker thread itself
     
-    def __init__(self, queue, log, key):
+    def __init__(self, queue, log, key, target, backlog):
         Thread.__init__(self)
         
         self.queue = queue
         self.log = log
         self.key = key
+        self.url, self.timeout = target
+        self.backlog = backlog
+        
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.filtered = 0
+        self.latency = Histogram()
 
     def run(self):
+        # imported by the first forwarder, channels without streaming key never load them
+        requests = lazyImport('requests')
+        
         while True:
             # Get the work from the queue and expand the tuple
             msg = self.queue.get()
             
+            if msg is None:
+                return # stopSlackStreaming
+            
             payload = { 'secret' : self.key }
             
             try:
                 if self.filterMsg(msg):
+                    self.filtered += 1
+                    self.queue.task_done()
                     continue
                 
                 # msg.extras['url'] # maybe later. supported since errbot 5.0
                 
-                tsStruct = self.extractTimestamp(msg)
+                ts = self.extractSlackTs(msg)
+                tsStruct = time.localtime(float(ts))
                 
                 payload['time'] = '{:02d}:{:02d}'.format(tsStruct.tm_hour, tsStruct.tm_min)
                 payload['nick'] = str(msg.frm.person)[1:]
                 
                 try:
-                    payload['post'] = emoji.emojize(msg.body, use_aliases=True)
-                except NameError:
+                    payload['post'] = emojize(msg.body)
+                except AttributeError:
                     payload['post'] = msg.body # no emoji support, continue without
                 
+                if self.backlog is not None:
+                    self.backlog.append({ 'time': payload['time'], 'nick': payload['nick'], 'post': payload['post'], 'ts': ts })
+                
                 try:
                     if self.key is not None: # simply discard if no key has been configured
-                        r = requests.post('https://happyshooting.de/live/add_line.php', data=payload, timeout=0.5);
+                        begin = time.perf_counter()
+                        r = requests.post(self.url, data=payload, timeout=self.timeout);
+                        self.latency.add(time.perf_counter() - begin)
                         self.log.debug("request sent " + r.url + " -> " + str(r))
+                        
+                        if 200 <= r.status_code < 300:
+                            self.sent += 1
+                        else:
+                            self.failed += 1
                     else:
+                        self.dropped += 1
                         self.log.debug("no key, discarding")
                 except requests.exceptions.RequestException as e:
+                    self.failed += 1
                     self.log.exception("failed to forward message to HSLive Slack Stream")
             except Exception as e:
+                self.dropped += 1
                 self.log.exception("something went wrong")
             
             self.queue.task_done()
@@ -1311,13 +5728,100 @@ class WebsiteForwardWorker(Thread):
     
     # msg: Message -> time.struct_time
     def extractTimestamp(self, msg):
+        return time.localtime(float(self.extractSlackTs(msg)))
+    
+    # msg: Message -> string
+    def extractSlackTs(self, msg):
         # Slack timestamp format: unix-time with fraction (.), stored as string
         
         try:
-            tsStr = msg.extras['slack_event']['message']['ts']
+            return msg.extras['slack_event']['message']['ts']
         except KeyError:
-            tsStr = msg.extras['slack_event']['ts']
-        
-        return time.localtime(float(tsStr))
+            return msg.extras['slack_event']['ts']
+
 
 
+
+class SamplingProfiler(Thread):
+    """
+    Samples the stacks of the plugin threads for a given time and writes them in the folded format of flamegraph.pl / speedscope
+    
+    Only exists while profiling, the bot itself is not instrumented.
+    Threads are only recorded while they run code of this plugin (commands, pollers, forwarders, webhooks).
+    """
+    
+    # duration      float, seconds to sample
+    # interval      float, seconds between two samples
+    # path          string, file the folded stacks are written to
+    # done          function(SamplingProfiler) called from the profiler thread when finished
+    # stacks        collections.Counter of (string, tuple of code) -> int, samples per thread name and stack (root first)
+    # samples       int, number of samples taken
+    # stopped       threading.Event, set to finish early
+    # error         Exception (None: file written)
+    
+    def __init__(self, duration, interval, path, done):
+        Thread.__init__(self, name='titlebot-profiler', daemon=True)
+        
+        self.duration = duration
+        self.interval = interval
+        self.path = path
+        self.done = done
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = Event()
+        self.error = None
+    
+    def run(self):
+        names = { }
+        end = time.monotonic() + self.duration
+        
+        while not self.stopped.wait(self.interval) and time.monotonic() < end:
+            self.sample(names)
+        
+        try:
+            self.write()
+        except OSError as e:
+            self.error = e
+        
+        self.done(self)
+    
+    # names: dict of int -> string, thread names by ident (refreshed on unknown threads)
+    def sample(self, names):
+        own = threading.get_ident()
+        
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            
+            stack = [ ]
+            plugin = False
+            
+            while frame is not None:
+                stack.append(frame.f_code)
+                plugin = plugin or frame.f_code.co_filename == __file__
+                frame = frame.f_back
+            
+            if not plugin:
+                continue
+            
+            if ident not in names:
+                names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            
+            stack.reverse()
+            self.stacks[(names.get(ident, 'thread-' + str(ident)), tuple(stack))] += 1
+        
+        self.samples += 1
+    
+    def write(self):
+        labels = { }
+        
+        def label(code):
+            if code not in labels:
+                # ';' separates the frames, ' ' the count
+                labels[code] = (getattr(code, 'co_qualname', code.co_name) + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')').replace(';', ':')
+            
+            return labels[code]
+        
+        with open(self.path, 'w', encoding='utf-8') as out:
+            for (thread, stack), count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                out.write(';'.join([ thread.replace(';', ':') ] + [ label(code) for code in stack ]) + ' ' + str(count) + '\n')
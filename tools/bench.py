@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Synthetic load benchmark for titlebot-ng
+
+Drives the bot commands through the in-process fake backend (see fakebackend.py) the way errbot does,
+i.e. including the argument parsing, and reports per-command latency percentiles and the store write volume per phase.
+After the concurrent phases, the consistency of every poll is checked using Poll.verify().
+
+    python tools/bench.py --voters 10000 --options 500 --channels 3 --save baseline.json
+    python tools/bench.py --voters 10000 --options 500 --channels 3 --compare baseline.json
+
+Baselines are only comparable when taken on the same machine with the same workload parameters.
+"""
+
+from queue import Queue
+from threading import Thread
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fakebackend import FakeMessage, FakeTitlebot, Timings, writtenBytes
+
+
+class Bench:
+    # args          argparse.Namespace
+    # timings       Timings
+    # plugin        FakeTitlebot
+    # rooms         list of FakeRoom
+    # owner         dict of FakeRoom -> FakeOccupant
+    # voters        dict of FakeRoom -> list of FakeOccupant
+    # phases        dict of string -> dict, duration and store write volume per phase
+    # problems      list of str, inconsistencies found by Poll.verify()
+    # failures      list of str, commands which raised an exception
+    
+    def __init__(self, args, dataDir):
+        self.args = args
+        self.timings = Timings()
+        self.random = random.Random(args.seed)
+        self.phases = { }
+        self.problems = [ ]
+        self.failures = [ ]
+        
+        self.plugin = FakeTitlebot(dataDir=dataDir, timings=self.timings)
+        self.plugin.configure({ 'STORAGE': args.storage, 'SQLITE_PATH': os.path.join(dataDir, 'titlebot.sqlite') })
+        
+        self.rooms = [ ]
+        self.owner = { }
+        self.voters = { }
+        
+        perChannel = max(1, args.voters // args.channels)
+        
+        for index in range(args.channels):
+            room = self.plugin.addRoom('#bench' + str(index), [ ])
+            
+            self.owner[room] = room.join('owner')
+            self.voters[room] = [ room.join('user' + str(index) + '_' + str(user)) for user in range(perChannel) ]
+            self.rooms.append(room)
+    
+    
+    # name: string, msg: FakeMessage, args: string
+    def command(self, name, msg, args=''):
+        begin = time.perf_counter()
+        
+        try:
+            self.plugin.command(name, msg, args)
+        except Exception as e:
+            self.failures.append(name + " " + args + ": " + repr(e))
+            self.plugin.log.exception("command " + name + " " + args + " failed")
+        
+        self.timings.record(name, time.perf_counter() - begin)
+    
+    
+    # runs the jobs on args.threads threads, measures the phase
+    # name: string, jobs: list of (string, FakeMessage, string)
+    def phase(self, name, jobs):
+        queue = Queue()
+        
+        for job in jobs:
+            queue.put(job)
+        
+        def work():
+            while True:
+                job = queue.get()
+                
+                if job is None:
+                    return
+                
+                self.command(*job)
+        
+        writes, written = self.plugin.storeStats.snapshot()
+        io = writtenBytes()
+        begin = time.perf_counter()
+        
+        workers = [ Thread(target=work, daemon=True) for thread in range(self.args.threads) ]
+        
+        for worker in workers:
+            queue.put(None)
+            worker.start()
+        
+        for worker in workers:
+            worker.join()
+        
+        duration = time.perf_counter() - begin
+        writesAfter, writtenAfter = self.plugin.storeStats.snapshot()
+        ioAfter = writtenBytes()
+        
+        self.phases[name] = {
+            'commands': len(jobs),
+            'seconds': duration,
+            'rate': len(jobs) / duration if duration > 0 else 0,
+            'storeWrites': writesAfter - writes,
+            'storeBytes': writtenAfter - written,
+            'ioBytes': ioAfter - io if io is not None else None,
+        }
+    
+    
+    # room: FakeRoom -> FakeMessage, sent by the channel owner to the channel
+    def ownerMsg(self, room):
+        return FakeMessage(self.owner[room], room)
+    
+    
+    def run(self):
+        args = self.args
+        
+        self.plugin.activate()
+        
+        self.phase('setup', [ ('tb_channel', self.ownerMsg(room), 'add') for room in self.rooms ])
+        self.phase('enable', [ ('enable', self.ownerMsg(room), '') for room in self.rooms ])
+        
+        jobs = [ ]
+        
+        for room in self.rooms:
+            for option in range(args.options):
+                voter = self.random.choice(self.voters[room])
+                jobs.append(('add', FakeMessage(voter, room), 'Proposed title number ' + str(option) + ' ' + voter.nick))
+        
+        self.phase('add', jobs)
+        
+        # concurrent countdowns, running while the votes arrive
+        self.phase('countdown', [ ('countdown', self.ownerMsg(room), str(args.countdown)) for room in self.rooms ])
+        
+        jobs = [ ('vote', FakeMessage(voter, room), str(self.pickOption())) for room in self.rooms for voter in self.voters[room] ]
+        self.random.shuffle(jobs)
+        self.phase('vote', jobs)
+        
+        jobs = [ ]
+        
+        for index in range(args.lists):
+            room = self.rooms[index % len(self.rooms)]
+            voter = self.random.choice(self.voters[room])
+            jobs.append(('list', FakeMessage(voter, room), self.random.choice([ 'options', 'results' ])))
+            jobs.append(('list', self.ownerMsg(room), '--public results'))
+        
+        self.phase('list', jobs)
+        
+        jobs = [ ('revoke', FakeMessage(voter, room), '') for room in self.rooms for voter in self.random.sample(self.voters[room], int(len(self.voters[room]) * args.revoke)) ]
+        self.phase('revoke', jobs)
+        
+        jobs = [ ('rm', self.ownerMsg(room), str(option)) for room in self.rooms for option in self.random.sample(range(1, args.options + 1), min(args.rm, args.options)) ]
+        self.phase('rm', jobs)
+        
+        self.verify()
+        self.mixed()
+        self.verify()
+        self.expire()
+        
+        self.plugin.deactivate()
+    
+    
+    # -> int, skewed towards the low option numbers like real polls
+    def pickOption(self):
+        return min(self.args.options, int(self.random.paretovariate(1.2))) if self.random.random() < 0.5 else self.random.randint(1, self.args.options)
+    
+    
+    # concurrent votes, revokes, additions and deletions in all channels
+    def mixed(self):
+        jobs = [ ]
+        
+        for index in range(self.args.mixed):
+            room = self.random.choice(self.rooms)
+            msg = FakeMessage(self.random.choice(self.voters[room]), room)
+            kind = self.random.random()
+            
+            if kind < 0.5:
+                jobs.append(('vote', msg, str(self.pickOption())))
+            elif kind < 0.8:
+                jobs.append(('revoke', msg, ''))
+            elif kind < 0.95:
+                jobs.append(('add', msg, 'Late title ' + str(index)))
+            else:
+                jobs.append(('rm', self.ownerMsg(room), str(self.random.randint(1, self.args.options))))
+        
+        self.phase('mixed', jobs)
+    
+    
+    def verify(self):
+        for chan in self.plugin.chans:
+            self.problems += [ str(chan.channel) + ": " + problem for problem in chan.verify() ]
+    
+    
+    # ends all countdowns and waits until the results have been printed
+    def expire(self):
+        self.phase('expire', [ ('countdown', self.ownerMsg(room), '2') for room in self.rooms ])
+        
+        deadline = time.time() + 30
+        
+        while time.time() < deadline and any(poll.countdownTS >= 0 for chan in self.plugin.chans for poll in chan.polls.values()):
+            time.sleep(0.1)
+    
+    
+    # -> dict
+    def report(self):
+        return {
+            'workload': { key: value for key, value in vars(self.args).items() if key in Bench.WORKLOAD },
+            'commands': self.timings.summary(),
+            'phases': self.phases,
+            'sent': dict(self.plugin.sent),
+            'problems': self.problems,
+            'failures': self.failures,
+        }
+    
+    
+    WORKLOAD = ('voters', 'options', 'channels', 'threads', 'storage', 'lists', 'revoke', 'rm', 'mixed', 'seed')
+
+
+
+# report: dict
+def printReport(report):
+    print("----- Commands (latency in ms) -----")
+    print("  {:<24} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format('command', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+    
+    for name, stats in sorted(report['commands'].items()):
+        print("  {:<24} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(name, stats['count'], stats['mean'], stats['p50'], stats['p90'], stats['p99'], stats['max']))
+    
+    print("----- Phases -----")
+    print("  {:<12} {:>8} {:>9} {:>10} {:>8} {:>12} {:>12}".format('phase', 'commands', 'seconds', 'cmds/s', 'writes', 'store bytes', 'io bytes'))
+    
+    for name, phase in report['phases'].items():
+        io = phase['ioBytes'] if phase['ioBytes'] is not None else '-'
+        print("  {:<12} {:>8} {:>9.2f} {:>10.1f} {:>8} {:>12} {:>12}".format(name, phase['commands'], phase['seconds'], phase['rate'], phase['storeWrites'], phase['storeBytes'], io))
+    
+    print("----- Messages sent: " + ", ".join(key + ": " + str(value) for key, value in sorted(report['sent'].items())) + " -----")
+    print("----- Failed commands: " + str(len(report['failures'])) + ", inconsistencies: " + str(len(report['problems'])) + " -----")
+    
+    for problem in (report['failures'] + report['problems'])[:20]:
+        print("  " + problem)
+
+
+MIN_SAMPLES = 20
+
+
+# report: dict, baseline: dict, tolerance: float -> list of str (regressions)
+def compare(report, baseline, tolerance):
+    if report['workload'] != baseline['workload']:
+        print("warning: the baseline was taken with a different workload: " + json.dumps(baseline['workload']))
+    
+    regressions = [ ]
+    
+    print("----- Compared to baseline (current / baseline) -----")
+    
+    for name, stats in sorted(report['commands'].items()):
+        base = baseline['commands'].get(name)
+        
+        if base is None or min(stats['count'], base['count']) < MIN_SAMPLES:
+            continue # too few samples for stable percentiles
+        
+        ratios = { key: stats[key] / base[key] if base[key] > 0 else 1.0 for key in ('p50', 'p99') }
+        marker = ""
+        
+        for key, ratio in ratios.items():
+            if ratio > 1 + tolerance:
+                regressions.append(name + " " + key + ": " + '{:.3f}'.format(base[key]) + " -> " + '{:.3f}'.format(stats[key]) + " ms")
+                marker = "  <-- regression"
+        
+        print("  {:<24} p50 {:>6.2f}x  p99 {:>6.2f}x{}".format(name, ratios['p50'], ratios['p99'], marker))
+    
+    for name, phase in report['phases'].items():
+        base = baseline['phases'].get(name)
+        
+        if base is not None and base['storeBytes'] > 0 and phase['storeBytes'] > base['storeBytes'] * (1 + tolerance):
+            regressions.append(name + " store bytes: " + str(base['storeBytes']) + " -> " + str(phase['storeBytes']))
+    
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic load benchmark for titlebot-ng')
+    parser.add_argument('--voters', type=int, default=10000, help='number of voters, spread over the channels. default=10000')
+    parser.add_argument('--options', type=int, default=500, help='number of options per channel. default=500')
+    parser.add_argument('--channels', type=int, default=3, help='number of channels. default=3')
+    parser.add_argument('--threads', type=int, default=4, help='number of concurrent command threads. default=4')
+    parser.add_argument('--storage', choices=['kv', 'sqlite'], default='kv', help='storage backend. default=kv')
+    parser.add_argument('--lists', type=int, default=20, help='number of !list requests per kind. default=20')
+    parser.add_argument('--revoke', type=float, default=0.1, help='fraction of the voters revoking their vote. default=0.1')
+    parser.add_argument('--rm', type=int, default=25, help='number of options deleted per channel. default=25')
+    parser.add_argument('--mixed', type=int, default=2000, help='number of commands of the concurrent mixed phase. default=2000')
+    parser.add_argument('--countdown', type=int, default=3600, help='countdown running during the vote phase (seconds). default=3600')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the workload. default=1')
+    parser.add_argument('--save', metavar='FILE', help='save the results as baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a saved baseline, exit status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown compared to the baseline. default=0.25')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as dataDir:
+        bench = Bench(args, dataDir)
+        bench.run()
+    
+    report = bench.report()
+    printReport(report)
+    
+    if args.save is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        
+        with open(args.save, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+    
+    status = 0 if len(report['problems']) == 0 and len(report['failures']) == 0 else 2
+    
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline), args.tolerance)
+        
+        for regression in regressions:
+            print("regression: " + regression)
+        
+        if len(regressions) > 0 and status == 0:
+            status = 1
+    
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,702 @@
+#!/usr/bin/env python3
+"""
+Regression checks of titlebot-ng
+
+Each check runs a short scenario on a fresh bot with the in-process fake backend (see fakebackend.py), once per storage
+backend, and restarts the bot from its store where persistence matters. errbot, flask, requests and emoji must be installed.
+
+    python tools/checks.py
+    python tools/checks.py --storage sqlite voteZero
+
+Exit status 2 if a check failed.
+"""
+
+import argparse
+import collections
+import csv
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from fakebackend import FakeMessage, FakeTitlebot
+from replay import StubServer
+
+import titlebot
+
+
+class Scenario:
+    """
+    A bot with one configured channel '#checks' run by 'owner', voting enabled
+    """
+    
+    # storage       string, 'kv' or 'sqlite'
+    # dataDir       string
+    # hslive        StubServer, receives the lines forwarded from channels with an API key
+    # plugin        FakeTitlebot
+    # room          FakeRoom
+    # users         dict of string -> FakeOccupant, by nick
+    # replies       list of (string, string), recipient and text of the messages sent
+    
+    def __init__(self, storage, dataDir, nicks):
+        self.storage = storage
+        self.dataDir = dataDir
+        self.replies = [ ]
+        self.plugin = None
+        self.hslive = StubServer(0, 0, 0, 0)
+        
+        threading.Thread(target=self.hslive.serve_forever, daemon=True).start()
+        self.start([ ])
+        self.room = self.plugin.addRoom('#checks', [ 'owner' ] + list(nicks))
+        self.users = { occupant.nick: occupant for occupant in self.room.occupants }
+        
+        self.command('owner', 'tb_channel', 'add')
+        self.command('owner', 'enable')
+    
+    
+    # store: dict of string -> bytes, rooms: list of FakeRoom
+    def start(self, rooms, store=None):
+        plugin = FakeTitlebot(dataDir=self.dataDir)
+        plugin.configure({ 'STORAGE': self.storage, 'SQLITE_PATH': os.path.join(self.dataDir, 'titlebot.sqlite'), 'HSLIVE_URL': self.hslive.url() })
+        plugin.fakeRooms = rooms
+        plugin.fakeStore = store if store is not None else { }
+        plugin.send = lambda identifier, text, *args, **kwargs: self.replies.append((str(identifier), text))
+        
+        plugin.activate()
+        plugin.restored.wait()
+        
+        self.plugin = plugin
+    
+    
+    # restarts the bot from its store
+    def restart(self):
+        self.plugin.deactivate()
+        self.start(self.plugin.fakeRooms, self.plugin.fakeStore)
+    
+    
+    # nick: string, name: string, args: string -> string, the last reply (None: no reply)
+    def command(self, nick, name, args=''):
+        count = len(self.replies)
+        self.plugin.command(name, FakeMessage(self.users[nick] if nick in self.users else self.room.join(nick), self.room), args)
+        
+        return self.replies[-1][1] if len(self.replies) > count else None
+    
+    
+    # nick: string, body: string, a plain channel message, extras: dict (e.g. the Slack event)
+    def say(self, nick, body, extras=None):
+        self.plugin.callback_message(FakeMessage(self.users[nick], self.room, body, extras))
+    
+    
+    # -> Poll
+    def poll(self):
+        return self.plugin.chans[0].polls['main']
+    
+    
+    # -> dict of string -> tuple of int, the ballots by user
+    def ballots(self):
+        return { vote.name: vote.ballot for vote in self.poll().snapshot().votes }
+    
+    
+    # -> list of str
+    def verify(self):
+        return [ str(chan.channel) + ": " + problem for chan in self.plugin.chans for problem in chan.verify() ]
+    
+    
+    def stop(self):
+        self.plugin.deactivate()
+        self.hslive.shutdown()
+
+
+
+class Request:
+    """
+    The parts of a flask.Request the webhooks read
+    """
+    
+    # args          dict of string -> string, the query parameters
+    # headers       dict of string -> string
+    
+    def __init__(self, headers=None, **args):
+        self.args = args
+        self.headers = headers or { }
+
+
+
+# condition: bool, text: string
+def expect(condition, text):
+    if not condition:
+        raise AssertionError(text)
+
+
+# option 0 is no option, a vote for it must neither be accepted nor replace a persisted vote
+def voteZero(scenario):
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('alice', 'vote', '1')
+    
+    reply = scenario.command('alice', 'vote', '0')
+    expect(reply is not None and 'accepted' not in reply, "vote 0 answered: " + str(reply))
+    
+    scenario.restart()
+    
+    expect(scenario.ballots() == { '@alice': (0, ) }, "stored ballots after vote 0: " + str(scenario.ballots()))
+    expect(scenario.verify() == [ ], "inconsistent: " + str(scenario.verify()))
+
+
+# quick votes for option 0 are rejected and leave the persisted vote alone
+def quickVoteZero(scenario):
+    scenario.command('owner', 'quickvotes', 'on')
+    scenario.command('owner', 'add', 'First title')
+    scenario.say('alice', '+1')
+    scenario.say('alice', '0')
+    scenario.say('bob', '+0')
+    scenario.plugin.quickVoteProcessChan(scenario.plugin.chans[0])
+    
+    reply = scenario.replies[-1][1]
+    expect('1 accepted (option 1: 1)' in reply and 'no such option: alice (0), bob (0)' in reply, "quick votes answered: " + reply)
+    
+    scenario.restart()
+    
+    expect(scenario.ballots() == { '@alice': (0, ) }, "stored ballots after quick vote 0: " + str(scenario.ballots()))
+
+
+# ballots of several options are rejected as a whole if one of them is no option
+def ballotZero(scenario):
+    scenario.command('owner', 'mode', 'ranked')
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('owner', 'add', 'Second title')
+    scenario.command('alice', 'vote', '2 1')
+    
+    for ballot in ('1 0', '0 2', '2 5'):
+        reply = scenario.command('bob', 'vote', ballot)
+        expect(reply is not None and 'accepted' not in reply, "vote " + ballot + " answered: " + str(reply))
+    
+    reply = scenario.command('alice', 'vote', '1')
+    expect(reply == "Vote rejected, you have already voted for options 2 > 1", "second vote answered: " + str(reply))
+    
+    scenario.restart()
+    
+    expect(scenario.ballots() == { '@alice': (1, 0) }, "stored ballots: " + str(scenario.ballots()))
+    expect(scenario.verify() == [ ], "inconsistent: " + str(scenario.verify()))
+
+
+# the archive shows the runoff placements of a ranked poll, not the first choices
+def archiveRanked(scenario):
+    scenario.command('owner', 'mode', 'ranked')
+    
+    for text in ('First title', 'Second title', 'Third title'):
+        scenario.command('owner', 'add', text)
+    
+    # first choices: option 1 twice, option 2 once, option 3 twice. 2 is eliminated, its ballot moves on to 3
+    for nick, ballot in (('alice', '1'), ('bob', '1'), ('carl', '3'), ('dave', '3'), ('erin', '2 3')):
+        scenario.command(nick, 'vote', ballot)
+    
+    scenario.command('owner', 'reset')
+    
+    reply = scenario.command('owner', 'archive', 'show 1')
+    places = [ line.strip() for line in reply.split('\n') if line.startswith('  ') and not line.startswith('  instant') ]
+    
+    expect(places[0] == "1. Third title (Option 3 with 3 votes)", "archived results: " + reply)
+    expect(scenario.plugin.chans[0].archive[0].winner == 'Third title', "archived winner: " + str(scenario.plugin.chans[0].archive[0].winner))
+
+
+# a poll is archived when its countdown expires, a reset afterwards archives it again only if it has changed in between
+def archiveOnce(scenario):
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('alice', 'vote', '1')
+    scenario.plugin.countdownProcessPoll(scenario.poll(), 0)
+    
+    reply = scenario.command('owner', 'reset')
+    expect(reply.endswith("archived as #1 -----"), "reset after the countdown answered: " + str(reply))
+    
+    scenario.command('owner', 'enable')
+    scenario.command('owner', 'add', 'Second title')
+    scenario.plugin.countdownProcessPoll(scenario.poll(), 0)
+    scenario.command('owner', 'enable')
+    scenario.command('owner', 'add', 'Third title')
+    
+    reply = scenario.command('owner', 'reset')
+    expect(reply.endswith("archived as #3 -----"), "reset of a changed poll answered: " + str(reply))
+    
+    scenario.restart()
+    
+    reasons = [ entry.reason for entry in scenario.plugin.chans[0].archive ]
+    expect(reasons == [ 'countdown', 'countdown', 'reset' ], "archived: " + str(reasons))
+
+
+# ballots: list of tuple of int, candidates: list of int -> list of (int, int), instant-runoff recounting every ballot in every
+# round, ties are eliminated like Tally.runoff: fewest first preferences, then the higher id
+def recountRunoff(ballots, candidates):
+    remaining = set(candidates)
+    first = collections.Counter(next(option for option in ballot if option in remaining) for ballot in ballots if remaining & set(ballot))
+    eliminated = [ ]
+    
+    while True:
+        counts = { option: 0 for option in remaining }
+        
+        for ballot in ballots:
+            for option in ballot:
+                if option in remaining:
+                    counts[option] += 1
+                    break
+        
+        if len(remaining) <= 1 or max(counts.values(), default=0) * 2 > sum(counts.values()):
+            break
+        
+        option = min(remaining, key=lambda option: (counts[option], first[option], -option))
+        remaining.discard(option)
+        eliminated.append((option, counts[option]))
+    
+    finalists = sorted(remaining, key=lambda option: (-counts[option], -first[option], option))
+    
+    return [ (option, votes) for option, votes in [ (option, counts[option]) for option in finalists ] + eliminated[::-1] if votes > 0 ]
+
+
+# the incremental ranked tally agrees with recounting the ballots, after votes, revocations and a deleted option
+def runoffRecount(scenario):
+    rnd = random.Random(7)
+    scenario.command('owner', 'mode', 'ranked')
+    
+    for option in range(8):
+        scenario.command('owner', 'add', 'Ranked title ' + str(option))
+    
+    for voter in range(120):
+        scenario.command('voter' + str(voter), 'vote', ' '.join(str(option) for option in rnd.sample(range(1, 9), rnd.randint(1, 4))))
+    
+    for voter in rnd.sample(range(120), 30):
+        scenario.command('voter' + str(voter), 'revoke')
+    
+    scenario.command('owner', 'rm', '3')
+    
+    for attempt in ('live', 'restored'):
+        snapshot = scenario.poll().snapshot()
+        tallied = [ (option.id, option.votes) for option in snapshot.results ]
+        recounted = recountRunoff([ vote.ballot for vote in snapshot.votes ], [ option.id for option in snapshot.live() ])
+        
+        expect(len(tallied) > 1 and tallied == recounted, attempt + " runoff " + str(tallied) + ", recounted " + str(recounted))
+        expect(scenario.verify() == [ ], "inconsistent: " + str(scenario.verify()))
+        
+        scenario.restart()
+
+
+# importing and deleting several options are one change each: one event, one new version and one new snapshot
+def batchChanges(scenario):
+    chan = scenario.plugin.chans[0]
+    scenario.command('alice', 'vote', '--quiet 1') # no options yet, rejected
+    cursor, version, revision = chan.events.seq, chan.version, scenario.poll().revision
+    
+    scenario.command('owner', 'importOptions', '\n'.join('Imported title ' + str(option) for option in range(50)))
+    seq, events, reset = chan.events.read(cursor, 0)
+    events = [ json.loads(event) for event in events ]
+    
+    expect(len(events) == 1 and events[0]['type'] == 'options' and len(events[0]['options']) == 50, "import events: " + str(events)[:200])
+    expect((chan.version, scenario.poll().revision) == (version + 1, revision + 1), "import versions: " + str((chan.version, scenario.poll().revision)))
+    expect(len(scenario.poll().snapshot().live()) == 50, "imported: " + str(len(scenario.poll().snapshot().live())))
+    
+    scenario.command('alice', 'vote', '2')
+    scenario.command('bob', 'vote', '3')
+    cursor = chan.events.seq
+    scenario.command('owner', 'rm', '1 2 3 4')
+    seq, events, reset = chan.events.read(cursor, 0)
+    events = [ json.loads(event) for event in events ]
+    
+    expect([ (event['type'], event.get('options')) for event in events ] == [ ('delete', [ 1, 2, 3, 4 ]) ], "delete events: " + str(events))
+    expect(scenario.ballots() == { } and scenario.verify() == [ ], "after deleting: " + str(scenario.ballots()) + " " + str(scenario.verify()))
+
+
+# an emoji alias (as sent by Slack) duplicates the unicode emoji (as sent by other clients). needs the emoji package
+def emojiDuplicates(scenario):
+    scenario.command('alice', 'add', '\U0001F44D title')
+    reply = scenario.command('bob', 'add', ':thumbsup: title')
+    
+    expect(reply is not None and reply.startswith("Option rejected, it duplicates option 1"), "alias added: " + str(reply))
+    expect(len(scenario.poll().snapshot().live()) == 1, "options: " + str([ option.text for option in scenario.poll().snapshot().live() ]))
+
+
+# the rendered webhook responses of a poll or channel are dropped with it
+def webCacheEvicted(scenario):
+    scenario.command('owner', 'poll', 'add side')
+    
+    for poll in ('main', 'side'):
+        scenario.plugin.web_results(Request(poll=poll), 'checks')
+        scenario.plugin.web_options(Request(poll=poll), 'checks')
+    
+    scenario.command('owner', 'poll', 'rm side')
+    expect(sorted(scenario.plugin.webCache) == [ ('#checks', 'main', 'options'), ('#checks', 'main', 'results') ], "cached after removing the poll: " + str(sorted(scenario.plugin.webCache)))
+    
+    scenario.command('owner', 'tb_channel', 'rm --channel #checks')
+    expect(len(scenario.plugin.webCache) == 0, "cached after removing the channel: " + str(sorted(scenario.plugin.webCache)))
+
+
+# the digest posts the top standings to the channel, but only when they changed since the last one
+def digest(scenario):
+    scenario.command('owner', 'digest', '--top 2 3600')
+    
+    for text in ('First title', 'Second title', 'Third title'):
+        scenario.command('owner', 'add', text)
+    
+    for nick, option in (('alice', 2), ('bob', 2), ('carl', 3)):
+        scenario.command(nick, 'vote', '--quiet ' + str(option))
+    
+    def posted():
+        count = len(scenario.replies)
+        scenario.plugin.digestProcessPoll(scenario.plugin.chans[0])
+        
+        return [ text for recipient, text in scenario.replies[count:] if recipient == '#checks' ]
+    
+    first = posted()
+    expect(first == [ '----- Current standings (top 2) -----\n  1. Second title (2: 2)\n  2. Third title (3: 1)' ], "digest: " + str(first))
+    expect(posted() == [ ], "digest without changes: " + str(scenario.replies[-1:]))
+    
+    scenario.command('owner', 'vote', '--quiet 3')
+    scenario.command('dave', 'vote', '--quiet 3')
+    second = posted()
+    expect(second == [ '----- Current standings (top 2) -----\n  1. Third title (3: 3)\n  2. Second title (2: 2)' ], "digest after votes: " + str(second))
+    
+    scenario.command('owner', 'disable')
+    expect(posted() == [ ], "digest while voting is disabled: " + str(scenario.replies[-1:]))
+
+
+# the JSON webhooks answer a request for the current version with 304, every change gives a new ETag
+def conditionalResults(scenario):
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('owner', 'add', 'Second title')
+    scenario.command('alice', 'vote', '--quiet 2')
+    
+    response = scenario.plugin.web_results(Request(), 'checks')
+    etag = response.headers['ETag']
+    results = json.loads(response.get_data())['results']
+    
+    expect(response.status_code == 200 and [ (result['place'], result['id'], result['votes']) for result in results ] == [ (1, 2, 1) ], "results: " + str(results))
+    
+    for tag in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+        response = scenario.plugin.web_results(Request({ 'If-None-Match': tag }), 'checks')
+        expect(response.status_code == 304 and response.get_data() == b'' and response.headers['ETag'] == etag, "If-None-Match " + tag + ": " + str(response.status_code))
+    
+    scenario.command('bob', 'vote', '--quiet 1')
+    response = scenario.plugin.web_results(Request({ 'If-None-Match': etag }), 'checks')
+    
+    expect(response.status_code == 200 and response.headers['ETag'] != etag, "after a vote: " + str(response.status_code) + " " + response.headers['ETag'])
+    expect(sorted((result['id'], result['votes']) for result in json.loads(response.get_data())['results']) == [ (1, 1), (2, 1) ], "results after a vote: " + str(response.get_data()))
+    
+    counts = scenario.plugin.web_votes(Request(), 'checks')
+    expect(counts.headers['ETag'] == response.headers['ETag'] and json.loads(counts.get_data()) == { 'poll': 'main', 'voters': 2, 'votes': { '1': 1, '2': 1 } }, "counts: " + str(counts.get_data()))
+
+
+# changes reach a long-poll waiting for them and an event stream resuming after its last event id
+def eventDelivery(scenario):
+    first = json.loads(scenario.plugin.web_events(Request(wait='0'), 'checks').get_data())
+    expect(first['reset'] and first['events'] == [ ], "long-poll without cursor: " + str(first))
+    
+    adder = threading.Timer(0.2, lambda: scenario.command('owner', 'add', 'First title'))
+    adder.start()
+    started = time.time()
+    polled = json.loads(scenario.plugin.web_events(Request(cursor=first['cursor'], wait='10'), 'checks').get_data())
+    adder.join()
+    
+    expect(time.time() - started < 5, "long-poll returned after " + str(time.time() - started) + "sec")
+    expect(not polled['reset'] and [ (event['type'], event['option'], event['text']) for event in polled['events'] ] == [ ('option', 1, 'First title') ], "long-poll: " + str(polled))
+    
+    scenario.command('alice', 'vote', '--quiet 1')
+    scenario.command('bob', 'vote', '--quiet 1')
+    stream = scenario.plugin.web_stream(Request({ 'Last-Event-ID': polled['cursor'] }), 'checks').response
+    
+    try:
+        sent = [ next(stream), next(stream) ]
+    finally:
+        stream.close()
+    
+    events = [ (text.split('\n')[0], json.loads(text.split('\n')[1][len('data: '):])) for text in sent ]
+    cursor = int(polled['cursor'].rsplit('-', 1)[1])
+    
+    expect([ ident for ident, event in events ] == [ 'id: ' + scenario.plugin.chans[0].epoch + '-' + str(cursor + index) for index in (1, 2) ], "stream ids: " + str(sent))
+    expect([ (event['type'], event['option'], event['votes']) for ident, event in events ] == [ ('vote', 1, 1), ('vote', 1, 2) ], "stream events: " + str(sent))
+    expect(scenario.plugin.streamClients == 0, "stream listeners after closing: " + str(scenario.plugin.streamClients))
+
+
+# commands reach the poll named by --poll or the default poll, the polls keep their options and votes apart
+def pollRouting(scenario):
+    scenario.command('owner', 'poll', 'add side')
+    scenario.command('owner', 'enable', '--poll side')
+    scenario.command('owner', 'add', 'Main title')
+    scenario.command('owner', 'add', '--poll side Side title')
+    scenario.command('alice', 'vote', '--quiet 1')
+    scenario.command('bob', 'vote', '--quiet --poll side 1')
+    
+    reply = scenario.command('carl', 'vote', '--poll other 1')
+    expect(reply is not None and 'there is no poll named other' in reply, "vote in an unknown poll: " + str(reply))
+    
+    scenario.command('owner', 'poll', 'default side')
+    scenario.command('carl', 'vote', '--quiet 1')
+    scenario.restart()
+    
+    polls = scenario.plugin.chans[0].polls
+    contents = { name: ([ option.text for option in poll.snapshot().live() ], sorted(vote.name for vote in poll.snapshot().votes)) for name, poll in polls.items() }
+    
+    expect(contents == { 'main': ([ 'Main title' ], [ '@alice' ]), 'side': ([ 'Side title' ], [ '@bob', '@carl' ]) }, "polls: " + str(contents))
+    expect(scenario.plugin.chans[0].defaultPoll == 'side', "default poll: " + scenario.plugin.chans[0].defaultPoll)
+    
+    results = json.loads(scenario.plugin.web_results(Request(poll='main'), 'checks').get_data())
+    expect(results['poll'] == 'main' and [ (result['text'], result['votes']) for result in results['results'] ] == [ ('Main title', 1) ], "main results: " + str(results))
+    expect(scenario.verify() == [ ], "inconsistent: " + str(scenario.verify()))
+
+
+# tombstones of deleted options are kept for TOMBSTONE_RETENTION, compacting them never frees their ids
+def tombstoneRetention(scenario):
+    for text in ('First title', 'Second title', 'Third title'):
+        scenario.command('owner', 'add', text)
+    
+    scenario.command('owner', 'rm', '2')
+    scenario.restart()
+    
+    options = lambda: [ (option.id + 1, option.deleted) for option in scenario.poll().snapshot().options ]
+    expect(options() == [ (1, False), (2, True), (3, False) ], "options within the retention: " + str(options()))
+    
+    scenario.plugin.config['TOMBSTONE_RETENTION'] = 0
+    scenario.command('owner', 'rm', '3')
+    expect(options() == [ (1, False) ], "options after compacting: " + str(options()))
+    
+    scenario.restart()
+    scenario.command('owner', 'add', 'Fourth title')
+    expect(options() == [ (1, False), (4, False) ], "options after adding: " + str(options()))
+    
+    reply = scenario.command('alice', 'vote', '2')
+    expect(reply is not None and 'no such option' in reply and scenario.ballots() == { }, "vote for a compacted option: " + str(reply))
+    expect(scenario.verify() == [ ], "inconsistent: " + str(scenario.verify()))
+
+
+# the history webhook returns the counts at "from" and the recorded changes after it, downsampling merges the older
+# half of the snapshots without changing any count
+def historyDeltas(scenario):
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('owner', 'add', 'Second title')
+    begin = time.time()
+    
+    # the 50th change records a snapshot
+    for voter in range(titlebot.TallyHistory.MUTATIONS):
+        scenario.command('voter' + str(voter), 'vote', '--quiet 1')
+    
+    middle = time.time()
+    
+    for nick in ('alice', 'bob', 'carl'):
+        scenario.command(nick, 'vote', '--quiet 2')
+    
+    history = lambda begin: json.loads(scenario.plugin.web_history(Request(**{ 'from': str(begin), 'to': str(time.time() + 1) }), 'checks').get_data())
+    
+    whole, recent = history(begin), history(middle)
+    expect(whole['start'] == { } and [ change['votes'] for change in whole['changes'] ] == [ { '1': 50 }, { '2': 3 } ], "history: " + str(whole))
+    expect(recent['start'] == { '1': 50 } and [ change['votes'] for change in recent['changes'] ] == [ { '2': 3 } ], "recent history: " + str(recent))
+    expect(recent['options'] == { '1': 'First title', '2': 'Second title' }, "history options: " + str(recent['options']))
+    
+    history = titlebot.TallyHistory({ 0: 5 })
+    
+    for index in range(titlebot.TallyHistory.SIZE + 1):
+        if index == titlebot.TallyHistory.SIZE:
+            recorded = list(history.snapshots)
+        
+        history.record({ index % 3: 1, 3: -1 if index % 2 else 1 })
+        history.flush()
+    
+    end = time.time() + 1
+    view = history.view()
+    half = (titlebot.TallyHistory.SIZE + 1) // 2
+    
+    expect(len(history.snapshots) == half // 2 + titlebot.TallyHistory.SIZE + 1 - half, "snapshots after downsampling: " + str(len(history.snapshots)))
+    expect(history.snapshots[half // 2:-1] == recorded[half:], "the newer half got downsampled")
+    expect([ ts for ts, changes in history.snapshots[:half // 2] ] == [ ts for ts, changes in recorded[1:half:2] ], "merged snapshots are not recorded at the later time")
+    expect(all(history.snapshots[index][0] <= history.snapshots[index + 1][0] for index in range(len(history.snapshots) - 1)), "snapshots out of order")
+    expect(view.series(end, end) == ({ 0: 339, 1: 334, 2: 333, 3: 1 }, [ ]), "counts after downsampling: " + str(view.series(end, end)[0]))
+    
+    samples = view.sample(history.start, end, 3)
+    expect(samples[0][1] == { 0: 5 } and samples[-1][1] == { 0: 339, 1: 334, 2: 333, 3: 1 }, "samples: " + str([ counts for ts, counts in samples ]))
+
+
+# the exports stream the snapshot of the request in several chunks, votes only with the API key
+def streamedExport(scenario):
+    scenario.command('owner', 'tb_apikey', 'checks-key')
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('owner', 'add', 'Second, comma title')
+    voters = [ 'voter' + str(voter) for voter in range(titlebot.Export.CHUNK_ROWS + 44) ]
+    
+    for index, nick in enumerate(voters):
+        scenario.command(nick, 'vote', '--quiet ' + str(1 + index % 2))
+    
+    expect(scenario.plugin.web_export(Request(), 'checks', 'votes').status_code == 403, "votes exported without the API key")
+    
+    response = scenario.plugin.web_export(Request({ 'Authorization': 'Bearer checks-key' }, format='csv'), 'checks', 'votes')
+    scenario.command('late', 'vote', '--quiet 1')
+    chunks = list(response.response)
+    rows = list(csv.reader(io.StringIO(''.join(chunks))))
+    texts = { 1: 'First title', 2: 'Second, comma title' }
+    
+    expect(response.headers['Content-Disposition'] == 'attachment; filename="checks-main-votes.csv"', "votes file: " + response.headers['Content-Disposition'])
+    expect(len(chunks) > 1, "votes in " + str(len(chunks)) + " chunks")
+    expect(rows == [ [ 'user', 'option', 'text', 'rank' ] ] + [ [ '@' + nick, str(1 + index % 2), texts[1 + index % 2], '1' ] for index, nick in enumerate(voters) ], "votes: " + str(rows[:3]) + " ... " + str(len(rows)) + " rows")
+    
+    results = json.loads(''.join(scenario.plugin.web_export(Request(format='json'), 'checks', 'results').response))
+    expect(results == [ { 'place': 1, 'id': 1, 'text': 'First title', 'votes': 151 }, { 'place': 2, 'id': 2, 'text': 'Second, comma title', 'votes': 150 } ], "results: " + str(results))
+
+
+# the metrics webhook serves the Prometheus text format: every sample of a declared metric, counts as counted
+def metricsExposition(scenario):
+    scenario.command('owner', 'tb_apikey', 'checks-key')
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('alice', 'vote', '--quiet 1')
+    scenario.command('bob', 'vote', '--quiet 1')
+    
+    response = scenario.plugin.web_metrics(Request())
+    text = response.get_data(as_text=True)
+    declared = { }
+    samples = { }
+    
+    expect(response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8' and text.endswith('\n'), "metrics response: " + response.headers['Content-Type'])
+    
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            name, kind = line[len('# TYPE '):].split(' ')
+            declared[name] = kind
+            continue
+        
+        if line.startswith('# HELP '):
+            continue
+        
+        match = re.fullmatch(r'([a-z_]+)(\{(?:[a-z_]+="(?:[^"\\]|\\.)*",?)*\})? (\S+)', line)
+        expect(match is not None, "not a sample: " + line)
+        
+        name = match.group(1)
+        expect(name in declared or re.sub(r'_(bucket|sum|count)$', '', name) in declared, "sample of an undeclared metric: " + line)
+        samples[name + (match.group(2) or '')] = float(match.group(3))
+    
+    expect(samples.get('titlebot_changes_total{channel="#checks",kind="vote"}') == 2, "vote changes: " + str(samples.get('titlebot_changes_total{channel="#checks",kind="vote"}')))
+    expect(samples.get('titlebot_votes{channel="#checks",poll="main"}') == 2 and samples.get('titlebot_options{channel="#checks",poll="main"}') == 1, "poll gauges: " + str([ sample for sample in samples if 'poll="main"' in sample ]))
+    expect(declared['titlebot_forward_post_seconds'] == 'histogram' and 'titlebot_forward_post_seconds_bucket{channel="#checks",le="+Inf"}' in samples and samples['titlebot_forward_post_seconds_bucket{channel="#checks",le="+Inf"}'] == samples.get('titlebot_forward_post_seconds_count{channel="#checks"}'), "forwarder histogram: " + str([ sample for sample in samples if sample.startswith('titlebot_forward_post') ]))
+    expect(scenario.plugin.metricLabels({ 'poll': 'a"b\\c\nd' }) == '{poll="a\\"b\\\\c\\nd"}', "escaped labels: " + scenario.plugin.metricLabels({ 'poll': 'a"b\\c\nd' }))
+
+
+# the flood control rejects a user over the limit (telling them once), sheds listings before votes when the channel is
+# busy and never limits admins
+def floodRejected(scenario):
+    scenario.command('owner', 'add', 'First title')
+    scenario.command('owner', 'flood', '--user 3 --total 0')
+    
+    for attempt in range(5):
+        scenario.command('alice', 'vote', '--quiet 1')
+    
+    told = [ text for recipient, text in scenario.replies if recipient == '@alice' and text.startswith("Slow down") ]
+    shed = scenario.plugin.floodControl.shedCounts('#checks')
+    
+    expect(len(told) == 1 and shed == { ('vote', 'user'): 2 }, "user limit: told " + str(len(told)) + " times, shed " + str(shed))
+    expect(scenario.ballots() == { '@alice': (0, ) }, "ballots: " + str(scenario.ballots()))
+    
+    # the channel bucket holds 4 commands, a listing leaves 2 of them for votes
+    scenario.command('owner', 'flood', '--user 0 --total 4')
+    
+    for nick in ('bob', 'carl', 'dave'):
+        scenario.command(nick, 'list')
+    
+    for nick in ('erin', 'fred', 'gina'):
+        scenario.command(nick, 'vote', '--quiet 1')
+    
+    for attempt in range(10):
+        scenario.command('owner', 'list')
+    
+    shed = scenario.plugin.floodControl.shedCounts('#checks')
+    busy = [ recipient for recipient, text in scenario.replies if text.startswith("The bot is busy") ]
+    
+    expect(shed == { ('vote', 'user'): 2, ('list', 'channel'): 1, ('vote', 'channel'): 1 }, "channel limit: shed " + str(shed))
+    expect(busy == [ '@dave', '@gina' ] and sorted(scenario.ballots()) == [ '@alice', '@erin', '@fred' ], "channel limit: busy " + str(busy) + ", ballots " + str(sorted(scenario.ballots())))
+
+
+# the website catches up with the forwarded lines after its cursor, an unknown cursor or dropped lines are reported as gap
+def backlogReplay(scenario):
+    scenario.command('owner', 'tb_apikey', 'checks-key')
+    chan = scenario.plugin.chans[0]
+    
+    def say(nick, text, subtype=None):
+        event = { 'type': 'message', 'text': text, 'ts': '{:.6f}'.format(time.time()) }
+        
+        if subtype is not None:
+            event['subtype'] = subtype
+        
+        scenario.say(nick, text, { 'slack_event': event })
+    
+    def backlog(cursor=None, key='checks-key'):
+        response = scenario.plugin.web_backlog(Request({ 'Authorization': 'Bearer ' + key }, **({ 'cursor': cursor } if cursor is not None else { })), 'checks')
+        
+        return json.loads(response.get_data()) if response.status_code == 200 else response.status_code
+    
+    # waits until the forwarder posted the lines
+    def forwarded(count):
+        deadline = time.time() + 5
+        
+        while len(scenario.hslive.arrivals) < count and time.time() < deadline:
+            time.sleep(0.01)
+    
+    say('alice', 'first line')
+    say('bob', 'joined', 'channel_join')
+    say('bob', '!vote 1')
+    say('bob', 'second line')
+    forwarded(2)
+    
+    first = backlog()
+    expect(first['gap'] and [ (line['nick'], line['post']) for line in first['lines'] ] == [ ('alice', 'first line'), ('bob', 'second line') ], "backlog: " + str(first))
+    expect([ (fields['nick'], fields['post']) for arrival, fields in scenario.hslive.arrivals ] == [ (line['nick'], line['post']) for line in first['lines'] ], "posted: " + str(scenario.hslive.arrivals))
+    expect(backlog(key='wrong') == 403, "backlog read with a wrong API key")
+    
+    say('carl', 'third line')
+    forwarded(3)
+    
+    later = backlog(first['cursor'])
+    expect(not later['gap'] and [ (line['nick'], line['post'], line['seq']) for line in later['lines'] ] == [ ('carl', 'third line', 3) ], "backlog after the cursor: " + str(later))
+    expect(backlog(later['cursor'])['lines'] == [ ], "backlog after the latest cursor: " + str(backlog(later['cursor'])))
+    
+    scenario.restart()
+    expect(backlog(later['cursor']) == { 'cursor': scenario.plugin.chans[0].epoch + '-0', 'gap': True, 'lines': [ ] }, "backlog after a restart: " + str(backlog(later['cursor'])))
+    
+    lines = titlebot.ChatBacklog(3, 10 ** 6)
+    
+    for index in range(5):
+        lines.append({ 'post': str(index) })
+    
+    seq, dropped, gap = lines.read(1)
+    expect((seq, [ json.loads(line)['post'] for line in dropped ], gap) == (5, [ '2', '3', '4' ], True), "bounded backlog: " + str((seq, dropped, gap)))
+
+
+CHECKS = [ voteZero, quickVoteZero, ballotZero, archiveRanked, archiveOnce, webCacheEvicted, runoffRecount, batchChanges, emojiDuplicates, digest, conditionalResults, eventDelivery, pollRouting, tombstoneRetention, historyDeltas, streamedExport, metricsExposition, floodRejected, backlogReplay ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='regression checks of titlebot-ng')
+    parser.add_argument('--storage', choices=['kv', 'sqlite'], action='append', help='storage backend (repeatable). default: both')
+    parser.add_argument('names', nargs='*', help='the checks to run. default: all')
+    args = parser.parse_args()
+    
+    checks = [ check for check in CHECKS if len(args.names) == 0 or check.__name__ in args.names ]
+    failed = 0
+    
+    for storage in args.storage or [ 'kv', 'sqlite' ]:
+        for check in checks:
+            with tempfile.TemporaryDirectory() as dataDir:
+                scenario = Scenario(storage, dataDir, [ 'alice', 'bob', 'carl' ])
+                
+                try:
+                    check(scenario)
+                    print("ok      " + check.__name__ + " (" + storage + ")")
+                except Exception as e:
+                    failed += 1
+                    print("FAILED  " + check.__name__ + " (" + storage + "): " + (str(e) if isinstance(e, AssertionError) else traceback.format_exc()))
+                finally:
+                    scenario.stop()
+    
+    print("----- " + str(len(checks) * len(args.storage or [ 'kv', 'sqlite' ]) - failed) + " passed, " + str(failed) + " failed -----")
+    
+    sys.exit(0 if failed == 0 else 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+"""
+In-process fake errbot backend for the titlebot-ng benchmarks and load tools
+
+Provides rooms, occupants, person identities, messages, a pickling plugin store with write statistics and pollers.
+The plugin runs unmodified on top of it, only the errbot plumbing of BotPlugin is replaced. Messages and files take the
+plugin's send path down to errbot's BotPlugin, just the transport of the bot is a counter. errbot and flask must be installed.
+"""
+
+from threading import Event, Lock, Thread
+
+import collections
+import inspect
+import logging
+import math
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from errbot.backends.base import Identifier
+
+import titlebot
+
+
+class FakePerson(Identifier):
+    # person        string, '@' + nick
+    # nick          string
+    
+    def __init__(self, nick):
+        self.person = '@' + nick
+        self.nick = nick
+        self.fullname = nick
+        self.client = None
+        self.aclattr = self.person
+        self.email = None
+    
+    
+    def __str__(self):
+        return self.person
+    
+    
+    def __eq__(self, other):
+        return isinstance(other, FakePerson) and other.person == self.person
+    
+    
+    def __hash__(self):
+        return hash(self.person)
+
+
+
+class FakeOccupant(FakePerson):
+    # room          FakeRoom
+    
+    def __init__(self, nick, room):
+        super().__init__(nick)
+        
+        self.room = room
+
+
+
+class FakeRoom(Identifier):
+    # name          string, '#' + channel
+    # occupants     list of FakeOccupant
+    # joined        bool
+    
+    def __init__(self, name):
+        self.name = name
+        self.occupants = [ ]
+        self.joined = True
+    
+    
+    # nick: string -> FakeOccupant
+    def join(self, nick):
+        occupant = FakeOccupant(nick, self)
+        self.occupants.append(occupant)
+        
+        return occupant
+    
+    
+    def __str__(self):
+        return self.name
+    
+    
+    def __eq__(self, other):
+        return isinstance(other, FakeRoom) and other.name == self.name
+    
+    
+    def __hash__(self):
+        return hash(self.name)
+
+
+
+class FakeMessage:
+    # body          string
+    # frm           FakePerson
+    # to            FakeRoom or FakePerson
+    # extras        dict
+    
+    def __init__(self, frm, to, body='', extras=None):
+        self.frm = frm
+        self.to = to
+        self.body = body
+        self.extras = extras if extras is not None else { }
+    
+    
+    @property
+    def is_direct(self):
+        return not isinstance(self.to, FakeRoom)
+    
+    
+    @property
+    def is_group(self):
+        return isinstance(self.to, FakeRoom)
+
+
+
+class FakeConfig:
+    # BOT_ADMINS    tuple of string
+    # BOT_PREFIX    string
+    # BOT_DATA_DIR  string
+    
+    def __init__(self, owners, dataDir):
+        self.BOT_ADMINS = tuple(owners)
+        self.BOT_PREFIX = '!'
+        self.BOT_DATA_DIR = dataDir
+        self.BOT_ALT_PREFIXES = ()
+
+
+
+class FakeRepoManager:
+    def __init__(self, dataDir):
+        self.plugin_dir = dataDir
+
+
+
+class FakeBot:
+    """
+    Stands in for the errbot core, every hook the plugin base class might call is a no-op except for the transport of
+    messages and files, which counts them
+    """
+    
+    # sent          collections.Counter, messages sent per kind ('channel', 'direct', 'files') and their size ('bytes')
+    # sentLock      Lock
+    
+    def __init__(self, owners, dataDir):
+        self.bot_config = FakeConfig(owners, dataDir)
+        self.repo_manager = FakeRepoManager(dataDir)
+        self.storage_plugin = None
+        self.sent = collections.Counter()
+        self.sentLock = Lock()
+    
+    
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+    
+    
+    # called by BotPlugin.send
+    def send(self, identifier, text, in_reply_to=None, groupchat_nick_reply=False):
+        with self.sentLock:
+            self.sent['channel' if isinstance(identifier, FakeRoom) else 'direct'] += 1
+            self.sent['bytes'] += len(text)
+    
+    
+    # called by BotPlugin.send_stream_request
+    def send_stream_request(self, user, fsource, name=None, size=None, stream_type=None):
+        with self.sentLock:
+            self.sent['files'] += 1
+            self.sent['bytes'] += len(fsource.read())
+
+
+
+class StoreStats:
+    # writes        int, number of store writes
+    # bytes         int, pickled size of all writes
+    # lock          Lock
+    
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.lock = Lock()
+    
+    
+    # size: int
+    def record(self, size):
+        with self.lock:
+            self.writes += 1
+            self.bytes += size
+    
+    
+    # -> (int, int)
+    def snapshot(self):
+        with self.lock:
+            return (self.writes, self.bytes)
+
+
+
+class FakeTitlebot(titlebot.Titlebot):
+    """
+    Titlebot with the errbot plumbing replaced: rooms, plugin store and pollers
+    
+    Pollers run in their own threads like errbot's pollers, their callbacks are timed as 'poller:<name>'.
+    """
+    
+    # fakeRooms     list of FakeRoom
+    # fakeStore     dict of string -> bytes, pickled like errbot's persistent stores
+    # storeStats    StoreStats
+    # sent          collections.Counter, FakeBot.sent
+    # timings       Timings (None: callbacks are not timed)
+    # pollers       dict of method -> (Event, Thread)
+    
+    def __init__(self, owners=('@owner', ), dataDir='.', timings=None):
+        bot = FakeBot(owners, dataDir)
+        super().__init__(bot, 'Titlebot')
+        
+        self.fakeRooms = [ ]
+        self.fakeStore = { }
+        self.storeStats = StoreStats()
+        self.sent = bot.sent
+        self.timings = timings
+        self.pollers = { }
+    
+    
+    # errbot plumbing
+    
+    def init_storage(self):
+        pass
+    
+    
+    def open_storage(self, *args, **kwargs):
+        pass
+    
+    
+    def close_storage(self):
+        pass
+    
+    
+    def __getitem__(self, key):
+        return pickle.loads(self.fakeStore[key])
+    
+    
+    def __setitem__(self, key, value):
+        data = pickle.dumps(value)
+        
+        self.storeStats.record(len(data))
+        self.fakeStore[key] = data
+    
+    
+    def __delitem__(self, key):
+        del self.fakeStore[key]
+    
+    
+    def __contains__(self, key):
+        return key in self.fakeStore
+    
+    
+    def rooms(self):
+        return self.fakeRooms
+    
+    
+    def query_room(self, room):
+        for candidate in self.fakeRooms:
+            if str(candidate) == room:
+                return candidate
+        
+        raise ValueError("no such room: " + room)
+    
+    
+    def build_identifier(self, text):
+        if text.startswith('#'):
+            return self.query_room(text)
+        
+        return FakePerson(text.lstrip('@'))
+    
+    
+    def start_poller(self, interval, method, times=None, args=None, kwargs=None):
+        stop = Event()
+        
+        def run():
+            while not stop.wait(interval):
+                begin = time.perf_counter()
+                
+                try:
+                    method()
+                except Exception:
+                    self.log.exception("poller " + method.__name__ + " failed")
+                
+                if self.timings is not None:
+                    self.timings.record('poller:' + method.__name__, time.perf_counter() - begin)
+        
+        thread = Thread(target=run, name='poller-' + method.__name__, daemon=True)
+        self.pollers[method] = (stop, thread)
+        thread.start()
+    
+    
+    def stop_poller(self, method, args=None, kwargs=None):
+        stop, thread = self.pollers.pop(method, (None, None))
+        
+        if stop is not None:
+            stop.set()
+    
+    
+    # helpers
+    
+    # name: string (with leading '#'), nicks: list of string -> FakeRoom
+    def addRoom(self, name, nicks):
+        room = FakeRoom(name)
+        
+        for nick in nicks:
+            room.join(nick)
+        
+        self.fakeRooms.append(room)
+        
+        return room
+    
+    
+    # runs a bot command the way errbot does: argument string parsed by the command decorator, replies drained
+    # name: string (method name), msg: FakeMessage, args: string
+    def command(self, name, msg, args=''):
+        result = getattr(self, name)(msg, args)
+        
+        if inspect.isgenerator(result):
+            collections.deque(result, maxlen=0)
+
+
+
+class Timings:
+    """
+    Latency samples per command, thread-safe
+    """
+    
+    # samples       dict of string -> list of float (seconds)
+    # lock          Lock
+    
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.lock = Lock()
+    
+    
+    # name: string, seconds: float
+    def record(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds)
+    
+    
+    # -> dict of string -> dict (count, mean, p50, p90, p99, max in milliseconds)
+    def summary(self):
+        with self.lock:
+            samples = { name: sorted(values) for name, values in self.samples.items() }
+        
+        result = { }
+        
+        for name, values in samples.items():
+            result[name] = {
+                'count': len(values),
+                'mean': 1000 * sum(values) / len(values),
+                'p50': 1000 * percentile(values, 0.5),
+                'p90': 1000 * percentile(values, 0.9),
+                'p99': 1000 * percentile(values, 0.99),
+                'max': 1000 * values[-1],
+            }
+        
+        return result
+
+
+
+# values: sorted list of float, fraction: float -> float (nearest rank)
+def percentile(values, fraction):
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+# -> int (bytes passed to write() by this process, None: not available on this platform)
+def writtenBytes():
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    
+    return None
+
+
+logging.getLogger('errbot.plugins.Titlebot').setLevel(logging.WARNING)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Slack event replay harness for the HSLive Slack Streaming forwarder (WebsiteForwardWorker)
+
+Feeds recorded or synthetic Slack message events through Titlebot.callback_message at a configurable rate,
+the forwarders post them to a local stub HSLive server which records the arrivals and simulates latency and failures.
+Reports the end-to-end lag, throughput, drops and ordering violations per run.
+
+    python tools/replay.py --rate 50 --duration 30 --channels 2 --latency 0.05 --fail 0.01
+    python tools/replay.py --input events.jsonl --speed 10
+
+Recorded events are JSON lines, one Slack event per line as found in msg.extras['slack_event'] (channel, user, text, ts, subtype).
+To correlate arrivals, the harness appends a sequence marker ' ~<number>' to every message text.
+errbot, flask and requests have to be installed.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from threading import Lock, Thread
+from urllib.parse import parse_qs
+
+import argparse
+import json
+import logging
+import random
+import re
+import tempfile
+import time
+
+from fakebackend import FakeMessage, FakeTitlebot, percentile
+
+import titlebot
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Stub of the HSLive add_line.php endpoint, records every arrival
+    """
+    
+    # latency       float, seconds until a request is answered
+    # jitter        float, additional random latency (seconds)
+    # fail          float, fraction of requests answered with HTTP 500
+    # arrivals      list of (float, dict), arrival time and form fields of the accepted requests
+    # failed        int, number of requests answered with HTTP 500
+    # lock          Lock
+    
+    daemon_threads = True
+    
+    MARKER = re.compile(r' ~(\d+)$')
+    
+    def __init__(self, latency, jitter, fail, seed):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        
+        self.latency = latency
+        self.jitter = jitter
+        self.fail = fail
+        self.random = random.Random(seed)
+        self.arrivals = [ ]
+        self.failed = 0
+        self.lock = Lock()
+    
+    
+    # -> string
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + '/live/add_line.php'
+    
+    
+    # fields: dict -> int (HTTP status)
+    def receive(self, fields):
+        with self.lock:
+            delay = self.latency + self.random.random() * self.jitter
+            failing = self.random.random() < self.fail
+        
+        time.sleep(delay)
+        
+        with self.lock:
+            if failing:
+                self.failed += 1
+                
+                return 500
+            
+            self.arrivals.append((time.perf_counter(), fields))
+            
+            return 200
+
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        fields = { key: values[0] for key, values in parse_qs(body, keep_blank_values=True).items() }
+        
+        status = self.server.receive(fields)
+        
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+    
+    
+    def log_message(self, format, *args):
+        pass # silence the access log
+
+
+
+class Replay:
+    # args          argparse.Namespace
+    # random        random.Random
+    # server        StubServer
+    # plugin        FakeTitlebot
+    # rooms         list of FakeRoom
+    # sent          dict of int -> (float, FakeRoom, FakeMessage, bool), send time, channel, message and whether it should be forwarded
+    # sendDuration  float, seconds until the last event has been sent
+    
+    # Slack message subtypes of the synthetic load and their frequency, None: regular message
+    SUBTYPES = [ (None, 0.80), ('me_message', 0.03), ('message_changed', 0.05), ('message_replied', 0.02), ('reply_broadcast', 0.02), ('bot_message', 0.03), ('channel_join', 0.03), ('command', 0.02) ]
+    WORDS = 'ich finde das foto echt super aber der titel blende zeit iso licht kamera objektiv podcast folge live'.split()
+    
+    def __init__(self, args, dataDir):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.server = StubServer(args.latency, args.jitter, args.fail, args.seed)
+        self.sent = { }
+        self.sendDuration = 0
+        
+        self.plugin = FakeTitlebot(dataDir=dataDir)
+        self.plugin.configure({ 'HSLIVE_URL': self.server.url(), 'HSLIVE_TIMEOUT': args.timeout })
+        self.rooms = [ self.plugin.addRoom('#replay' + str(index), [ 'owner' ] + [ 'user' + str(user) for user in range(args.users) ]) for index in range(args.channels) ]
+        
+        # decides like the forwarder whether an event is forwarded, never started
+        self.filter = titlebot.WebsiteForwardWorker(Queue(), logging.getLogger('replay'), None, (None, 0), None)
+    
+    
+    def run(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        
+        self.plugin.activate()
+        
+        for index, room in enumerate(self.rooms):
+            owner = room.occupants[0]
+            self.plugin.command('tb_channel', FakeMessage(owner, room), 'add')
+            self.plugin.command('tb_apikey', FakeMessage(owner, room), 'replay-key-' + str(index))
+        
+        events = self.recorded() if self.args.input is not None else self.synthetic()
+        
+        begin = time.perf_counter()
+        
+        for seq, (due, room, event) in enumerate(events):
+            delay = begin + due - time.perf_counter()
+            
+            if delay > 0:
+                time.sleep(delay)
+            
+            self.send(seq, room, event)
+        
+        self.sendDuration = time.perf_counter() - begin
+        self.settle()
+        
+        self.plugin.deactivate()
+        self.server.shutdown()
+    
+    
+    # -> iterator of (float, FakeRoom, dict), due time relative to the start, channel and Slack event
+    def synthetic(self):
+        count = int(self.args.rate * self.args.duration)
+        
+        for index in range(count):
+            room = self.random.choice(self.rooms)
+            user = self.random.choice(room.occupants[1:])
+            subtype = self.random.choices([ subtype for subtype, weight in Replay.SUBTYPES ], [ weight for subtype, weight in Replay.SUBTYPES ])[0]
+            text = ' '.join(self.random.choice(Replay.WORDS) for word in range(self.random.randint(1, 20)))
+            
+            event = { 'type': 'message', 'channel': str(room), 'user': user.nick, 'text': text, 'ts': '{:.6f}'.format(time.time()) }
+            
+            if subtype == 'command':
+                event['text'] = '!vote ' + str(self.random.randint(1, 50))
+            elif subtype is not None:
+                event['subtype'] = subtype
+            
+            if subtype in ('message_changed', 'message_replied'):
+                event['message'] = { 'type': 'message', 'user': user.nick, 'text': text, 'ts': event['ts'] }
+            
+            yield (index / self.args.rate, room, event)
+    
+    
+    # -> iterator of (float, FakeRoom, dict), paced by the Slack timestamps (divided by --speed) or by --rate
+    def recorded(self):
+        channels = { }
+        first = None
+        
+        with open(self.args.input) as input:
+            for index, line in enumerate(input):
+                if not line.strip():
+                    continue
+                
+                event = json.loads(line)
+                room = channels.setdefault(event.get('channel'), self.rooms[len(channels) % len(self.rooms)])
+                ts = float(event.get('ts', 0))
+                first = ts if first is None else first
+                
+                # the forwarder reports the time of the original message, shift it to now
+                event['ts'] = '{:.6f}'.format(time.time() + ts - first)
+                
+                if self.args.rate is not None:
+                    yield (index / self.args.rate, room, event)
+                else:
+                    yield ((ts - first) / self.args.speed, room, event)
+    
+    
+    # seq: int, room: FakeRoom, event: dict
+    def send(self, seq, room, event):
+        nick = event.get('user') or (event.get('message') or { }).get('user') or 'user0'
+        frm = [ occupant for occupant in room.occupants if occupant.nick == nick ]
+        frm = frm[0] if len(frm) > 0 else room.join(nick)
+        
+        msg = FakeMessage(frm, room, event.get('text', '') + ' ~' + str(seq), { 'slack_event': event })
+        expected = not msg.body.lstrip().startswith('!') and not self.filter.filterMsg(msg)
+        
+        self.sent[seq] = (time.perf_counter(), room, msg, expected)
+        self.plugin.callback_message(msg)
+    
+    
+    # waits until the forwarders are idle and no request arrived for --settle seconds
+    def settle(self):
+        deadline = time.perf_counter() + self.args.drain
+        count = -1
+        
+        while time.perf_counter() < deadline:
+            queued = sum(chan.streamQueue.qsize() for chan in self.plugin.chans if chan.streamQueue is not None)
+            
+            with self.server.lock:
+                arrived = len(self.server.arrivals) + self.server.failed
+            
+            if queued == 0 and arrived == count:
+                return
+            
+            count = arrived
+            time.sleep(self.args.settle)
+    
+    
+    # -> dict
+    def report(self):
+        keys = { 'replay-key-' + str(index): room for index, room in enumerate(self.rooms) }
+        
+        with self.server.lock:
+            arrivals = list(self.server.arrivals)
+            failed = self.server.failed
+        
+        lags = [ ]
+        seen = set()
+        duplicates = 0
+        unexpected = 0
+        misrouted = 0
+        payloadErrors = 0
+        violations = 0
+        lastSeq = { }
+        
+        for arrival, fields in arrivals:
+            marker = StubServer.MARKER.search(fields.get('post', ''))
+            
+            if marker is None or int(marker.group(1)) not in self.sent:
+                unexpected += 1
+                continue
+            
+            seq = int(marker.group(1))
+            sentAt, room, msg, expected = self.sent[seq]
+            
+            if seq in seen:
+                duplicates += 1
+                continue
+            
+            seen.add(seq)
+            
+            if not expected:
+                unexpected += 1
+            
+            if keys.get(fields.get('secret')) != room:
+                misrouted += 1
+            
+            ts = self.filter.extractTimestamp(msg)
+            
+            if fields.get('time') != '{:02d}:{:02d}'.format(ts.tm_hour, ts.tm_min) or fields.get('nick') != str(msg.frm.person)[1:]:
+                payloadErrors += 1
+            
+            # each channel is forwarded by its own worker, the order is only defined within a channel
+            if seq < lastSeq.get(room, -1):
+                violations += 1
+            
+            lastSeq[room] = max(seq, lastSeq.get(room, -1))
+            lags.append(arrival - sentAt)
+        
+        expected = [ seq for seq, (sentAt, room, msg, forward) in self.sent.items() if forward ]
+        lags.sort()
+        window = (arrivals[-1][0] - arrivals[0][0]) if len(arrivals) > 1 else 0
+        
+        return {
+            'events': len(self.sent),
+            'sendRate': len(self.sent) / self.sendDuration if self.sendDuration > 0 else 0,
+            'expected': len(expected),
+            'arrived': len(seen),
+            'failed': failed,
+            'dropped': len([ seq for seq in expected if seq not in seen ]),
+            'unexpected': unexpected,
+            'duplicates': duplicates,
+            'misrouted': misrouted,
+            'payloadErrors': payloadErrors,
+            'orderViolations': violations,
+            'throughput': len(arrivals) / window if window > 0 else 0,
+            'lag': { key: 1000 * percentile(lags, fraction) for key, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)) } if len(lags) > 0 else None,
+        }
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Slack event replay harness for the HSLive forwarder of titlebot-ng')
+    parser.add_argument('--input', metavar='FILE', help='recorded Slack events (JSON lines), default: synthetic events')
+    parser.add_argument('--rate', type=float, help='events per second, default for synthetic events: 20')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed of recorded events without --rate. default=1')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of synthetic load. default=30')
+    parser.add_argument('--channels', type=int, default=1, help='number of channels, each with its own forwarder. default=1')
+    parser.add_argument('--users', type=int, default=50, help='number of users per channel. default=50')
+    parser.add_argument('--latency', type=float, default=0.02, help='response time of the stub server (seconds). default=0.02')
+    parser.add_argument('--jitter', type=float, default=0.0, help='additional random response time of the stub server (seconds). default=0')
+    parser.add_argument('--fail', type=float, default=0.0, help='fraction of requests the stub server answers with HTTP 500. default=0')
+    parser.add_argument('--timeout', type=float, default=titlebot.Titlebot.CONFIG_TEMPLATE['HSLIVE_TIMEOUT'], help='request timeout of the forwarder (HSLIVE_TIMEOUT). default=plugin default')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds without arrivals until the run ends. default=1')
+    parser.add_argument('--drain', type=float, default=120, help='maximum seconds to wait for the forwarders after the last event. default=120')
+    parser.add_argument('--seed', type=int, default=1, help='random seed. default=1')
+    parser.add_argument('--json', metavar='FILE', help='save the report as JSON')
+    args = parser.parse_args()
+    
+    if args.input is None and args.rate is None:
+        args.rate = 20.0
+    
+    with tempfile.TemporaryDirectory() as dataDir:
+        replay = Replay(args, dataDir)
+        replay.run()
+    
+    report = replay.report()
+    
+    print("----- Replay -----")
+    print("  events sent:       " + str(report['events']) + " ({:.1f}/s)".format(report['sendRate']))
+    print("  to be forwarded:   " + str(report['expected']))
+    print("  arrived:           " + str(report['arrived']) + " ({:.1f}/s)".format(report['throughput']))
+    print("  dropped:           " + str(report['dropped']) + " (stub server failures: " + str(report['failed']) + ")")
+    print("  unexpected:        " + str(report['unexpected']) + ", duplicates: " + str(report['duplicates']) + ", wrong channel: " + str(report['misrouted']) + ", wrong nick/time: " + str(report['payloadErrors']))
+    print("  order violations:  " + str(report['orderViolations']))
+    
+    if report['lag'] is not None:
+        print("  lag (ms):          " + ", ".join(key + " {:.1f}".format(value) for key, value in report['lag'].items()))
+    
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
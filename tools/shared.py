@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Multi-process test of the shared SQLite state (configuration 'SHARED')
+
+Two bot processes share one database on this host, each configures and serves its own channels:
+
+ 1. both vote in their channels at the same time and in the channels of the other process, those votes must be ignored
+ 2. the first process dies without releasing its leases, the second one has to take over its channels once the leases
+    have expired, with the same options and votes
+ 3. a third process, holding no lease, changes a channel in the database, the serving process has to reload it
+
+Every step ends with Poll.verify() in the serving process. Runs on the in-process fake backend (see fakebackend.py),
+errbot and flask must be installed.
+
+    python tools/shared.py
+    python tools/shared.py --channels 3 --voters 100 --lease 2
+
+Exit status 2 if a check failed.
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# name: string, path: string, args: argparse.Namespace -> FakeTitlebot with rooms for all channels, activated
+def startBot(name, path, args):
+    from fakebackend import FakeTitlebot
+    
+    plugin = FakeTitlebot(dataDir=os.path.dirname(path))
+    plugin.configure({ 'STORAGE': 'sqlite', 'SQLITE_PATH': path, 'SHARED': True, 'INSTANCE': name, 'LEASE_TIME': args.lease })
+    
+    for channel in channels(args):
+        plugin.addRoom(channel, [ 'owner' ] + [ 'user' + str(user) for user in range(args.voters) ])
+    
+    plugin.activate()
+    plugin.restored.wait()
+    
+    return plugin
+
+
+# args: argparse.Namespace -> list of string, the channels, the first half is served by process 'a', the rest by 'b'
+def channels(args):
+    return [ '#shared' + str(index) for index in range(2 * args.channels) ]
+
+
+# plugin: FakeTitlebot -> dict of string -> (dict of int -> int, list of str), vote counts and problems of the served channels
+def report(plugin):
+    result = { }
+    
+    for chan in plugin.chans:
+        poll = chan.polls['main']
+        result[str(chan.channel)] = ({ option.id: option.votes for option in poll.snapshot().live() }, chan.verify())
+    
+    return result
+
+
+# plugin: FakeTitlebot, channel: string, nick: string, command: string, args: string
+def command(plugin, channel, nick, name, args=''):
+    from fakebackend import FakeMessage
+    
+    room = plugin.query_room(channel)
+    plugin.command(name, FakeMessage([ occupant for occupant in room.occupants if occupant.nick == nick ][0], room), args)
+
+
+# plugin: FakeTitlebot, served: list of string, timeout: float -> bool (False: timed out)
+def awaitServed(plugin, served, timeout):
+    deadline = time.time() + timeout
+    
+    while time.time() < deadline:
+        if set(served) <= set(str(chan.channel) for chan in plugin.chans):
+            return True
+        
+        time.sleep(0.1)
+    
+    return False
+
+
+# a bot process, see the steps above
+# name: string ('a' or 'b'), path: string, args: argparse.Namespace, barrier: Barrier, control: Queue, results: Queue
+def worker(name, path, args, barrier, control, results):
+    plugin = startBot(name, path, args)
+    everything = channels(args)
+    own = everything[:args.channels] if name == 'a' else everything[args.channels:]
+    rnd = random.Random(name)
+    
+    for channel in own:
+        command(plugin, channel, 'owner', 'tb_channel', 'add')
+        command(plugin, channel, 'owner', 'enable')
+        
+        for option in range(args.options):
+            command(plugin, channel, 'owner', 'add', 'Shared title ' + str(option))
+    
+    barrier.wait()
+    
+    # concurrently with the other process, the votes in its channels are ignored here
+    for user in range(args.voters):
+        for channel in everything:
+            command(plugin, channel, 'user' + str(user), 'vote', str(rnd.randint(1, args.options)))
+    
+    barrier.wait()
+    results.put((name, 'voted', report(plugin)))
+    
+    if control.get() == 'die':
+        # the feeder thread of the queue has to release its lock shared with the other process first
+        results.close()
+        results.join_thread()
+        os._exit(0) # no deactivate(), the leases are left to expire
+    
+    # take over the channels of the dead process
+    tookOver = awaitServed(plugin, everything, 5 * args.lease)
+    results.put((name, 'takeover' if tookOver else 'takeover timed out', report(plugin)))
+    
+    # changes by another process are reloaded
+    control.get()
+    reloaded = awaitServed(plugin, everything, 5) and wait(lambda: all(len(chan.polls['main'].snapshot().live()) == args.options + 1 for chan in plugin.chans), 5)
+    results.put((name, 'reload' if reloaded else 'reload timed out', report(plugin)))
+    
+    plugin.deactivate()
+
+
+# condition: function -> bool, timeout: float -> bool
+def wait(condition, timeout):
+    deadline = time.time() + timeout
+    
+    while time.time() < deadline:
+        if condition():
+            return True
+        
+        time.sleep(0.1)
+    
+    return condition()
+
+
+# adds one option to every channel without serving any, like a bot process sharing the database as standby
+# path: string, args: argparse.Namespace
+def standby(path, args):
+    import titlebot
+    
+    storage = titlebot.SqliteStorage(path)
+    storage.enableNotifications('c')
+    
+    for channel in channels(args):
+        config = storage.loadChannel(channel)
+        poll = [ poll for poll in config.polls if poll.name == 'main' ][0]
+        # the stored nextOption only follows purges, the ids of the options count as well (see Poll.setOptions)
+        option = titlebot.VotingOption(max([ poll.nextOption ] + [ option.id + 1 for option in poll.options ]), 'Added by standby')
+        poll.options.append(option)
+        poll.nextOption = option.id + 1
+        storage.storeConfig(config)
+    
+    storage.close()
+
+
+class Checks:
+    # problems      list of str
+    
+    def __init__(self):
+        self.problems = [ ]
+    
+    
+    # condition: bool, text: string
+    def expect(self, condition, text):
+        if not condition:
+            self.problems.append(text)
+    
+    
+    # step: string, served: dict of string -> (dict of int -> int, list of str), see report
+    def consistent(self, step, served):
+        for channel, (counts, problems) in served.items():
+            self.problems += [ step + " " + channel + ": " + problem for problem in problems ]
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='multi-process test of the shared SQLite state of titlebot-ng')
+    parser.add_argument('--channels', type=int, default=2, help='number of channels per process. default=2')
+    parser.add_argument('--voters', type=int, default=50, help='number of voters per channel. default=50')
+    parser.add_argument('--options', type=int, default=10, help='number of options per channel. default=10')
+    parser.add_argument('--lease', type=int, default=2, help='LEASE_TIME in seconds. default=2')
+    args = parser.parse_args()
+    
+    context = multiprocessing.get_context('spawn')
+    checks = Checks()
+    
+    with tempfile.TemporaryDirectory() as dataDir:
+        path = os.path.join(dataDir, 'titlebot.sqlite')
+        barrier = context.Barrier(2)
+        results = context.Queue()
+        control = { name: context.Queue() for name in ('a', 'b') }
+        workers = { name: context.Process(target=worker, args=(name, path, args, barrier, control[name], results)) for name in ('a', 'b') }
+        
+        for process in workers.values():
+            process.start()
+        
+        try:
+            voted = dict((name, served) for name, step, served in [ results.get(timeout=120) for name in workers ])
+            
+            # 1. each process serves its own channels, the votes in the channels of the other process were ignored
+            everything = channels(args)
+            
+            checks.expect(sorted(voted['a']) == everything[:args.channels], "process a serves " + str(sorted(voted['a'])))
+            checks.expect(sorted(voted['b']) == everything[args.channels:], "process b serves " + str(sorted(voted['b'])))
+            
+            for name, served in voted.items():
+                checks.consistent("voted", served)
+                
+                for channel, (counts, problems) in served.items():
+                    checks.expect(sum(counts.values()) == args.voters, channel + " counts " + str(sum(counts.values())) + " votes, expected one per voter")
+            
+            # 2. a dies, b takes over its channels with their votes
+            control['a'].put('die')
+            control['b'].put('stay')
+            workers['a'].join(30)
+            
+            name, step, served = results.get(timeout=10 * args.lease + 30)
+            checks.expect(step == 'takeover', "b: " + step + ", serves " + str(sorted(served)))
+            checks.consistent(step, served)
+            
+            for channel, (counts, problems) in voted['a'].items():
+                checks.expect(served.get(channel, (None, ))[0] == counts, channel + " taken over with counts " + str(served.get(channel, (None, ))[0]) + ", served with " + str(counts))
+            
+            # 3. a standby process changes the channels, b reloads them
+            standby(path, args)
+            control['b'].put('go')
+            
+            name, step, served = results.get(timeout=60)
+            checks.expect(step == 'reload', "b: " + step)
+            checks.consistent(step, served)
+            
+            for channel in everything:
+                before = voted['a'].get(channel, voted['b'].get(channel))[0]
+                after = dict(served.get(channel, ({ }, ))[0])
+                added = [ id for id in after if id not in before ]
+                
+                checks.expect(len(added) == 1 and after.pop(added[0]) == 0 and after == before, channel + " reloaded with counts " + str(served.get(channel, (None, ))[0]) + ", before " + str(before))
+        except queue.Empty:
+            checks.problems.append("a bot process did not report in time")
+        finally:
+            for process in workers.values():
+                process.join(30)
+                
+                if process.is_alive():
+                    process.terminate()
+    
+    for problem in checks.problems:
+        print("FAILED  " + problem)
+    
+    print("----- Shared state: " + str(2 * args.channels) + " channels, 2 bot processes, " + str(len(checks.problems)) + " problems -----")
+    
+    sys.exit(0 if len(checks.problems) == 0 else 2)
+
+
+if __name__ == '__main__':
+    main()
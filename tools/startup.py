@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for titlebot-ng
+
+Measures loading the plugin module, activating the plugin and the latency of the first commands with many configured channels,
+using the in-process fake backend (see fakebackend.py). A first plugin instance configures the channels, further instances
+restore them from the same store like a restarted bot. The rooms are restored in the background after activation, a command
+for a channel still waiting for its restore restores that channel right away.
+
+    python tools/startup.py --channels 500 --options 20 --voters 50
+    python tools/startup.py --channels 500 --storage sqlite --runs 5
+
+errbot and flask must be installed.
+"""
+
+import argparse
+import importlib
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# modules: list of string -> (float, list of string), seconds and the modules newly loaded by importing them
+def timedImport(modules):
+    before = set(sys.modules)
+    begin = time.perf_counter()
+    
+    for module in modules:
+        importlib.import_module(module)
+    
+    return (time.perf_counter() - begin, sorted(name for name in set(sys.modules) - before if '.' not in name))
+
+
+class Startup:
+    # args          argparse.Namespace
+    # backend       module fakebackend, imported after the plugin import has been measured
+    # dataDir       string
+    # rooms         list of FakeRoom
+    # owner         dict of FakeRoom -> FakeOccupant
+    # store         dict of string -> bytes, the plugin store after the setup (kv storage)
+    # runs          list of dict, seconds per step of each restart
+    
+    def __init__(self, args, backend, dataDir):
+        self.args = args
+        self.backend = backend
+        self.dataDir = dataDir
+        self.random = random.Random(args.seed)
+        self.rooms = [ ]
+        self.owner = { }
+        self.store = { }
+        self.runs = [ ]
+    
+    
+    # -> FakeTitlebot
+    def plugin(self):
+        plugin = self.backend.FakeTitlebot(dataDir=self.dataDir)
+        plugin.configure({ 'STORAGE': self.args.storage, 'SQLITE_PATH': os.path.join(self.dataDir, 'titlebot.sqlite') })
+        plugin.fakeStore = dict(self.store)
+        plugin.fakeRooms = self.rooms
+        
+        return plugin
+    
+    
+    # configures the channels with their options and votes, the plugin is deactivated afterwards
+    def setup(self):
+        args = self.args
+        
+        for index in range(args.channels):
+            room = self.backend.FakeRoom('#startup' + str(index))
+            
+            self.owner[room] = room.join('owner')
+            
+            for user in range(args.voters):
+                room.join('user' + str(index) + '_' + str(user))
+            
+            self.rooms.append(room)
+        
+        plugin = self.plugin()
+        plugin.activate()
+        plugin.restored.wait()
+        
+        for room in self.rooms:
+            owner = self.backend.FakeMessage(self.owner[room], room)
+            
+            plugin.command('tb_channel', owner, 'add')
+            plugin.command('enable', owner, '')
+            
+            for option in range(args.options):
+                plugin.command('add', owner, 'Proposed title number ' + str(option))
+            
+            for occupant in room.occupants[1:]:
+                plugin.command('vote', self.backend.FakeMessage(occupant, room), str(self.random.randint(1, args.options)))
+        
+        plugin.deactivate()
+        
+        self.store = plugin.fakeStore
+    
+    
+    # plugin: FakeTitlebot, msg: FakeMessage -> float (seconds)
+    def command(self, plugin, msg):
+        begin = time.perf_counter()
+        plugin.command('list', msg, 'results')
+        
+        return time.perf_counter() - begin
+    
+    
+    # restarts the bot: activation, the first commands while the rooms are restored, the complete restore
+    def restart(self):
+        plugin = self.plugin()
+        last = self.rooms[-1]
+        other = self.random.choice(self.rooms[:-1]) if len(self.rooms) > 1 else last
+        
+        begin = time.perf_counter()
+        plugin.activate()
+        activated = time.perf_counter()
+        
+        # the last room is the last one restored in the background, its command restores it on demand
+        first = self.command(plugin, self.backend.FakeMessage(self.owner[last], last))
+        second = self.command(plugin, self.backend.FakeMessage(self.owner[other], other))
+        
+        plugin.restored.wait()
+        restored = time.perf_counter()
+        
+        warm = self.command(plugin, self.backend.FakeMessage(self.owner[other], other))
+        served = len(plugin.chans)
+        
+        plugin.deactivate()
+        
+        self.runs.append({
+            'activate': activated - begin,
+            'first': first,
+            'second': second,
+            'restored': restored - begin,
+            'warm': warm,
+            'channels': served,
+        })
+
+
+
+STEPS = (
+    ('activate', "activate() returned"),
+    ('first', "first command (last channel)"),
+    ('second', "second command (other channel)"),
+    ('restored', "all channels restored"),
+    ('warm', "command after the restore"),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='startup benchmark for titlebot-ng')
+    parser.add_argument('--channels', type=int, default=200, help='number of configured channels. default=200')
+    parser.add_argument('--options', type=int, default=20, help='number of options per channel. default=20')
+    parser.add_argument('--voters', type=int, default=50, help='number of voters per channel. default=50')
+    parser.add_argument('--storage', choices=['kv', 'sqlite'], default='kv', help='storage backend. default=kv')
+    parser.add_argument('--runs', type=int, default=3, help='number of restarts measured. default=3')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the workload. default=1')
+    args = parser.parse_args()
+    
+    dependencies, _ = timedImport([ 'errbot', 'flask' ])
+    plugin, loaded = timedImport([ 'titlebot' ])
+    backend = importlib.import_module('fakebackend')
+    
+    print("----- Import (ms) -----")
+    print("  errbot and flask: {:9.1f}".format(1000 * dependencies))
+    print("  titlebot:         {:9.1f}".format(1000 * plugin))
+    print("  loaded by titlebot: " + (", ".join(loaded) if len(loaded) > 0 else "nothing"))
+    
+    with tempfile.TemporaryDirectory() as dataDir:
+        startup = Startup(args, backend, dataDir)
+        
+        begin = time.perf_counter()
+        startup.setup()
+        print("----- Setup: " + str(args.channels) + " channels in {:.1f}s -----".format(time.perf_counter() - begin))
+        
+        for run in range(args.runs):
+            startup.restart()
+    
+    print("----- Restart with " + str(args.channels) + " channels (ms, median of " + str(args.runs) + " runs) -----")
+    
+    for key, label in STEPS:
+        values = [ run[key] for run in startup.runs ]
+        print("  {:<32} {:9.2f}  (min {:.2f}, max {:.2f})".format(label, 1000 * statistics.median(values), 1000 * min(values), 1000 * max(values)))
+    
+    missing = [ run['channels'] for run in startup.runs if run['channels'] != args.channels ]
+    
+    if len(missing) > 0:
+        print("error: channels not restored, served: " + ", ".join(str(count) for count in missing))
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Concurrent stress test of the channel state and its storage
+
+Writer threads vote, revoke, add and delete options in all channels at once while reader threads list the options, results
+and votes and a checker verifies the channels (Poll.verify(): vote counts, tally and ballots against the vote ledger) under load.
+Afterwards the bot is restarted from its store, the restored channels are verified and their vote counts compared to the
+live ones. Runs on the in-process fake backend (see fakebackend.py), errbot and flask must be installed.
+
+    python tools/stress.py --storage kv --seconds 10
+    python tools/stress.py --storage sqlite --threads 8 --channels 4
+
+Exit status 2 if a command failed or an inconsistency was found.
+"""
+
+from threading import Event, Lock, Thread
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fakebackend import FakeMessage, FakeTitlebot
+from titlebot import Tally
+
+
+class Stress:
+    # args          argparse.Namespace
+    # dataDir       string
+    # plugin        FakeTitlebot
+    # rooms         list of FakeRoom
+    # owner         dict of FakeRoom -> FakeOccupant
+    # voters        dict of FakeRoom -> list of FakeOccupant
+    # stop          Event, ends the concurrent phase
+    # commands      int, commands run by the writers and readers
+    # checks        int, verifications done while the commands were running
+    # problems      list of str, inconsistencies found
+    # failures      list of str, commands which raised an exception
+    # lock          Lock, guards commands, checks, problems and failures
+    
+    def __init__(self, args, dataDir):
+        self.args = args
+        self.dataDir = dataDir
+        self.stop = Event()
+        self.commands = 0
+        self.checks = 0
+        self.problems = [ ]
+        self.failures = [ ]
+        self.lock = Lock()
+        
+        self.plugin = self.newPlugin()
+        self.rooms = [ ]
+        self.owner = { }
+        self.voters = { }
+        
+        for index in range(args.channels):
+            room = self.plugin.addRoom('#stress' + str(index), [ ])
+            
+            self.owner[room] = room.join('owner')
+            self.voters[room] = [ room.join('user' + str(index) + '_' + str(user)) for user in range(args.voters) ]
+            self.rooms.append(room)
+    
+    
+    # -> FakeTitlebot
+    def newPlugin(self):
+        plugin = FakeTitlebot(dataDir=self.dataDir)
+        plugin.configure({ 'STORAGE': self.args.storage, 'SQLITE_PATH': os.path.join(self.dataDir, 'titlebot.sqlite') })
+        
+        return plugin
+    
+    
+    # name: string, msg: FakeMessage, args: string
+    def command(self, name, msg, args=''):
+        try:
+            self.plugin.command(name, msg, args)
+        except Exception as e:
+            with self.lock:
+                self.failures.append(name + " " + args + ": " + repr(e))
+        
+        with self.lock:
+            self.commands += 1
+    
+    
+    # room: FakeRoom -> FakeMessage, sent by the channel owner to the channel
+    def ownerMsg(self, room):
+        return FakeMessage(self.owner[room], room)
+    
+    
+    # the channels cycle through the voting modes, thus the ballots of every mode are stressed
+    def setup(self):
+        self.plugin.activate()
+        self.plugin.restored.wait()
+        
+        for index, room in enumerate(self.rooms):
+            self.command('tb_channel', self.ownerMsg(room), 'add')
+            self.command('mode', self.ownerMsg(room), Tally.MODES[index % len(Tally.MODES)])
+            self.command('enable', self.ownerMsg(room), '')
+            
+            for option in range(self.args.options):
+                self.command('add', self.ownerMsg(room), 'Stress title ' + str(option))
+    
+    
+    # rnd: random.Random, room: FakeRoom -> string, a ballot valid in the mode of the channel
+    def ballot(self, rnd, room):
+        options = self.args.options + self.args.seconds # a few of the options added later
+        
+        if self.rooms.index(room) % len(Tally.MODES) == 0:
+            return str(rnd.randint(1, options))
+        
+        return ' '.join(str(option) for option in rnd.sample(range(1, options + 1), rnd.randint(1, 4)))
+    
+    
+    # seed: int
+    def writer(self, seed):
+        rnd = random.Random(seed)
+        
+        while not self.stop.is_set():
+            room = rnd.choice(self.rooms)
+            msg = FakeMessage(rnd.choice(self.voters[room]), room)
+            kind = rnd.random()
+            
+            if kind < 0.55:
+                self.command('vote', msg, '--quiet ' + self.ballot(rnd, room))
+            elif kind < 0.85:
+                self.command('revoke', msg, '')
+            elif kind < 0.95:
+                self.command('add', msg, 'Late title ' + str(seed) + ' ' + str(rnd.random()))
+            else:
+                self.command('rm', self.ownerMsg(room), str(rnd.randint(1, self.args.options)))
+    
+    
+    # seed: int
+    def reader(self, seed):
+        rnd = random.Random(seed)
+        
+        while not self.stop.is_set():
+            room = rnd.choice(self.rooms)
+            self.command('list', self.ownerMsg(room), rnd.choice([ 'options', 'results', 'votes' ]))
+    
+    
+    def checker(self):
+        while not self.stop.wait(0.05):
+            problems = self.verify(self.plugin, 'live')
+            
+            with self.lock:
+                self.checks += 1
+                self.problems += problems
+    
+    
+    # plugin: FakeTitlebot, label: string -> list of str
+    def verify(self, plugin, label):
+        return [ label + " " + str(chan.channel) + ": " + problem for chan in plugin.chans for problem in chan.verify() ]
+    
+    
+    # plugin: FakeTitlebot -> dict of (string, string, int) -> int, vote count by channel, poll and option id
+    def counts(self, plugin):
+        result = { }
+        
+        for chan in plugin.chans:
+            for poll in chan.polls.values():
+                for option in poll.snapshot().live():
+                    result[(str(chan.channel), poll.name, option.id)] = option.votes
+        
+        return result
+    
+    
+    def run(self):
+        self.setup()
+        
+        threads = [ Thread(target=self.writer, args=(seed, ), daemon=True) for seed in range(self.args.threads) ]
+        threads += [ Thread(target=self.reader, args=(1000 + seed, ), daemon=True) for seed in range(self.args.readers) ]
+        threads.append(Thread(target=self.checker, daemon=True))
+        
+        for thread in threads:
+            thread.start()
+        
+        time.sleep(self.args.seconds)
+        self.stop.set()
+        
+        for thread in threads:
+            thread.join()
+        
+        self.problems += self.verify(self.plugin, 'final')
+        live = self.counts(self.plugin)
+        
+        self.plugin.deactivate()
+        
+        # restart from the store like a restarted bot
+        restarted = self.newPlugin()
+        restarted.fakeStore = self.plugin.fakeStore
+        restarted.fakeRooms = self.rooms
+        restarted.activate()
+        restarted.restored.wait()
+        
+        self.problems += self.verify(restarted, 'restored')
+        restored = self.counts(restarted)
+        
+        for key in sorted(set(live) | set(restored)):
+            if live.get(key) != restored.get(key):
+                self.problems.append("restored " + key[0] + " poll " + key[1] + " option " + str(key[2]) + " counts " + str(restored.get(key)) + " votes, live " + str(live.get(key)))
+        
+        restarted.deactivate()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='concurrent stress test of titlebot-ng')
+    parser.add_argument('--storage', choices=['kv', 'sqlite'], default='kv', help='storage backend. default=kv')
+    parser.add_argument('--channels', type=int, default=3, help='number of channels. default=3')
+    parser.add_argument('--voters', type=int, default=200, help='number of voters per channel. default=200')
+    parser.add_argument('--options', type=int, default=30, help='number of options per channel. default=30')
+    parser.add_argument('--threads', type=int, default=6, help='number of writer threads. default=6')
+    parser.add_argument('--readers', type=int, default=2, help='number of reader threads. default=2')
+    parser.add_argument('--seconds', type=int, default=5, help='duration of the concurrent phase. default=5')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as dataDir:
+        stress = Stress(args, dataDir)
+        stress.run()
+    
+    print("----- Stress: " + str(stress.commands) + " commands, " + str(stress.checks) + " checks under load -----")
+    
+    for failure in stress.failures[:20]:
+        print("failed: " + failure)
+    
+    for problem in stress.problems[:20]:
+        print("inconsistent: " + problem)
+    
+    print("----- Failed commands: " + str(len(stress.failures)) + ", inconsistencies: " + str(len(stress.problems)) + " -----")
+    
+    sys.exit(0 if len(stress.failures) == 0 and len(stress.problems) == 0 else 2)
+
+
+if __name__ == '__main__':
+    main()